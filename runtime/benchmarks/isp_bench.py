@@ -0,0 +1,539 @@
+#! /usr/bin/python3
+
+# Offline benchmarks for the Python hot paths of the runtime tools: load image,
+# flash init and hex dump generation, ELF architecture detection, composite
+# entity generation and log scraping. Inputs are synthetic (RISC-V ELF files of
+# bare metal, FreeRTOS and seL4 sizes, tag info blobs, entities files and logs),
+# so no toolchain, policy or network access is needed.
+#
+# Each benchmark runs in its own process, which reports the best and median
+# wall time of its repetitions, the throughput over the bytes it processes and
+# its peak RSS. Results can be saved with -o and compared against a previous
+# run with -b.
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import struct
+import logging
+import argparse
+import tempfile
+import statistics
+import multiprocessing
+
+runtime_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, runtime_dir)
+
+import isp_utils
+import isp_pexlog
+import isp_load_image
+import isp_install_policy
+import isp_run_app
+
+logger = logging.getLogger()
+
+# Fixture sizes per profile. "quick" finishes in about a minute; "full" uses
+# realistic seL4 image and multi-GB log sizes
+profiles = {
+    "quick": {"elf_scale": 0.25, "log_mb": 64, "entities": 500},
+    "full": {"elf_scale": 1, "log_mb": 2048, "entities": 5000},
+}
+
+# (name, address, size, type) of the sections of each synthetic executable,
+# at elf_scale 1, and the size of its tag info
+executables = {
+    "bare": {
+        "arch": "rv32",
+        "sections": [(".init", 0x80000000, 0x40, "text"),
+                     (".text", 0x80000040, 48 << 10, "text"),
+                     (".rodata", 0x8000c048, 8 << 10, "rodata"),
+                     (".data", 0x80010000, 4 << 10, "data"),
+                     (".sdata", 0x80011008, 0x100, "data"),
+                     (".bss", 0x80012000, 16 << 10, "bss")],
+        "taginfo": 32 << 10,
+    },
+    "frtos": {
+        "arch": "rv32",
+        "sections": [(".init", 0x80000000, 0x40, "text"),
+                     (".text", 0x80000040, 384 << 10, "text"),
+                     (".rodata", 0x80060040, 64 << 10, "rodata"),
+                     (".data", 0x80080000, 32 << 10, "data"),
+                     (".sdata", 0x80088004, 0x400, "data"),
+                     (".bss", 0x80090000, 256 << 10, "bss")],
+        "taginfo": 512 << 10,
+    },
+    "sel4": {
+        "arch": "rv64",
+        "sections": [(".text", 0x80200000, 4 << 20, "text"),
+                     (".rodata", 0x80600000, 8 << 20, "rodata"),
+                     (".data", 0x81000000, 512 << 10, "data"),
+                     (".bss", 0x81080000, 1 << 20, "bss")],
+        "taginfo": 8 << 20,
+    },
+}
+
+kernel_address = "0x00000000"
+ap_address = "0x00200000"
+
+# ELF constants for the synthetic executables
+elf_header = {"rv32": struct.Struct("<16sHHIIIIIHHHHHH"),
+              "rv64": struct.Struct("<16sHHIQQQIHHHHHH")}
+section_header = {"rv32": struct.Struct("<IIIIIIIIII"),
+                  "rv64": struct.Struct("<IIQQQQIIQQ")}
+elf_class = {"rv32": 1, "rv64": 2}
+em_riscv = 243
+sht_progbits = 1
+sht_strtab = 3
+sht_nobits = 8
+section_flags = {"text": 0x6, "rodata": 0x2, "data": 0x3, "bss": 0x3}
+
+
+def randomBytes(rng, size):
+    return rng.getrandbits(size * 8).to_bytes(size, "little") if size else b""
+
+
+# Writes a RISC-V executable with the given sections (see executables), with
+# pseudo-random contents. Only what the runtime tools read is filled in: the
+# ELF header and the section table
+def writeElf(path, arch, sections, scale, seed):
+    rng = random.Random(seed)
+    ehdr = elf_header[arch]
+    shdr = section_header[arch]
+
+    names = b"\0"
+    name_offsets = []
+    for name, _, _, _ in sections + [(".shstrtab", 0, 0, None)]:
+        name_offsets.append(len(names))
+        names += name.encode() + b"\0"
+
+    headers = [shdr.pack(0, 0, 0, 0, 0, 0, 0, 0, 0, 0)]
+    offset = ehdr.size
+    address_shift = 0
+    with open(path, "wb") as f:
+        f.write(bytes(ehdr.size))
+        for (name, address, size, kind), name_offset in zip(sections, name_offsets):
+            # scaled sections move later ones up, keeping the gaps between them
+            scaled_size = max(int(size * scale) & ~3, 4)
+            address += address_shift
+            address_shift += scaled_size - size
+
+            section_type = sht_nobits if kind == "bss" else sht_progbits
+            headers.append(shdr.pack(name_offset, section_type, section_flags[kind],
+                                     address, offset, scaled_size, 0, 0, 4, 0))
+            if section_type != sht_nobits:
+                f.write(randomBytes(rng, scaled_size))
+                offset += scaled_size
+
+        headers.append(shdr.pack(name_offsets[-1], sht_strtab, 0, 0, offset, len(names), 0, 0, 1, 0))
+        f.write(names)
+        offset += len(names)
+
+        shoff = (offset + 7) & ~7
+        f.write(bytes(shoff - offset))
+        f.write(b"".join(headers))
+
+        ident = b"\x7fELF" + bytes([elf_class[arch], 1, 1, 0]) + bytes(8)
+        f.seek(0)
+        f.write(ehdr.pack(ident, 2, em_riscv, 1, sections[0][1], 0, shoff, 0,
+                          ehdr.size, 0, 0, shdr.size, len(headers), len(headers) - 1))
+
+
+def writeTagInfo(path, size, seed):
+    rng = random.Random(seed)
+    with open(path, "wb") as f:
+        f.write(randomBytes(rng, size))
+
+
+# Writes entities files for a number of policies to entities_dir, in the format
+# of the policy sources
+def writeEntities(entities_dir, module, policies, count):
+    os.makedirs(entities_dir, exist_ok=True)
+    for policy in policies:
+        entities = [{"name": "{}.{}.entity{}".format(module, policy, i),
+                     "elf_name": "symbol_{}_{}".format(policy, i),
+                     "tag_all": i % 2 == 0}
+                    for i in range(count)]
+        with open(os.path.join(entities_dir, ".".join([module, policy, "entities", "yml"])), "w") as f:
+            isp_install_policy.yaml.dump_all([entities], f)
+
+
+def writeLog(path, size_mb, lines, last_line):
+    block = b"".join(lines)
+    block *= max((1 << 20) // len(block), 1)
+    with open(path, "wb") as f:
+        for _ in range(size_mb):
+            f.write(block)
+        f.write(last_line)
+
+
+uart_lines = [b"Running test iteration 1234, checksum 0x1a2b3c4d\n",
+              b"heap: allocated 0x00000040 bytes at 0x80023450\n"]
+
+pex_lines = [b"Validator: 0x80001234 addi sp,sp,-32 env: rwx.Code stack.Stack\n",
+             b"Rule cache miss at pc 0x80001238, computing tags\n",
+             b"Validator: 0x8000123c sw ra,28(sp) mem: heap.Pointer\n"]
+
+
+# Fixtures are written once per work directory and profile, and reused by
+# later runs with the same --workdir
+class Fixtures:
+    def __init__(self, work_dir, profile):
+        self.dir = os.path.join(work_dir, profile)
+        self.settings = profiles[profile]
+        os.makedirs(self.dir, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def exe(self, name):
+        path = self.path(name + ".elf")
+        if not os.path.exists(path):
+            exe = executables[name]
+            writeElf(path + ".tmp", exe["arch"], exe["sections"], self.settings["elf_scale"], name)
+            os.replace(path + ".tmp", path)
+        return path
+
+    def tagInfo(self, name):
+        path = self.path(name + ".taginfo")
+        if not os.path.exists(path):
+            size = int(executables[name]["taginfo"] * self.settings["elf_scale"])
+            writeTagInfo(path + ".tmp", size, name + "-tags")
+            os.replace(path + ".tmp", path)
+        return path
+
+    def loadImage(self, name):
+        path = self.path(name + ".load_image")
+        if not os.path.exists(path):
+            isp_load_image.generate_load_image(self.exe(name), path + ".tmp", self.tagInfo(name))
+            os.replace(path + ".tmp", path)
+        return path
+
+    def tagLoadImage(self, name):
+        path = self.path(name + ".tag_load_image")
+        if not os.path.exists(path):
+            isp_load_image.generate_tag_load_image(path + ".tmp", self.tagInfo(name))
+            os.replace(path + ".tmp", path)
+        return path
+
+    def entities(self):
+        entities_dir = self.path("entities")
+        policies = ["heap", "rwx", "stack", "threeClass", "cfi", "dataflow", "userType", "ppac"]
+        if not os.path.isdir(entities_dir):
+            writeEntities(entities_dir + ".tmp", "osv", policies, self.settings["entities"])
+            os.replace(entities_dir + ".tmp", entities_dir)
+        return entities_dir, policies
+
+    # a run directory holding uart.log, as getProcessExitCode expects
+    def uartRunDir(self):
+        run_dir = self.path("uart-run")
+        if not os.path.isdir(run_dir):
+            os.makedirs(run_dir + ".tmp", exist_ok=True)
+            last_line = "{} 0x0\n".format(isp_utils.terminateMessage("bare")).encode()
+            writeLog(os.path.join(run_dir + ".tmp", "uart.log"), self.settings["log_mb"], uart_lines, last_line)
+            os.replace(run_dir + ".tmp", run_dir)
+        return run_dir
+
+    def pexLog(self):
+        path = self.path("pex.log")
+        if not os.path.exists(path):
+            writeLog(path + ".tmp", self.settings["log_mb"], pex_lines,
+                     b"Policy Violation:\n    PC = 80001240  MEM = 80023450\n")
+            os.replace(path + ".tmp", path)
+        return path
+
+
+def fileSize(*paths):
+    total = 0
+    for path in paths:
+        if os.path.isdir(path):
+            total += sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+        else:
+            total += os.path.getsize(path)
+    return total
+
+
+# Each benchmark is (name, setup) where setup(fixtures, out_dir) generates the
+# fixtures it needs and returns (run, input bytes): run() is the timed call
+def benchmarks():
+    def getArch(name):
+        def setup(fixtures, out_dir):
+            exe = fixtures.exe(name)
+            return (lambda: isp_utils.getArch(exe)), None
+        return setup
+
+    def loadImage(name):
+        def setup(fixtures, out_dir):
+            exe = fixtures.exe(name)
+            tags = fixtures.tagInfo(name)
+            out = os.path.join(out_dir, name + ".load_image")
+            return (lambda: isp_load_image.generate_load_image(exe, out, tags)), fileSize(exe, tags)
+        return setup
+
+    def tagLoadImage(name):
+        def setup(fixtures, out_dir):
+            tags = fixtures.tagInfo(name)
+            out = os.path.join(out_dir, name + ".tag_load_image")
+            return (lambda: isp_load_image.generate_tag_load_image(out, tags)), fileSize(tags)
+        return setup
+
+    def flashInit(name):
+        def setup(fixtures, out_dir):
+            # the bare metal image stands in for the PEX kernel
+            kernel = fixtures.loadImage("bare")
+            ap = fixtures.tagLoadImage(name)
+            out = os.path.join(out_dir, name + ".init")
+            flash_init_map = {kernel_address: kernel, ap_address: ap}
+            return (lambda: isp_load_image.generate_flash_init(out, flash_init_map)), fileSize(kernel, ap)
+        return setup
+
+    def hexDump(name):
+        def setup(fixtures, out_dir):
+            image = fixtures.loadImage(name)
+            out = os.path.join(out_dir, name + ".hex")
+            return (lambda: isp_load_image.generate_hex_dump(image, out, 64)), fileSize(image)
+        return setup
+
+    def compositeEntities(fixtures, out_dir):
+        entities_dir, policies = fixtures.entities()
+        out = os.path.join(out_dir, "composite_entities.yml")
+        return ((lambda: isp_install_policy.generateCompositeEntities(policies, entities_dir, out, "osv")),
+                fileSize(entities_dir))
+
+    def exitCode(fixtures, out_dir):
+        run_dir = fixtures.uartRunDir()
+        return (lambda: isp_run_app.getProcessExitCode(run_dir, "bare")), fileSize(run_dir)
+
+    def pexScan(fixtures, out_dir):
+        pex_log = fixtures.pexLog()
+        return (lambda: isp_pexlog.scanFile(pex_log)), fileSize(pex_log)
+
+    result = []
+    for name in executables:
+        result.append(("getArch[{}]".format(name), getArch(name)))
+    for name in executables:
+        result.append(("generate_load_image[{}]".format(name), loadImage(name)))
+    for name in executables:
+        result.append(("generate_tag_load_image[{}]".format(name), tagLoadImage(name)))
+    for name in executables:
+        result.append(("generate_flash_init[{}]".format(name), flashInit(name)))
+    for name in executables:
+        result.append(("generate_hex_dump[{}]".format(name), hexDump(name)))
+    result.append(("generateCompositeEntities", compositeEntities))
+    result.append(("getProcessExitCode", exitCode))
+    result.append(("pexlog.scanFile", pexScan))
+
+    return result
+
+
+def readStatus(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+# Body of the process running one benchmark. The fixtures are generated in the
+# parent, so only the timed calls count towards the peak RSS
+def runBenchmark(setup, fixtures, out_dir, repeat, min_time, conn):
+    try:
+        run, input_bytes = setup(fixtures, out_dir)
+
+        # reset the peak RSS to the current RSS (Linux 4.0 and later)
+        try:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+        except IOError:
+            pass
+        base_rss = readStatus("VmRSS")
+
+        # calls too short to time individually are repeated in a loop
+        number = 1
+        while True:
+            start = time.perf_counter()
+            for _ in range(number):
+                run()
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time or number >= 1 << 20:
+                break
+            number *= 10
+
+        times = [elapsed / number]
+        for _ in range(repeat - 1):
+            start = time.perf_counter()
+            for _ in range(number):
+                run()
+            times.append((time.perf_counter() - start) / number)
+
+        peak_rss = readStatus("VmHWM")
+        conn.send({"times": times,
+                   "number": number,
+                   "input_bytes": input_bytes,
+                   "peak_rss": peak_rss,
+                   "peak_rss_increase": (peak_rss - base_rss) if peak_rss and base_rss else None})
+    except Exception as e:
+        conn.send({"error": "{}: {}".format(type(e).__name__, e)})
+    finally:
+        conn.close()
+
+
+def runIsolated(setup, fixtures, out_dir, repeat, min_time):
+    # generate fixtures in the parent so that the child's peak RSS only
+    # reflects the benchmark
+    try:
+        setup(fixtures, out_dir)
+    except Exception as e:
+        return {"error": "{}: {}".format(type(e).__name__, e)}
+
+    context = multiprocessing.get_context("fork")
+    parent_conn, child_conn = context.Pipe(duplex=False)
+    process = context.Process(target=runBenchmark,
+                              args=(setup, fixtures, out_dir, repeat, min_time, child_conn))
+    process.start()
+    child_conn.close()
+
+    try:
+        result = parent_conn.recv()
+    except EOFError:
+        result = None
+    process.join()
+
+    if result is None:
+        return {"error": "benchmark process exited with code {}".format(process.exitcode)}
+
+    return result
+
+
+def summarize(name, result):
+    if "error" in result:
+        return {"name": name, "error": result["error"]}
+
+    best = min(result["times"])
+    summary = {"name": name,
+               "best_seconds": best,
+               "median_seconds": statistics.median(result["times"]),
+               "repeat": len(result["times"]),
+               "number": result["number"],
+               "peak_rss_mb": result["peak_rss"] / (1 << 20) if result["peak_rss"] else None,
+               "peak_rss_increase_mb": (result["peak_rss_increase"] / (1 << 20)
+                                        if result["peak_rss_increase"] is not None else None)}
+
+    if result["input_bytes"]:
+        summary["input_mb"] = result["input_bytes"] / (1 << 20)
+        summary["throughput_mb_s"] = summary["input_mb"] / best if best > 0 else None
+    else:
+        summary["calls_per_second"] = 1 / best if best > 0 else None
+
+    return summary
+
+
+def formatRow(summary, baseline):
+    if "error" in summary:
+        return "{:<40} FAILED: {}".format(summary["name"], summary["error"])
+
+    if "throughput_mb_s" in summary:
+        rate = "{:10.1f} MB/s".format(summary["throughput_mb_s"])
+    else:
+        rate = "{:10.0f} /s  ".format(summary["calls_per_second"])
+
+    row = "{:<40} {:>12.6f} s {} {:>9.1f} MB".format(summary["name"], summary["best_seconds"], rate,
+                                                     summary["peak_rss_increase_mb"] or 0)
+
+    if baseline and "best_seconds" in baseline:
+        change = summary["best_seconds"] / baseline["best_seconds"] - 1
+        row += " {:+7.1%}".format(change)
+
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description='''
+    Benchmark the Python hot paths of the runtime tools on synthetic inputs
+    ''')
+    parser.add_argument("-p", "--profile", choices=sorted(profiles), default="quick", help='''
+    Fixture sizes. "full" uses multi-MB seL4 images and multi-GB logs. Default is quick
+    ''')
+    parser.add_argument("-k", "--filter", type=str, help='''
+    Only run benchmarks whose name matches this regular expression
+    ''')
+    parser.add_argument("-r", "--repeat", type=int, default=5, help='''
+    Number of timed repetitions of each benchmark. Default is 5
+    ''')
+    parser.add_argument("--min-time", type=float, default=0.1, help='''
+    Minimum duration in seconds of a repetition; shorter calls are looped. Default is 0.1
+    ''')
+    parser.add_argument("-w", "--workdir", type=str, help='''
+    Directory in which to keep the fixtures for later runs. Default is a
+    temporary directory
+    ''')
+    parser.add_argument("-o", "--output", type=str, help='''
+    Write the results to this JSON file
+    ''')
+    parser.add_argument("-b", "--baseline", type=str, help='''
+    JSON results of a previous run to compare against
+    ''')
+    parser.add_argument("--max-regression", type=float, default=0.25, help='''
+    With --baseline, exit with an error if any benchmark is slower than the
+    baseline by more than this fraction. Default is 0.25
+    ''')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = {b["name"]: b for b in json.load(f)["benchmarks"]}
+
+    temp_dir = None
+    work_dir = args.workdir
+    if not work_dir:
+        temp_dir = tempfile.TemporaryDirectory(prefix="isp-bench-")
+        work_dir = temp_dir.name
+
+    fixtures = Fixtures(work_dir, args.profile)
+    out_dir = os.path.join(work_dir, "out")
+    os.makedirs(out_dir, exist_ok=True)
+
+    print("{:<40} {:>14} {:>15} {:>12}".format("benchmark", "best", "rate", "peak RSS +"))
+
+    summaries = []
+    regressions = []
+    try:
+        for name, setup in benchmarks():
+            if args.filter and not re.search(args.filter, name):
+                continue
+
+            summary = summarize(name, runIsolated(setup, fixtures, out_dir, args.repeat, args.min_time))
+            summaries.append(summary)
+            print(formatRow(summary, baseline.get(name)), flush=True)
+
+            previous = baseline.get(name)
+            if previous and "best_seconds" in previous and "best_seconds" in summary:
+                if summary["best_seconds"] > previous["best_seconds"] * (1 + args.max_regression):
+                    regressions.append(name)
+    finally:
+        if temp_dir:
+            temp_dir.cleanup()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"profile": args.profile,
+                       "python": sys.version.split()[0],
+                       "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "benchmarks": summaries}, f, indent=2)
+
+    if regressions:
+        print("Slower than the baseline by more than {:.0%}: {}".format(args.max_regression, ", ".join(regressions)))
+        sys.exit(1)
+
+    if any("error" in s for s in summaries):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import logging
+import tempfile
+import contextlib
+import isp_utils
+
+logger = logging.getLogger()
+
+cache_root = os.path.join(isp_utils.getIspPrefix(), "cache")
+
+# Set to disable all artifact caches (e.g. when debugging the tools themselves)
+disable_env_var = "ISP_DISABLE_CACHE"
+
+# Overrides the per-cache default size limit, in megabytes
+max_size_env_var = "ISP_CACHE_MAX_SIZE"
+
+hash_chunk_size = 1 << 20
+
+# Staging directories older than this were left behind by a killed process
+stale_staging_seconds = 24 * 60 * 60
+
+
+def cacheEnabled():
+    return not os.environ.get(disable_env_var)
+
+
+def hashFile(path, h=None):
+    if h is None:
+        h = hashlib.sha256()
+
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(hash_chunk_size), b""):
+            h.update(chunk)
+
+    return h
+
+
+# Hash of every file name and contents under path, ignoring hidden files and
+# the directories in exclude
+def hashTree(path, exclude=()):
+    h = hashlib.sha256()
+
+    if os.path.isfile(path):
+        return hashFile(path, h).hexdigest()
+
+    exclude = [os.path.realpath(d) for d in exclude]
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if not d.startswith(".") and
+                         os.path.realpath(os.path.join(root, d)) not in exclude)
+        for name in sorted(files):
+            if name.startswith("."):
+                continue
+            file_path = os.path.join(root, name)
+            h.update(os.path.relpath(file_path, path).encode())
+            h.update(b"\0")
+            if os.path.isfile(file_path):
+                hashFile(file_path, h)
+
+    return h.hexdigest()
+
+
+# Identity of an installed tool, so that cache entries are not reused across tool updates
+def toolId(tool):
+    tool_path = shutil.which(tool)
+    if not tool_path:
+        return tool
+
+    st = os.stat(tool_path)
+    return "{}:{}:{}".format(tool_path, st.st_size, st.st_mtime_ns)
+
+
+def hashKey(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(repr(part).encode())
+        h.update(b"\0")
+
+    return h.hexdigest()
+
+
+def entrySize(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+
+    return size
+
+
+def copyEntry(src, dest):
+    isp_utils.removeIfExists(dest)
+    if os.path.isdir(src):
+        shutil.copytree(src, dest, symlinks=True)
+    else:
+        shutil.copy2(src, dest)
+
+
+@contextlib.contextmanager
+def lockFile(path, shared=False):
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def removeStaleBuildTrees(build_root, tree_id, stale_prefix):
+    for name in os.listdir(build_root):
+        if name == tree_id or name.endswith(".lock") or not name.startswith(stale_prefix):
+            continue
+
+        # Only the source hash may differ, e.g. "soc-gfe-" must not match "soc-gfe-sim-<hash>"
+        if "-" in name[len(stale_prefix):]:
+            continue
+
+        # the lock file is left in place: once unlinked, a process that opened
+        # it before and one that creates it anew would lock different files
+        stale_dir = os.path.join(build_root, name)
+        with lockFile(stale_dir + ".lock"):
+            logger.debug("Removing stale build tree {}".format(stale_dir))
+            isp_utils.removeIfExists(stale_dir)
+
+
+# A persistent build tree at $ISP_PREFIX/cache/<name>/<tree_id>, held under an
+# exclusive lock for the duration of the with block. tree_id should encode a
+# hash of the sources so that a source change starts a new tree; when a new
+# tree is created, other trees whose ids start with stale_prefix are removed.
+@contextlib.contextmanager
+def sharedBuildTree(name, tree_id, stale_prefix=""):
+    build_root = os.path.join(cache_root, name)
+    isp_utils.doMkDir(build_root)
+    tree_dir = os.path.join(build_root, tree_id)
+
+    with lockFile(tree_dir + ".lock"):
+        if not os.path.isdir(tree_dir):
+            removeStaleBuildTrees(build_root, tree_id, stale_prefix)
+        yield tree_dir
+
+
+# Marks build_dir, a directory of a shared build tree, as just used and removes
+# the least recently used of its siblings whose names start with prefix, so that
+# at most max_dirs of them are kept. The tree's lock must be held
+def pruneBuildDirs(build_dir, prefix, max_dirs):
+    os.utime(build_dir)
+    parent = os.path.dirname(build_dir)
+    dirs = []
+    for name in os.listdir(parent):
+        path = os.path.join(parent, name)
+        if name.startswith(prefix) and os.path.isdir(path):
+            dirs.append((os.path.getmtime(path), path))
+
+    for mtime, path in sorted(dirs)[:-max_dirs]:
+        logger.debug("Removing least recently used build dir {}".format(path))
+        isp_utils.removeIfExists(path)
+
+
+# A size-bounded, content-addressed store of build artifacts (files or
+# directories) under $ISP_PREFIX/cache/<name>.
+# Entries are published atomically with a rename, so concurrent builders of the
+# same key never observe a partial entry. An entry's mtime records its last
+# use and the least recently used entries are evicted once the cache grows
+# past max_size. Readers hold a shared lock while copying an entry out, and
+# eviction holds the exclusive lock.
+class ArtifactCache:
+    def __init__(self, name, max_size_mb):
+        self.name = name
+        self.cache_dir = os.path.join(cache_root, name)
+        self.lock_path = os.path.join(self.cache_dir, ".lock")
+        self.stats_path = os.path.join(self.cache_dir, ".stats.json")
+        self.enabled = cacheEnabled()
+        self.hits = 0
+        self.misses = 0
+
+        if max_size_env_var in os.environ:
+            max_size_mb = int(os.environ[max_size_env_var])
+        self.max_size = max_size_mb * (1 << 20)
+
+        if self.enabled:
+            isp_utils.doMkDir(self.cache_dir)
+
+    def entryPath(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    # Copies the entry for key to dest. Returns False on a cache miss
+    def fetch(self, key, dest):
+        if not self.enabled:
+            return False
+
+        entry_path = self.entryPath(key)
+        with lockFile(self.lock_path, shared=True):
+            if not os.path.exists(entry_path):
+                self.misses += 1
+                self.recordStat("misses")
+                logger.debug("{} cache miss for {}".format(self.name, key))
+                return False
+
+            copyEntry(entry_path, dest)
+            os.utime(entry_path)
+
+        self.hits += 1
+        self.recordStat("hits")
+        logger.debug("{} cache hit for {}".format(self.name, key))
+        return True
+
+    # Cumulative hit/miss counts across every process using this cache
+    def stats(self):
+        try:
+            with open(self.stats_path, "r") as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {"hits": 0, "misses": 0}
+
+    def recordStat(self, stat):
+        with lockFile(self.stats_path + ".lock"):
+            stats = self.stats()
+            stats[stat] = stats.get(stat, 0) + 1
+            with open(self.stats_path + ".tmp", "w") as f:
+                json.dump(stats, f)
+            os.replace(self.stats_path + ".tmp", self.stats_path)
+
+    # Stores a copy of src (a file or directory) as the entry for key
+    def publish(self, key, src):
+        if not self.enabled:
+            return
+
+        staging_dir = tempfile.mkdtemp(prefix=".tmp-", dir=self.cache_dir)
+        staged_path = os.path.join(staging_dir, "entry")
+
+        try:
+            copyEntry(src, staged_path)
+            os.rename(staged_path, self.entryPath(key))
+        except OSError as e:
+            # Another process may have published the same entry first
+            if not os.path.exists(self.entryPath(key)):
+                logger.warning("Failed to publish {} cache entry {}: {}".format(self.name, key, e))
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+        self.evict()
+
+    def evict(self):
+        with lockFile(self.lock_path):
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                path = self.entryPath(name)
+                if name.startswith(".tmp-"):
+                    if time.time() - os.path.getmtime(path) > stale_staging_seconds:
+                        shutil.rmtree(path, ignore_errors=True)
+                    continue
+                if name.startswith("."):
+                    continue
+                entries.append((os.path.getmtime(path), entrySize(path), path))
+
+            total_size = sum(size for _, size, _ in entries)
+            for mtime, size, path in sorted(entries):
+                if total_size <= self.max_size:
+                    break
+                logger.debug("Evicting {} cache entry {}".format(self.name, os.path.basename(path)))
+                isp_utils.removeIfExists(path)
+                total_size -= size
@@ -0,0 +1,221 @@
+import os
+import glob
+import gzip
+import select
+import logging
+import threading
+import collections
+
+logger = logging.getLogger()
+
+read_size = 1 << 20
+
+# how often the reader checks whether the capture is being closed
+poll_seconds = 0.1
+
+# Uncompressed bytes written to each segment before rotating to the next
+segment_size = 64 << 20
+
+# Fastest zlib level; debug validator output compresses well even at level 1
+compress_level = 1
+
+# Output waiting to be compressed is held in memory up to this size. Beyond it
+# new output is only kept in the uncompressed tail, so that a slow disk never
+# blocks the simulator's writes
+max_backlog = 256 << 20
+
+
+def segmentPath(path, index):
+    return "{}.{:04d}.gz".format(path, index)
+
+
+def segmentPaths(path):
+    return sorted(glob.glob(glob.escape(path) + ".[0-9][0-9][0-9][0-9].gz"))
+
+
+# Settings for a compressed log capture (see LogCapture), in megabytes
+class CaptureSettings:
+    def __init__(self, max_size_mb=1024, tail_size_mb=16):
+        self.max_size = max_size_mb << 20
+        self.tail_size = tail_size_mb << 20
+
+
+# Captures the output a child process writes to a pipe as gzip segments
+# <path>.0000.gz, <path>.0001.gz, ... rotated every segment_size bytes. Once the
+# segments exceed settings.max_size the oldest are deleted. The last
+# settings.tail_size bytes are also kept uncompressed in memory and written to
+# <path> when the capture ends, so the end of the log can be read directly.
+# One thread drains the pipe as fast as the child writes (feeding scanner, a
+# PexLogScanner, if given) and another compresses, so the child is never
+# blocked by compression or the disk.
+class LogCapture:
+    def __init__(self, path, settings, scanner=None):
+        self.path = path
+        self.settings = settings
+        self.scanner = scanner
+        self.tail = collections.deque()
+        self.tail_bytes = 0
+        self.backlog = collections.deque()
+        self.backlog_bytes = 0
+        self.backlog_ready = threading.Condition()
+        self.eof = False
+        self.total_bytes = 0
+        self.dropped_bytes = 0
+        self.segments = []
+        self.threads = []
+        self.read_fd = None
+        self.stopping = False
+
+        for stale_path in segmentPaths(path):
+            os.remove(stale_path)
+
+    # Returns the file descriptor for the child to write to. The caller closes
+    # it once the child has been started
+    def pipe(self):
+        self.read_fd, write_fd = os.pipe()
+        return write_fd
+
+    # Closes the pipe of a capture that was never started, e.g. because the
+    # child failed to start
+    def abort(self):
+        if not self.threads and self.read_fd is not None:
+            os.close(self.read_fd)
+            self.read_fd = None
+
+    def start(self):
+        self.threads = [threading.Thread(target=self.readLoop, daemon=True),
+                        threading.Thread(target=self.compressLoop, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def readLoop(self):
+        try:
+            while True:
+                # once the child has exited, stop when the pipe is drained even if
+                # a process it started still holds the write end
+                if not select.select([self.read_fd], [], [], poll_seconds)[0]:
+                    if self.stopping:
+                        break
+                    continue
+
+                data = os.read(self.read_fd, read_size)
+                if not data:
+                    break
+
+                self.total_bytes += len(data)
+                if self.scanner is not None:
+                    self.scanner.feed(data)
+                self.addToTail(data)
+
+                with self.backlog_ready:
+                    if self.backlog_bytes + len(data) > max_backlog:
+                        self.dropped_bytes += len(data)
+                        continue
+                    self.backlog.append(data)
+                    self.backlog_bytes += len(data)
+                    self.backlog_ready.notify()
+        finally:
+            os.close(self.read_fd)
+            with self.backlog_ready:
+                self.eof = True
+                self.backlog_ready.notify()
+
+    def addToTail(self, data):
+        self.tail.append(data)
+        self.tail_bytes += len(data)
+        while self.tail and self.tail_bytes - len(self.tail[0]) >= self.settings.tail_size:
+            self.tail_bytes -= len(self.tail.popleft())
+
+    def compressLoop(self):
+        segment = None
+        segment_bytes = 0
+        while True:
+            with self.backlog_ready:
+                while not self.backlog and not self.eof:
+                    self.backlog_ready.wait()
+                if not self.backlog:
+                    break
+                data = self.backlog.popleft()
+                self.backlog_bytes -= len(data)
+
+            if segment is None:
+                segment = self.openSegment()
+            segment.write(data)
+            segment_bytes += len(data)
+
+            if segment_bytes >= segment_size:
+                segment.close()
+                segment = None
+                segment_bytes = 0
+                self.removeOldSegments()
+
+        if segment is not None:
+            segment.close()
+            self.removeOldSegments()
+
+    def openSegment(self):
+        segment_path = segmentPath(self.path, len(self.segments))
+        self.segments.append(segment_path)
+        return gzip.open(segment_path, "wb", compresslevel=compress_level)
+
+    def removeOldSegments(self):
+        sizes = [(path, os.path.getsize(path)) for path in self.segments if os.path.exists(path)]
+        total_size = sum(size for _, size in sizes)
+        for path, size in sizes[:-1]:
+            if total_size <= self.settings.max_size:
+                break
+            logger.debug("Removing old log segment {}".format(path))
+            os.remove(path)
+            total_size -= size
+
+    # Called once the child has exited. Waits for the pipe to be drained and
+    # the backlog to be compressed, then writes the uncompressed tail
+    def close(self):
+        self.stopping = True
+        for thread in self.threads:
+            thread.join()
+
+        tail = b"".join(self.tail)[-self.settings.tail_size:]
+        with open(self.path, "wb") as f:
+            f.write(tail)
+
+        if self.dropped_bytes:
+            logger.warn("{} MB of {} could not be compressed in time and are only partly kept in {}".format(
+                self.dropped_bytes >> 20, os.path.basename(self.path), self.path))
+        if len(segmentPaths(self.path)) < len(self.segments):
+            logger.info("Removed the oldest segments of {} to stay under {} MB".format(
+                os.path.basename(self.path), self.settings.max_size >> 20))
+
+
+# Yields the contents of a captured log in blocks that end at line boundaries,
+# from its segments if it was captured with LogCapture, otherwise from the
+# plain file. Segments are split by size, so a line may continue in the next one
+def readBlocks(path):
+    segments = segmentPaths(path)
+    if not segments:
+        segments = [path]
+
+    partial = b""
+    for segment in segments:
+        opener = gzip.open if segment.endswith(".gz") else open
+        with opener(segment, "rb") as f:
+            while True:
+                data = f.read(read_size)
+                if not data:
+                    break
+
+                end = data.rfind(b"\n") + 1
+                if end == 0:
+                    partial += data
+                    continue
+
+                yield partial + data[:end]
+                partial = data[end:]
+
+    if partial:
+        yield partial
+
+
+def readLines(path):
+    for block in readBlocks(path):
+        yield from block.splitlines(keepends=True)
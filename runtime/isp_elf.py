@@ -0,0 +1,118 @@
+import os
+from struct import Struct
+
+elf_magic = b"\x7fELF"
+ident_t = Struct("16s")
+
+# ELF header after e_ident, and section header, by EI_CLASS (1 is 32 bit, 2 is 64 bit)
+header_formats = {1: "HHIIIIIHHHHHH", 2: "HHIQQQIHHHHHH"}
+section_formats = {1: "IIIIIIIIII", 2: "IIQQQQIIQQ"}
+elf_classes = {1: 32, 2: 64}
+byte_orders = {1: "<", 2: ">"}
+
+SHF_ALLOC = 0x2
+SHF_COMPRESSED = 0x800
+SHT_NOBITS = 8
+SHN_XINDEX = 0xffff
+
+machine_names = {
+    243: "EM_RISCV",
+}
+
+# The ElfInfo of each ELF read by this process, by cacheKey
+elf_infos = {}
+
+
+class ElfSection:
+    def __init__(self, name, type, flags, addr, offset, size):
+        self.name = name
+        self.type = type
+        self.flags = flags
+        self.addr = addr
+        self.offset = offset
+        self.size = size
+
+
+# What the runtime needs of an ELF file: its class, machine, entry point and
+# section table
+class ElfInfo:
+    def __init__(self, elfclass, machine, entry, sections):
+        self.elfclass = elfclass
+        self.machine = machine
+        self.entry = entry
+        self.sections = sections
+
+    def machineName(self):
+        return machine_names.get(self.machine, self.machine)
+
+
+def readSectionName(strtab, offset):
+    end = strtab.find(b"\0", offset)
+    return strtab[offset:end if end >= 0 else len(strtab)].decode(errors="replace")
+
+
+# Reads the header and section table of the ELF file at path, without reading
+# the rest of it. Raises ValueError if it is not an ELF file
+def readElf(path):
+    with open(path, "rb") as f:
+        ident = f.read(ident_t.size)
+        if len(ident) < ident_t.size or ident[:4] != elf_magic:
+            raise ValueError("{} is not an ELF file".format(path))
+        if ident[4] not in elf_classes or ident[5] not in byte_orders:
+            raise ValueError("{} has an unknown ELF class or byte order".format(path))
+
+        order = byte_orders[ident[5]]
+        header_t = Struct(order + header_formats[ident[4]])
+        section_t = Struct(order + section_formats[ident[4]])
+
+        header = f.read(header_t.size)
+        if len(header) < header_t.size:
+            raise ValueError("{} has a truncated ELF header".format(path))
+        (_, machine, _, entry, _, shoff, _, _, _, _,
+         shentsize, shnum, shstrndx) = header_t.unpack(header)
+
+        headers = []
+        if shoff:
+            f.seek(shoff)
+            first = f.read(section_t.size)
+            if len(first) < section_t.size:
+                raise ValueError("{} has a truncated section table".format(path))
+            first = section_t.unpack(first)
+            # with 0xff00 sections or more, the count and string table index
+            # are in the first section header
+            if shnum == 0:
+                shnum = first[5]
+            if shstrndx == SHN_XINDEX:
+                shstrndx = first[6]
+
+            f.seek(shoff)
+            table = f.read(shentsize * shnum)
+            if len(table) < shentsize * shnum:
+                raise ValueError("{} has a truncated section table".format(path))
+            headers = [section_t.unpack_from(table, i * shentsize) for i in range(shnum)]
+
+        strtab = b""
+        if shstrndx < len(headers):
+            f.seek(headers[shstrndx][4])
+            strtab = f.read(headers[shstrndx][5])
+
+    sections = [ElfSection(readSectionName(strtab, name), sh_type, flags, addr, offset, size)
+                for name, sh_type, flags, addr, offset, size, _, _, _, _ in headers]
+
+    return ElfInfo(elf_classes[ident[4]], machine, entry, sections)
+
+
+# The file identity the cached ElfInfo of path is valid for: a rebuilt or
+# replaced file changes at least one of these
+def cacheKey(path):
+    st = os.stat(path)
+    return (os.path.realpath(path), st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+# The ElfInfo of the ELF file at path, read once per process (and by the
+# processes it forks afterwards, e.g. isp_run_batch jobs)
+def elfInfo(path):
+    key = cacheKey(path)
+    if key not in elf_infos:
+        elf_infos[key] = readElf(path)
+    return elf_infos[key]
@@ -0,0 +1,256 @@
+import os
+import json
+import time
+import fcntl
+import yaml
+import logging
+import isp_utils
+import isp_cache
+import isp_report
+
+logger = logging.getLogger()
+
+# Locks of the boards, shared by every batch run on this host
+board_dir = os.path.join(isp_utils.getIspPrefix(), "boards")
+
+# Inventory board fields and their defaults. Fields without a default are required.
+# "type" is the simulator module of the jobs the board runs. "simulator" runs
+# them on another module instead (e.g. qemu), to stand in for a board.
+board_defaults = {
+    "name": None,
+    "type": None,
+    "simulator": None,
+    "pex_tty": None,
+    "ap_tty": None,
+    "openocd_cfg": None,
+    "openocd_port": None,
+    "host": None,
+    "extra": None,
+}
+
+# Simulator module options set from the board fields
+board_options = {
+    "pex_tty": "+pex-tty",
+    "ap_tty": "+ap-tty",
+    "openocd_cfg": "+openocd-cfg",
+    "openocd_port": "+openocd-port",
+    "host": "+iveia-host",
+}
+
+# How often boards held by other batches are checked for again
+poll_seconds = 5
+
+
+class Board:
+    def __init__(self, fields):
+        self.name = fields["name"]
+        self.type = fields["type"]
+        self.simulator = fields["simulator"] or fields["type"]
+        self.fields = fields
+
+        self.lock = None
+        self.busy_since = None
+        self.busy_seconds = 0
+        self.jobs = 0
+        self.failures = 0
+        self.reprograms = 0
+
+    def simulated(self):
+        return self.simulator != self.type
+
+    # Options passed to the simulator module to run a job on this board
+    def extra(self):
+        if self.simulated():
+            return []
+
+        extra = []
+        for field, option in board_options.items():
+            if self.fields[field] is not None:
+                extra += [option, str(self.fields[field])]
+        return extra + (self.fields["extra"] or [])
+
+    # The hash of the bitstream the board holds, if known. The simulator
+    # module decides whether to program the board and keeps what it holds
+    # (see heldBitstream in isp_vcu118), so that is asked instead of tracked
+    def bitstream(self):
+        if self.simulated():
+            return None
+
+        sim_module = __import__("isp_" + self.type)
+        if not hasattr(sim_module, "heldBitstream"):
+            return None
+
+        return sim_module.heldBitstream(self.fields["pex_tty"])
+
+    # Takes the board's lock without waiting, so that no other batch on this
+    # host runs a job on it. Returns whether it was taken
+    def acquire(self):
+        isp_utils.doMkDir(board_dir)
+        lock = open(os.path.join(board_dir, self.name + ".lock"), "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            return False
+
+        self.lock = lock
+        self.busy_since = time.time()
+        return True
+
+    def release(self, succeeded):
+        self.busy_seconds += time.time() - self.busy_since
+        self.busy_since = None
+        self.jobs += 1
+        if not succeeded:
+            self.failures += 1
+
+        fcntl.flock(self.lock, fcntl.LOCK_UN)
+        self.lock.close()
+        self.lock = None
+
+    def busy(self):
+        return self.lock is not None
+
+    def utilization(self, wall_time):
+        return {
+            "name": self.name,
+            "type": self.type,
+            "simulator": self.simulator,
+            "jobs": self.jobs,
+            "failures": self.failures,
+            "reprograms": self.reprograms,
+            "busy_time": round(self.busy_seconds, 3),
+            "utilization": round(self.busy_seconds / wall_time, 3) if wall_time > 0 else None,
+        }
+
+
+def makeBoard(entry):
+    fields = dict(board_defaults)
+    fields.update(entry)
+
+    unknown = [k for k in fields if k not in board_defaults]
+    if unknown:
+        logger.error("Unknown inventory board field(s): {}".format(", ".join(unknown)))
+        return None
+
+    if not fields["name"] or not fields["type"]:
+        logger.error("Inventory board {} is missing name or type".format(entry))
+        return None
+
+    if isinstance(fields["extra"], str):
+        fields["extra"] = [fields["extra"]]
+
+    return Board(fields)
+
+
+# The inventory is a YAML file with a "boards" list, each board with the
+# fields in board_defaults
+def loadInventory(inventory_path):
+    with open(inventory_path, "r") as f:
+        inventory = yaml.load(f, Loader=yaml.FullLoader)
+
+    boards = []
+    for entry in (inventory or {}).get("boards", []):
+        board = makeBoard(entry)
+        if board is None:
+            return None
+        if board.name in [b.name for b in boards]:
+            logger.error("Inventory board name {} is used more than once".format(board.name))
+            return None
+        boards.append(board)
+
+    return boards
+
+
+# Whether the run report in run_dir records that the board was programmed
+def reportedProgramming(run_dir):
+    if run_dir is None:
+        return False
+
+    try:
+        with open(os.path.join(run_dir, isp_report.report_file), "r") as f:
+            report = json.load(f)
+    except (IOError, ValueError):
+        return False
+
+    return bool((report.get("bitstream") or {}).get("programmed"))
+
+
+# Hands out the boards of an inventory to the jobs that need them
+class Farm:
+    def __init__(self, boards):
+        self.boards = boards
+        self.types = set(board.type for board in boards)
+        self.bitstream_hashes = {}
+
+    def serves(self, job):
+        return job["simulator"] in self.types
+
+    def bitstreamHash(self, path):
+        if path not in self.bitstream_hashes:
+            self.bitstream_hashes[path] = isp_cache.hashFile(path).hexdigest()
+        return self.bitstream_hashes[path]
+
+    # Whether job needs a board holding bitstream_hash to be programmed with
+    # another bitstream
+    def needsProgramming(self, job, bitstream_hash):
+        if not job["bitstream"]:
+            return False
+        return bitstream_hash != self.bitstreamHash(job["bitstream"])
+
+    # Pairs each free board with a pending job it can run, preferring jobs that
+    # do not need it reprogrammed, and takes the board. Returns the (job,
+    # board) pairs and whether a board was held by another batch
+    def assign(self, pending):
+        assigned = []
+        blocked = False
+        pending = [job for job in pending if self.serves(job)]
+
+        for board in self.boards:
+            if board.busy():
+                continue
+
+            candidates = [job for job in pending if job["simulator"] == board.type]
+            if not candidates:
+                continue
+
+            if not board.acquire():
+                logger.debug("Board {} is in use by another batch".format(board.name))
+                blocked = True
+                continue
+
+            bitstream_hash = board.bitstream()
+            candidates.sort(key=lambda job: self.needsProgramming(job, bitstream_hash))
+            job = candidates[0]
+            pending.remove(job)
+            assigned.append((job, board))
+
+        return assigned, blocked
+
+    # The job's arguments for running on board
+    def boardJob(self, job, board):
+        job = dict(job, board=board.name, simulator=board.simulator)
+        extra = list(job["extra"] or []) + board.extra()
+
+        # the module checks the bitstream the board holds itself, which also
+        # covers runs outside the farm
+        if job["bitstream"] and not board.simulated():
+            extra += ["+bitstream", job["bitstream"]]
+
+        # the PEX binary prepared for the board's type does not fit the module
+        # standing in for it, which builds its own
+        if board.simulated():
+            job["pex_path"] = None
+
+        job["extra"] = extra or None
+        return job
+
+    # Releases board once job finished with result (an isp_run_batch result),
+    # counting a reprogram if its run report says the module programmed it
+    def finish(self, job, board, result):
+        if reportedProgramming(result["run_dir"]):
+            board.reprograms += 1
+        board.release(result["result"] == isp_utils.retVals.SUCCESS)
+
+    def utilization(self, wall_time):
+        return [board.utilization(wall_time) for board in self.boards]
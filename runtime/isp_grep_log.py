@@ -0,0 +1,80 @@
+#! /usr/bin/python3
+
+import re
+import sys
+import argparse
+import isp_capture
+
+
+def grepLog(path, pattern, count_only=False, line_numbers=False):
+    count = 0
+    number = 0
+    for block in isp_capture.readBlocks(path):
+        # most blocks of a large log do not match at all
+        if not pattern.search(block):
+            number += block.count(b"\n")
+            continue
+
+        lines = block.split(b"\n")
+        if not lines[-1]:
+            lines.pop()
+
+        for line in lines:
+            number += 1
+            if not pattern.search(line):
+                continue
+
+            count += 1
+            if count_only:
+                continue
+
+            text = line.decode(errors="replace")
+            if line_numbers:
+                text = "{}:{}".format(number, text)
+            print(text)
+
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='''
+    Search logs captured by isp_run_app --compress-logs across all of their
+    compressed segments. Plain logs are searched as they are
+    ''')
+    parser.add_argument("pattern", type=str, help='''
+    Regular expression to search for
+    ''')
+    parser.add_argument("logs", nargs="+", help='''
+    Path of each log as it would be without compression, e.g. isp-run-<...>/pex.log
+    ''')
+    parser.add_argument("-F", "--fixed-strings", action="store_true", help='''
+    Treat the pattern as a plain string
+    ''')
+    parser.add_argument("-i", "--ignore-case", action="store_true", help='''
+    Ignore case when matching
+    ''')
+    parser.add_argument("-c", "--count", action="store_true", help='''
+    Only print the number of matching lines
+    ''')
+    parser.add_argument("-n", "--line-number", action="store_true", help='''
+    Prefix each matching line with its line number in the log
+    ''')
+
+    args = parser.parse_args()
+
+    pattern = re.escape(args.pattern) if args.fixed_strings else args.pattern
+    flags = re.IGNORECASE if args.ignore_case else 0
+    regex = re.compile(pattern.encode(), flags)
+
+    total = 0
+    for path in args.logs:
+        count = grepLog(path, regex, args.count, args.line_number)
+        if args.count:
+            print("{}:{}".format(path, count) if len(args.logs) > 1 else count)
+        total += count
+
+    sys.exit(0 if total else 1)
+
+
+if __name__ == "__main__":
+    main()
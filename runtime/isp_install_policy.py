@@ -12,6 +12,7 @@ import multiprocessing
 import argparse
 import sys
 import isp_utils
+import isp_cache
 import yaml
 import logging
 
@@ -64,6 +65,21 @@ def generateCompositeEntities(policies, entities_dir, output, module):
     output_stream.close()
 
 
+# policy-tool is given the whole of policies_dir (-m), so all of it is hashed
+# but for the entities, of which those of the composed policies are hashed
+def policyCacheKey(module, policies, policies_dir, entities_dir, debug):
+    entities_hashes = []
+    for policy in policies:
+        entities_path = os.path.join(entities_dir, ".".join([module, policy, "entities", "yml"]))
+        if os.path.isfile(entities_path):
+            entities_hashes.append(isp_cache.hashFile(entities_path).hexdigest())
+
+    return isp_cache.hashKey(module, policies, debug,
+                             isp_cache.hashTree(policies_dir, exclude=[entities_dir]),
+                             entities_hashes,
+                             isp_cache.toolId("policy-tool"))
+
+
 def main():
     parser = argparse.ArgumentParser(description="Build and install policies and PEX binaries")
     parser.add_argument("-p", "--policies", nargs='+', required=True, help='''
@@ -107,6 +123,9 @@ def main():
     parser.add_argument("-m", "--module", type=str, default="osv", help='''
     Module name. Default "osv".
     ''')
+    parser.add_argument("--no-cache", action="store_true", help='''
+    Always run the policy tool rather than using a cached policy from $ISP_PREFIX/cache
+    ''')
 
     args = parser.parse_args()
 
@@ -135,18 +154,32 @@ def main():
         if args.global_policies:
             policies += args.global_policies
 
-        if runPolicyTool(args.module, policies, policies_dir, entities_dir,
-                         policy_out_dir, args.policy_debug) is False:
-            logger.error('''
-                         Policy tool failed to run to completion.
-                         See {}/policy_tool.log for more info
-                         '''.format(policy_out_dir))
-            sys.exit(1)
-
-        entity_output_path = os.path.join(policy_out_dir,
-                                          ".".join(["composite_entities", "yml"]))
-        logger.info("Generating composite policy entity file at {}".format(entity_output_path))
-        generateCompositeEntities(policies, entities_dir, entity_output_path, args.module)
+        policy_cache = isp_cache.ArtifactCache("policies", 1024)
+        if args.no_cache:
+            policy_cache.enabled = False
+
+        cache_key = ""
+        if policy_cache.enabled:
+            cache_key = policyCacheKey(args.module, policies, policies_dir,
+                                       entities_dir, args.policy_debug)
+
+        if policy_cache.fetch(cache_key, policy_out_dir):
+            logger.info("Using cached policy {}".format(policy_name))
+        else:
+            if runPolicyTool(args.module, policies, policies_dir, entities_dir,
+                             policy_out_dir, args.policy_debug) is False:
+                logger.error('''
+                             Policy tool failed to run to completion.
+                             See {}/policy_tool.log for more info
+                             '''.format(policy_out_dir))
+                sys.exit(1)
+
+            entity_output_path = os.path.join(policy_out_dir,
+                                              ".".join(["composite_entities", "yml"]))
+            logger.info("Generating composite policy entity file at {}".format(entity_output_path))
+            generateCompositeEntities(policies, entities_dir, entity_output_path, args.module)
+
+            policy_cache.publish(cache_key, policy_out_dir)
 
     logger.debug("Policy directory is {}".format(policy_out_dir))
 
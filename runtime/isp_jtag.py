@@ -0,0 +1,411 @@
+#! /usr/bin/python3
+
+import os
+import re
+import sys
+import time
+import queue
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+import multiprocessing.connection
+
+import isp_utils
+
+logger = logging.getLogger()
+
+default_port = 3333
+
+# Seconds a daemon without clients waits for one before exiting
+default_idle_seconds = 600
+
+# Seconds for a gdb command to complete, and for loading an executable
+command_seconds = 10
+load_seconds = 600
+
+# Seconds for a new daemon to serve, and for openocd to serve gdb
+start_seconds = 30
+
+retry_seconds = 0.05
+
+# The value written to the soft reset register, as -data-write-memory-bytes
+# contents (a little-endian 32 bit 1)
+reset_value = "01000000"
+
+mi_contents_re = re.compile(r'contents="([0-9a-fA-F]*)"')
+mi_msg_re = re.compile(r'msg="((?:[^"\\]|\\.)*)"')
+
+
+class GdbError(Exception):
+    pass
+
+
+def openocdCommand(openocd_path, cfg_path, port=default_port):
+    # the ports are set before the configuration, which may initialize openocd
+    args = [openocd_path]
+    if port != default_port:
+        args += ["-c", "gdb_port {}".format(port),
+                 "-c", "telnet_port disabled",
+                 "-c", "tcl_port disabled"]
+    return args + ["-f", cfg_path]
+
+
+# The socket of the daemon of a board. It lives in the system temp dir since
+# unix socket paths must stay short
+def socketPath(board):
+    socket_dir = os.path.join(tempfile.gettempdir(), "isp-jtag-{}".format(os.getuid()))
+    os.makedirs(socket_dir, mode=0o700, exist_ok=True)
+    return os.path.join(socket_dir, board + ".sock")
+
+
+# A gdb driven through its machine interface (MI), with its output read by a
+# thread so that every command can time out
+class GdbMI:
+    def __init__(self, gdb_path, log):
+        self.log = log
+        self.token = 0
+        self.running = False
+        self.lines = queue.Queue()
+        self.proc = subprocess.Popen([gdb_path, "--interpreter=mi2", "-q", "-nx"],
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                     universal_newlines=True, bufsize=1)
+        threading.Thread(target=self.readLines, daemon=True).start()
+
+    def readLines(self):
+        for line in self.proc.stdout:
+            self.lines.put(line.rstrip("\n"))
+        self.lines.put(None)
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def handleLine(self, line):
+        self.log.write(line + "\n")
+        if line.startswith("*running"):
+            self.running = True
+        elif line.startswith("*stopped"):
+            self.running = False
+
+    def nextLine(self, deadline):
+        try:
+            line = self.lines.get(timeout=max(0, deadline - time.time()))
+        except queue.Empty:
+            raise GdbError("gdb did not respond in time")
+
+        if line is None:
+            self.lines.put(None)
+            raise GdbError("gdb exited")
+
+        self.handleLine(line)
+        return line
+
+    # Handles the output gdb printed since the last command, e.g. the
+    # application stopping
+    def drain(self):
+        while True:
+            try:
+                line = self.lines.get_nowait()
+            except queue.Empty:
+                return
+            if line is None:
+                self.lines.put(None)
+                return
+            self.handleLine(line)
+
+    # Runs an MI command and returns its result record. Raises GdbError if it
+    # fails or does not complete within timeout seconds
+    def command(self, command, timeout=command_seconds):
+        self.token += 1
+        token = str(self.token)
+        self.log.write(token + command + "\n")
+        self.log.flush()
+        self.proc.stdin.write(token + command + "\n")
+
+        deadline = time.time() + timeout
+        while True:
+            line = self.nextLine(deadline)
+            if not line.startswith(token + "^"):
+                continue
+
+            result_class, _, results = line[len(token) + 1:].partition(",")
+            if result_class == "error":
+                msg = mi_msg_re.search(results)
+                raise GdbError("{} failed: {}".format(command, msg.group(1) if msg else results))
+            return results
+
+    def waitStopped(self, timeout=command_seconds):
+        deadline = time.time() + timeout
+        while self.running:
+            self.nextLine(deadline)
+
+    def close(self):
+        if self.alive():
+            try:
+                self.command("-gdb-exit", timeout=1)
+            except GdbError:
+                pass
+        if self.alive():
+            self.proc.kill()
+        self.proc.wait()
+
+
+# openocd and the gdb connected to it, kept running between runs on a board
+class JtagSession:
+    def __init__(self, openocd_command, port, gdb_path, log_prefix):
+        self.openocd_command = openocd_command
+        self.port = port
+        self.gdb_path = gdb_path
+
+        self.openocd_log = open(log_prefix + ".openocd.log", "a")
+        self.gdb_log = open(log_prefix + ".gdb.log", "a")
+        self.openocd = None
+        self.gdb = None
+
+    def alive(self):
+        return (self.openocd is not None and self.openocd.poll() is None and
+                self.gdb is not None and self.gdb.alive())
+
+    def connect(self, timeout=start_seconds):
+        deadline = time.time() + timeout
+        while True:
+            try:
+                self.gdb.command("-target-select remote :{}".format(self.port))
+                return
+            except GdbError:
+                if time.time() > deadline or self.openocd.poll() is not None:
+                    raise
+                time.sleep(retry_seconds)
+
+    def reconnect(self, timeout=start_seconds):
+        try:
+            self.gdb.command("-target-disconnect")
+        except GdbError:
+            pass
+        self.connect(timeout)
+
+    # (Re)starts openocd and gdb unless both are still running
+    def ensure(self):
+        if self.alive():
+            return
+
+        self.stop()
+        logger.info("Starting {}".format(" ".join(self.openocd_command)))
+        self.openocd = subprocess.Popen(self.openocd_command, stdout=self.openocd_log, stderr=subprocess.STDOUT)
+        self.gdb = GdbMI(self.gdb_path, self.gdb_log)
+        self.gdb.command("-gdb-set mi-async on")
+        self.gdb.command("-gdb-set confirm off")
+        self.connect()
+
+    def halt(self):
+        self.gdb.drain()
+        if self.gdb.running:
+            self.gdb.command("-exec-interrupt")
+            self.gdb.waitStopped()
+
+    # Writes the soft reset register and reads it back, since the read only
+    # completes once the write has gone through. The target is then
+    # reconnected to, as the reset invalidates what gdb knows about it
+    def reset(self, address):
+        self.ensure()
+        self.halt()
+        self.gdb.command("-data-write-memory-bytes {} {}".format(address, reset_value))
+
+        deadline = time.time() + command_seconds
+        while True:
+            try:
+                results = self.gdb.command("-data-read-memory-bytes {} 4".format(address))
+                break
+            except GdbError:
+                if time.time() > deadline:
+                    raise
+                self.reconnect(deadline - time.time())
+
+        contents = mi_contents_re.search(results)
+        logger.info("Reset register {} reads back {}".format(address, contents.group(1) if contents else results))
+
+        self.reconnect()
+
+    def load(self, exe_path):
+        self.ensure()
+        self.halt()
+        self.gdb.command("-file-exec-and-symbols {}".format(exe_path))
+        self.gdb.command("-target-download", timeout=load_seconds)
+
+    def cont(self):
+        if not self.alive():
+            raise GdbError("openocd or gdb exited")
+        self.gdb.command("-exec-continue")
+
+    def stop(self):
+        if self.gdb is not None:
+            self.gdb.close()
+            self.gdb = None
+        if self.openocd is not None:
+            self.openocd.terminate()
+            self.openocd.wait()
+            self.openocd = None
+
+
+# Serves the requests of one client at a time (the run on the board) on
+# socket_path, and exits once it had no client for idle_seconds
+def serve(socket_path, session, idle_seconds=default_idle_seconds):
+    isp_utils.removeIfExists(socket_path)
+    listener = multiprocessing.connection.Listener(socket_path, "AF_UNIX")
+    state = {"clients": 0, "last_client": time.time()}
+
+    def watchIdle():
+        while True:
+            time.sleep(1)
+            if state["clients"] == 0 and time.time() - state["last_client"] > idle_seconds:
+                logger.info("No client for {} s, exiting".format(idle_seconds))
+                session.stop()
+                isp_utils.removeIfExists(socket_path)
+                os._exit(0)
+
+    threading.Thread(target=watchIdle, daemon=True).start()
+
+    methods = {
+        "ping": lambda: session.openocd_command,
+        "reset": session.reset,
+        "load": session.load,
+        "cont": session.cont,
+        "halt": session.halt,
+    }
+
+    while True:
+        conn = listener.accept()
+        state["clients"] += 1
+        try:
+            while True:
+                try:
+                    method, args = conn.recv()
+                except EOFError:
+                    break
+
+                if method == "shutdown":
+                    session.stop()
+                    listener.close()
+                    isp_utils.removeIfExists(socket_path)
+                    conn.send((True, None))
+                    return
+
+                start = time.perf_counter()
+                try:
+                    conn.send((True, methods[method](*args)))
+                except (GdbError, OSError) as e:
+                    logger.error("{} failed: {}".format(method, e))
+                    conn.send((False, str(e)))
+                logger.info("{}{} took {:.3f} s".format(method, tuple(args), time.perf_counter() - start))
+        finally:
+            conn.close()
+            state["clients"] -= 1
+            state["last_client"] = time.time()
+
+
+# A connection to the daemon of a board
+class JtagClient:
+    def __init__(self, conn, socket_path):
+        self.conn = conn
+        self.socket_path = socket_path
+
+    def call(self, method, *args):
+        try:
+            self.conn.send((method, args))
+            ok, value = self.conn.recv()
+        except (EOFError, OSError) as e:
+            logger.error("Lost the connection to the debug daemon at {}: {}".format(self.socket_path, e))
+            return False, None
+
+        if not ok:
+            logger.error("Debug daemon {} failed: {}".format(method, value))
+        return ok, value
+
+    def reset(self, address):
+        return self.call("reset", address)[0]
+
+    def load(self, exe_path):
+        return self.call("load", exe_path)[0]
+
+    def cont(self):
+        return self.call("cont")[0]
+
+    def close(self):
+        self.conn.close()
+
+
+def connect(socket_path):
+    try:
+        return JtagClient(multiprocessing.connection.Client(socket_path, "AF_UNIX"), socket_path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        return None
+
+
+# Stops the daemon at socket_path, if one is running, e.g. to free the JTAG
+# adapter for other tools
+def stop(socket_path):
+    client = connect(socket_path)
+    if client is None:
+        return
+
+    logger.info("Stopping the debug daemon at {}".format(socket_path))
+    client.call("shutdown")
+    client.close()
+
+
+# Connects to the daemon at socket_path, first starting one if none runs with
+# the same openocd command. Returns None if it does not start
+def session(socket_path, openocd_command, port, gdb_path, log_prefix, idle_seconds=default_idle_seconds):
+    client = connect(socket_path)
+    if client is not None:
+        ok, command = client.call("ping")
+        if ok and command == openocd_command:
+            return client
+
+        logger.info("Restarting the debug daemon at {} for {}".format(socket_path, " ".join(openocd_command)))
+        client.call("shutdown")
+        client.close()
+
+    logger.info("Starting a debug daemon at {}, logging to {}.log".format(socket_path, log_prefix))
+    args = [sys.executable, os.path.abspath(__file__), socket_path, gdb_path,
+            "--port", str(port), "--log-prefix", log_prefix, "--idle-timeout", str(idle_seconds), "--"] + openocd_command
+    with open(log_prefix + ".log", "a") as daemon_log:
+        subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=daemon_log, stderr=subprocess.STDOUT,
+                         start_new_session=True)
+
+    deadline = time.time() + start_seconds
+    while time.time() < deadline:
+        client = connect(socket_path)
+        if client is not None:
+            return client
+        time.sleep(retry_seconds)
+
+    logger.error("Debug daemon at {} did not start, see {}.log".format(socket_path, log_prefix))
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keep openocd and gdb running for the runs on a board")
+    parser.add_argument("socket", type=str, help="Unix socket to serve requests on")
+    parser.add_argument("gdb", type=str, help="gdb executable")
+    parser.add_argument("openocd", nargs="+", help="openocd command")
+    parser.add_argument("--port", type=int, default=default_port, help='''
+    Port openocd serves gdb on
+    ''')
+    parser.add_argument("--log-prefix", type=str, required=True, help='''
+    Prefix of the daemon, openocd and gdb logs
+    ''')
+    parser.add_argument("--idle-timeout", type=int, default=default_idle_seconds, help='''
+    Seconds without a client after which the daemon exits
+    ''')
+
+    args = parser.parse_args()
+    isp_utils.setupLogger(logging.INFO, False)
+
+    session = JtagSession(args.openocd, args.port, args.gdb, args.log_prefix)
+    serve(args.socket, session, args.idle_timeout)
+
+
+if __name__ == "__main__":
+    main()
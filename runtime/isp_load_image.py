@@ -7,11 +7,14 @@ from struct import Struct
 import logging
 import os
 import zlib
+import mmap
+import hashlib
+import contextlib
+import binascii
+from array import array
 from pathlib import Path
-from itertools import zip_longest
 
-from elftools.elf.elffile import ELFFile
-from elftools.elf.constants import SH_FLAGS
+import isp_elf
 
 logger = logging.getLogger()
 
@@ -27,96 +30,142 @@ def align(v):
     return (v + 3) & ~3
 
 
-class SectionElision:
-    def __init__(self, section):
-        self.write_segment = False
-        sz = section["sh_size"]
-        self.segment_size = align(sz)
-        self.front_pad = 0
-        self.pad = self.segment_size - sz
-        self.end = section["sh_addr"] + self.segment_size
-
-    def extend(self, start, elided):
-        front_padding = start - self.end
-        elided.front_pad = front_padding
-        self.segment_size += elided.segment_size + front_padding
-        self.end += elided.segment_size + front_padding
-
-
 def auto_int(x):
     return int(x, 0)
 
 
-def unique_section_name(s):
-    return f"{s['sh_name']}{s['sh_addr']}"
-
 def include_section(s):
-    return ((s['sh_flags'] & SH_FLAGS.SHF_ALLOC) != 0) and (s['sh_type'] != 'SHT_NOBITS') and (s['sh_size'] != 0)
+    return ((s.flags & isp_elf.SHF_ALLOC) != 0) and (s.type != isp_elf.SHT_NOBITS) and (s.size != 0)
+
+
+# The uncompressed contents of a compressed section. These are rare enough
+# that pyelftools is only loaded for them
+def compressed_section_data(f, s):
+    from elftools.elf.elffile import ELFFile
+    return ELFFile(f).get_section_by_name(s.name).data()
+
+
+# Layout of a load image computed in one pass over the ELF section table:
+# segments is the (address, size) segment table, and copies lists, in output
+# order, the (front padding, file offset, size, back padding) of each section
+# payload. Sections within 16 bytes of the previous one are merged into its
+# segment, with the gap written as front padding.
+class LoadImagePlan:
+    def __init__(self, entry_point):
+        self.entry_point = entry_point
+        self.segments = []
+        self.copies = []
+        self.segment_end = None
+
+    def add_section(self, s):
+        addr = s.addr
+        size = s.size
+        segment_size = align(size)
+        front_pad = 0
+
+        if self.segments and addr - self.segment_end <= 16:
+            front_pad = addr - self.segment_end
+            last_addr, last_size = self.segments[-1]
+            self.segments[-1] = (last_addr, last_size + segment_size + front_pad)
+            self.segment_end += segment_size + front_pad
+        else:
+            self.segments.append((addr, segment_size))
+            self.segment_end = addr + segment_size
+
+        self.copies.append((front_pad, s, size, segment_size - size))
+
+    def payload_size(self):
+        return sum(max(front_pad, 0) + size + pad for front_pad, _, size, pad in self.copies)
+
+
+def plan_load_image(elf_info):
+    plan = LoadImagePlan(elf_info.entry)
+    for s in sorted(elf_info.sections, key=lambda s: s.addr):
+        if include_section(s):
+            logger.debug("section {0} at 0x{1:x}, for 0x{2:x} bytes".format(s.name, s.addr, s.size))
+            plan.add_section(s)
+
+    return plan
+
+
+# Writes all of data to out, a raw unbuffered file, whose write() may write
+# only part of it (e.g. when the disk is nearly full)
+def write_all(out, data):
+    view = memoryview(data)
+    while view:
+        written = out.write(view)
+        if not written:
+            raise IOError("Failed to write {} bytes to {}".format(len(view), out.name))
+        view = view[written:]
+
+
+# Copy count bytes at offset in src to the current position of dst (both raw
+# unbuffered files) without passing the data through Python where possible
+def copy_range(src, dst, offset, count):
+    src_fd = src.fileno()
+    dst_fd = dst.fileno()
+
+    while count > 0:
+        copied = 0
+        try:
+            if hasattr(os, "copy_file_range"):
+                copied = os.copy_file_range(src_fd, dst_fd, count, offset)
+            else:
+                copied = os.sendfile(dst_fd, src_fd, offset, count)
+        except OSError:
+            pass
+
+        if copied <= 0:
+            chunk = os.pread(src_fd, min(count, 1 << 20), offset)
+            if not chunk:
+                raise IOError("Unexpected end of file copying {} bytes at offset {}".format(count, offset))
+            write_all(dst, chunk)
+            copied = len(chunk)
+
+        offset += copied
+        count -= copied
+
+
+def write_padding(out, length):
+    if length > 0:
+        write_all(out, bytes(length))
 
 
 def generate_load_image(elf_binary, output_image, tag_info=None):
-    with open(output_image, 'wb') as out:
-        with open(elf_binary, 'rb') as f:
-            ef = ELFFile(f)
-            logger.debug("entry point at 0x{0:x}".format(ef.header["e_entry"]))
-            entry_point = ef.header["e_entry"]
-            out.write(load_image_t.pack(0xD04EA001, entry_point, 0, 0, 0))
-
-            open_segment = None
-            elision = None
-            elision_dict = {}
-            for s in sorted(ef.iter_sections(), key=lambda s: s["sh_addr"]):
-                if include_section(s):
-                    logger.debug("section {0} at 0x{1:x}, for 0x{2:x} bytes".format(s.name, s["sh_addr"], s["sh_size"]))
-                    elision = SectionElision(s)
-                    elision_dict[unique_section_name(s)] = elision
-                    if open_segment is None:
-                        open_segment = elision
-                        open_segment.write_segment = True
-                    else:
-                        if s["sh_addr"] - open_segment.end > 16:
-                            open_segment = elision
-                            open_segment.write_segment = True
-                        else:
-                            open_segment.extend(s["sh_addr"], elision)
-
-            segment_count = 0
-            for s in sorted(ef.iter_sections(), key=lambda s: s["sh_addr"]):
-                if include_section(s):
-                    elision = elision_dict[unique_section_name(s)]
-                    if elision.write_segment:
-                        logger.debug("segment at 0x{0:x}, for 0x{1:x} bytes".format(s["sh_addr"], elision.segment_size))
-                        out.write(load_segment_t.pack(s["sh_addr"], elision.segment_size))
-                        segment_count = segment_count + 1
-            for s in sorted(ef.iter_sections(), key=lambda s: s["sh_addr"]):
-                if include_section(s):
-                    elision = elision_dict[unique_section_name(s)]
-                    size = s["sh_size"]
-                    if elision.front_pad > 0:
-                        pad = bytearray(elision.front_pad)
-                        out.write(pad)
-                    out.write(s.data())
-                    if elision.pad != 0:
-                        pad = bytearray(elision.pad)
-                        out.write(pad)
-
-        taginfo_bytes = []
-        taginfo_offset = 0;
-
-        if (tag_info):
-            taginfo_offset = out.tell()
-            taginfo_bytes = Path(tag_info).read_bytes()
-            out.write(taginfo_bytes)
-            if (len(taginfo_bytes) & 3 != 0):
-                pad = bytearray(4 - (len(taginfo_bytes) & 3))
-                out.write(pad)
-
-        out.seek(0)
-        out.write(load_image_t.pack(0xD04EA001,
-                                    entry_point,
-                                    segment_count,
-                                    taginfo_offset,
-                                    len(taginfo_bytes)))
+    with open(output_image, 'wb', buffering=0) as out:
+        with open(elf_binary, 'rb', buffering=0) as f:
+            plan = plan_load_image(isp_elf.elfInfo(elf_binary))
+            logger.debug("entry point at 0x{0:x}".format(plan.entry_point))
+
+            taginfo_size = 0
+            taginfo_offset = 0
+            if tag_info:
+                taginfo_size = os.path.getsize(tag_info)
+                taginfo_offset = (load_image_t.size + load_segment_t.size * len(plan.segments) +
+                                  plan.payload_size())
+
+            write_all(out, load_image_t.pack(0xD04EA001,
+                                             plan.entry_point,
+                                             len(plan.segments),
+                                             taginfo_offset,
+                                             taginfo_size))
+
+            for addr, size in plan.segments:
+                logger.debug("segment at 0x{0:x}, for 0x{1:x} bytes".format(addr, size))
+            write_all(out, b"".join(load_segment_t.pack(addr, size) for addr, size in plan.segments))
+
+            for front_pad, s, size, pad in plan.copies:
+                write_padding(out, front_pad)
+                if s.flags & isp_elf.SHF_COMPRESSED:
+                    write_all(out, compressed_section_data(f, s))
+                else:
+                    copy_range(f, out, s.offset, size)
+                write_padding(out, pad)
+
+        if tag_info:
+            with open(tag_info, 'rb', buffering=0) as tags:
+                copy_range(tags, out, 0, taginfo_size)
+            write_padding(out, align(taginfo_size) - taginfo_size)
 
 def generate_tag_load_image(output_image, tag_info):
     with open(output_image, 'wb') as out:
@@ -141,63 +190,625 @@ def generate_tag_load_image(output_image, tag_info):
                                     len(taginfo_bytes)))
 
 
+# bytes of an input image mapped at a time by generate_flash_init, which bounds
+# its memory use regardless of the image size
+flash_map_size = 8 << 20
+
+
+def flash_address(addr):
+    if isinstance(addr, int):
+        return addr
+    return int(addr, 16)
+
+
+# Copies the first size bytes of the open file f to out, one mapped window at a
+# time, and returns their CRC32 followed by pad zero bytes, starting from crc
+def crc_and_copy(f, size, pad, crc, out):
+    for offset in range(0, size, flash_map_size):
+        length = min(flash_map_size, size - offset)
+        with mmap.mmap(f.fileno(), length, access=mmap.ACCESS_READ, offset=offset) as window:
+            with memoryview(window) as data:
+                crc = zlib.crc32(data, crc)
+                write_all(out, data)
+
+    return zlib.crc32(bytes(pad), crc)
+
+
+# Writes a flash init holding each (address, image file) pair of input_images,
+# a dict or a sequence of pairs with addresses as ints or hex strings. Each
+# image is preceded by a flash_address_t header with its size padded to 4 bytes
+# and the CRC32 of the header (with a zero CRC) and the padded payload. The
+# headers alone are also written to <output_image>.hdr.
 def generate_flash_init(output_image, input_images):
-    out = open(output_image, 'wb')
-    hdr = open(output_image + '.hdr', 'wb')
-    pairs = [(int(addr, 16), name) for addr, name in input_images.items()]
-    for p in pairs:
-        fh = open(p[1], 'rb')
-        rom_data = fh.read()
-        fh.close()
-        
-        # pad the payload, otherwise we'll get CRC failures when we load it
-        pad_len = 4 - (len(rom_data) % 4);
-        if pad_len != 4:
-            rom_data += '\0'*pad_len
-            
-        rom_bytes = bytearray(rom_data)
-        
-        crc = zlib.crc32(flash_address_t.pack(p[0], len(rom_bytes), 0))
-        crc = zlib.crc32(rom_data, crc) & 0xffffffff
-        hdr.write(flash_address_t.pack(p[0], len(rom_bytes), crc))
-        out.write(flash_address_t.pack(p[0], len(rom_bytes), crc))
-        out.write(rom_bytes)
-    # indicate end of stream
-    hdr.write(flash_address_t.pack(0xffffffff, 0, 0))
-    hdr.close()
-    out.write(flash_address_t.pack(0xffffffff, 0, 0))
-    out.close()
-
-
-def group_hex_chunks(iterable, n, fillvalue=None):
-    args = [iter(iterable)] * n
-    return zip_longest(*args, fillvalue=fillvalue)
+    if hasattr(input_images, "items"):
+        input_images = input_images.items()
+
+    with open(output_image, 'wb', buffering=0) as out, open(output_image + '.hdr', 'wb') as hdr:
+        for addr, name in input_images:
+            address = flash_address(addr)
+            with open(name, 'rb', buffering=0) as f:
+                size = os.fstat(f.fileno()).st_size
+
+                # pad the payload, otherwise we'll get CRC failures when we load it
+                padded_size = align(size)
+                pad = padded_size - size
+
+                # the payload is copied as its CRC is computed, and the header
+                # that precedes it filled in afterwards
+                header_offset = out.tell()
+                write_padding(out, flash_address_t.size)
+
+                crc = zlib.crc32(flash_address_t.pack(address, padded_size, 0))
+                crc = crc_and_copy(f, size, pad, crc, out) & 0xffffffff
+                write_padding(out, pad)
+
+                header = flash_address_t.pack(address, padded_size, crc)
+                if os.pwrite(out.fileno(), header, header_offset) != len(header):
+                    raise IOError("Failed to write the flash header at offset {} of {}".format(header_offset, output_image))
+                hdr.write(header)
+
+        # indicate end of stream
+        end = flash_address_t.pack(0xffffffff, 0, 0)
+        hdr.write(end)
+        write_all(out, end)
+
+
+# array typecodes whose byteswap() reverses a whole row of the given byte width
+row_typecodes = {array(t).itemsize: t for t in "BHIQ"}
+
+# rows per block in generate_hex_dump
+hex_dump_block_rows = 1 << 16
+
+
+# Reverse the bytes of each byte_width row of data, whose length must be a
+# multiple of byte_width
+def reverse_rows(data, byte_width):
+    if byte_width in row_typecodes:
+        rows = array(row_typecodes[byte_width], data)
+        rows.byteswap()
+        return rows.tobytes()
+
+    if byte_width % 8 == 0:
+        # byteswap each 64-bit word, then reverse the order of words in each row
+        words = array("Q", data)
+        words.byteswap()
+        row_words = byte_width // 8
+        rows = array("Q", bytes(len(data)))
+        for i in range(row_words):
+            rows[i::row_words] = words[row_words - 1 - i::row_words]
+        return rows.tobytes()
+
+    return b"".join(data[i:i + byte_width][::-1] for i in range(0, len(data), byte_width))
+
+
+# Format data as one hex row of byte_width bytes per line
+def hex_rows(data, byte_width):
+    hex_data = binascii.hexlify(reverse_rows(data, byte_width))
+    line_width = 2 * byte_width + 1
+    num_rows = len(data) // byte_width
+
+    # Scatter each hex column into place rather than formatting row by row
+    lines = bytearray(num_rows * line_width)
+    for i in range(2 * byte_width):
+        lines[i::line_width] = hex_data[i::2 * byte_width]
+    lines[line_width - 1::line_width] = b"\n" * num_rows
+
+    return lines
 
 
 def generate_hex_dump(in_path, out_path, bit_width=64):
     byte_width = bit_width // 8
+    block_size = hex_dump_block_rows * byte_width
+
+    with open(in_path, "rb") as infile, open(out_path, "wb") as outfile:
+        size = os.fstat(infile.fileno()).st_size
+        if size == 0:
+            return
+
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as image:
+            for offset in range(0, size, block_size):
+                block = image[offset:offset + block_size]
+
+                # Zero-fill the last row
+                if len(block) % byte_width != 0:
+                    block += bytes(byte_width - (len(block) % byte_width))
 
-    infile = open(in_path, "rb")
-    outfile = open(out_path, "w")
+                # Reverse because in Verilog most-significant bit of vectors is first.
+                outfile.write(hex_rows(block, byte_width))
 
-    for row in group_hex_chunks(infile.read(), byte_width, fillvalue=0):
-        # Reverse because in Verilog most-significant bit of vectors is first.
-        hex_row = ''.join('{:02x}'.format(b) for b in reversed(row))
-        outfile.write(hex_row + '\n')
 
-    infile.close()
-    outfile.close()
+#
+# Readers for the formats above, used to inspect, verify and compare generated
+# images. Images are memory-mapped and only the headers and segment tables are
+# parsed up front, so inspecting even a very large image reads a few pages;
+# payloads are only read to check CRCs or compare contents.
+#
+load_image_magic = 0xD04EA001
+
+# generate_tag_load_image writes this in place of the entry point and segment count
+no_segments = 0xffffffff
+
+# address of the flash_address_t that ends a flash init
+flash_end_address = 0xffffffff
+
+# bytes compared at a time when checking or comparing payloads
+compare_window_size = 8 << 20
+
+
+@contextlib.contextmanager
+def map_image(path):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b""
+            return
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield data
+
+
+def is_load_image(data, offset=0):
+    return (len(data) - offset >= load_image_t.size and
+            load_image_t.unpack_from(data, offset)[0] == load_image_magic)
+
+
+class LoadSegment:
+    def __init__(self, address, size, offset):
+        self.address = address
+        self.size = size
+        # of the payload, from the start of the load image
+        self.offset = offset
+
+
+# Header and segment table of the load image at offset in data, of length
+# bytes. Raises ValueError if it is not a load image
+class LoadImageInfo:
+    def __init__(self, data, offset=0, length=None):
+        if length is None:
+            length = len(data) - offset
+        if not is_load_image(data, offset):
+            raise ValueError("not a load image (no 0x{:08x} magic number)".format(load_image_magic))
+
+        (_, self.entry_point, segment_count,
+         self.taginfo_offset, self.taginfo_size) = load_image_t.unpack_from(data, offset)
+        self.offset = offset
+        self.length = length
+        self.tag_only = segment_count == no_segments
+        self.segments = []
+
+        payload_offset = load_image_t.size
+        if not self.tag_only:
+            table_size = segment_count * load_segment_t.size
+            if load_image_t.size + table_size > length:
+                raise ValueError("segment table of {} segments runs past the end of the image".format(segment_count))
+
+            payload_offset += table_size
+            table_offset = offset + load_image_t.size
+            for address, size in load_segment_t.iter_unpack(data[table_offset:table_offset + table_size]):
+                self.segments.append(LoadSegment(address, size, payload_offset))
+                payload_offset += size
+
+        self.payload_end = payload_offset
+
+    def describe(self):
+        if self.tag_only:
+            lines = ["tag load image, {} bytes".format(self.length)]
+        else:
+            lines = ["load image, {} bytes, entry point 0x{:x}, {} segments".format(
+                self.length, self.entry_point, len(self.segments))]
+            for segment in self.segments:
+                lines.append("  segment 0x{:08x}, 0x{:x} bytes at offset 0x{:x}".format(
+                    segment.address, segment.size, segment.offset))
+
+        if self.taginfo_size:
+            lines.append("  taginfo, 0x{:x} bytes at offset 0x{:x}".format(self.taginfo_size, self.taginfo_offset))
+
+        return lines
+
+    def problems(self):
+        problems = []
+        end = 0
+        for segment in self.segments:
+            if segment.address % 4 or segment.size % 4:
+                problems.append("segment 0x{:08x} (0x{:x} bytes) is not 4-byte aligned".format(segment.address, segment.size))
+            if segment.address < end:
+                problems.append("segment 0x{:08x} overlaps the previous segment".format(segment.address))
+            end = max(end, segment.address + segment.size)
+
+        if self.payload_end > self.length:
+            problems.append("segment payloads run 0x{:x} bytes past the end of the image".format(self.payload_end - self.length))
+
+        expected_length = self.payload_end
+        if self.taginfo_size:
+            if self.taginfo_offset % 4:
+                problems.append("taginfo offset 0x{:x} is not 4-byte aligned".format(self.taginfo_offset))
+            if self.taginfo_offset != self.payload_end:
+                problems.append("taginfo at offset 0x{:x} does not follow the segment payloads at 0x{:x}".format(
+                    self.taginfo_offset, self.payload_end))
+            if self.taginfo_offset + self.taginfo_size > self.length:
+                problems.append("taginfo runs past the end of the image")
+            expected_length = max(expected_length, self.taginfo_offset + align(self.taginfo_size))
+
+        if self.length > expected_length:
+            problems.append("0x{:x} unexpected bytes at the end of the image".format(self.length - expected_length))
+
+        return problems
+
+
+class FlashEntry:
+    def __init__(self, address, size, crc, offset):
+        self.address = address
+        self.size = size
+        self.crc = crc
+        # of the flash_address_t header; the payload follows it
+        self.offset = offset
+        self.payload_offset = offset + flash_address_t.size
+
+
+# Entry headers of a flash init (see generate_flash_init). Each header gives
+# the size of its payload, so reading them only touches one page per entry
+class FlashInitInfo:
+    def __init__(self, data):
+        self.length = len(data)
+        self.entries = []
+        self.terminated = False
+        self.truncated = False
+
+        offset = 0
+        while offset + flash_address_t.size <= self.length:
+            address, size, crc = flash_address_t.unpack_from(data, offset)
+            if address == flash_end_address:
+                self.terminated = True
+                offset += flash_address_t.size
+                break
+
+            entry = FlashEntry(address, size, crc, offset)
+            self.entries.append(entry)
+            offset = entry.payload_offset + size
+
+        self.end = offset
+        if offset > self.length:
+            self.truncated = True
+
+    def describe(self, data):
+        lines = ["flash init, {} bytes, {} entries".format(self.length, len(self.entries))]
+        for entry in self.entries:
+            lines.append("  entry 0x{:08x}, 0x{:x} bytes, crc 0x{:08x}".format(entry.address, entry.size, entry.crc))
+            if entry.payload_offset + entry.size <= self.length and is_load_image(data, entry.payload_offset):
+                image = LoadImageInfo(data, entry.payload_offset, entry.size)
+                lines += ["    " + line for line in image.describe()]
+
+        return lines
+
+    def problems(self, data):
+        problems = []
+        for entry in self.entries:
+            name = "entry 0x{:08x}".format(entry.address)
+            if entry.payload_offset + entry.size > self.length:
+                problems.append("{} runs past the end of the flash init".format(name))
+                continue
+
+            if entry.size % 4:
+                problems.append("{} size 0x{:x} is not a multiple of 4".format(name, entry.size))
+
+            crc = flash_entry_crc(data, entry)
+            if crc != entry.crc:
+                problems.append("{} has crc 0x{:08x}, expected 0x{:08x}".format(name, entry.crc, crc))
+
+            if is_load_image(data, entry.payload_offset):
+                image = LoadImageInfo(data, entry.payload_offset, entry.size)
+                problems += ["{}: {}".format(name, problem) for problem in image.problems()]
+
+        if not self.terminated:
+            problems.append("no end of stream marker")
+        elif self.end < self.length:
+            problems.append("0x{:x} unexpected bytes after the end of stream marker".format(self.length - self.end))
+
+        return problems
+
+
+def flash_entry_crc(data, entry):
+    crc = zlib.crc32(flash_address_t.pack(entry.address, entry.size, 0))
+    with memoryview(data) as view:
+        for offset in range(entry.payload_offset, entry.payload_offset + entry.size, compare_window_size):
+            end = min(offset + compare_window_size, entry.payload_offset + entry.size)
+            with view[offset:end] as window:
+                crc = zlib.crc32(window, crc)
+
+    return crc & 0xffffffff
+
+
+# Offset of the first byte that differs between the size bytes at offset_a in
+# data_a and offset_b in data_b, relative to those offsets, or None
+def first_difference(data_a, offset_a, data_b, offset_b, size):
+    for start in range(0, size, compare_window_size):
+        end = min(start + compare_window_size, size)
+        window_a = data_a[offset_a + start:offset_a + end]
+        window_b = data_b[offset_b + start:offset_b + end]
+        if window_a == window_b:
+            continue
+
+        # narrow down to the first differing page before comparing bytes
+        length = min(len(window_a), len(window_b))
+        for page in range(0, length, 4096):
+            if window_a[page:page + 4096] == window_b[page:page + 4096]:
+                continue
+            for i in range(page, min(page + 4096, length)):
+                if window_a[i] != window_b[i]:
+                    return start + i
+
+        return start + length
+
+    return None
+
+
+def diff_load_images(image_a, data_a, image_b, data_b):
+    differences = []
+    if image_a.tag_only != image_b.tag_only:
+        return ["one is a tag load image and the other is not"]
+
+    if image_a.entry_point != image_b.entry_point:
+        differences.append("entry point 0x{:x} -> 0x{:x}".format(image_a.entry_point, image_b.entry_point))
+
+    segments_a = {segment.address: segment for segment in image_a.segments}
+    segments_b = {segment.address: segment for segment in image_b.segments}
+    for address in sorted(set(segments_a) | set(segments_b)):
+        segment_a = segments_a.get(address)
+        segment_b = segments_b.get(address)
+        if segment_b is None:
+            differences.append("segment 0x{:08x} (0x{:x} bytes) removed".format(address, segment_a.size))
+        elif segment_a is None:
+            differences.append("segment 0x{:08x} (0x{:x} bytes) added".format(address, segment_b.size))
+        elif segment_a.size != segment_b.size:
+            differences.append("segment 0x{:08x} size 0x{:x} -> 0x{:x}".format(address, segment_a.size, segment_b.size))
+        else:
+            offset = first_difference(data_a, image_a.offset + segment_a.offset,
+                                      data_b, image_b.offset + segment_b.offset, segment_a.size)
+            if offset is not None:
+                differences.append("segment 0x{:08x} differs from address 0x{:08x}".format(address, address + offset))
+
+    if image_a.taginfo_size != image_b.taginfo_size:
+        differences.append("taginfo size 0x{:x} -> 0x{:x}".format(image_a.taginfo_size, image_b.taginfo_size))
+    elif image_a.taginfo_size:
+        offset = first_difference(data_a, image_a.offset + image_a.taginfo_offset,
+                                  data_b, image_b.offset + image_b.taginfo_offset, image_a.taginfo_size)
+        if offset is not None:
+            differences.append("taginfo differs from offset 0x{:x}".format(offset))
+
+    return differences
+
+
+def diff_flash_inits(flash_a, data_a, flash_b, data_b):
+    differences = []
+    entries_a = {entry.address: entry for entry in flash_a.entries}
+    entries_b = {entry.address: entry for entry in flash_b.entries}
+    for address in sorted(set(entries_a) | set(entries_b)):
+        entry_a = entries_a.get(address)
+        entry_b = entries_b.get(address)
+        name = "entry 0x{:08x}".format(address)
+        if entry_b is None:
+            differences.append("{} removed".format(name))
+        elif entry_a is None:
+            differences.append("{} added".format(name))
+        elif (entry_a.size == entry_b.size and
+              first_difference(data_a, entry_a.payload_offset, data_b, entry_b.payload_offset, entry_a.size) is None):
+            if entry_a.crc != entry_b.crc:
+                differences.append("{} crc 0x{:08x} -> 0x{:08x}".format(name, entry_a.crc, entry_b.crc))
+        elif is_load_image(data_a, entry_a.payload_offset) and is_load_image(data_b, entry_b.payload_offset):
+            image_a = LoadImageInfo(data_a, entry_a.payload_offset, entry_a.size)
+            image_b = LoadImageInfo(data_b, entry_b.payload_offset, entry_b.size)
+            changes = diff_load_images(image_a, data_a, image_b, data_b) or ["payload differs"]
+            differences += ["{}: {}".format(name, change) for change in changes]
+        else:
+            differences.append("{} (0x{:x} bytes, crc 0x{:08x}) -> (0x{:x} bytes, crc 0x{:08x})".format(
+                name, entry_a.size, entry_a.crc, entry_b.size, entry_b.crc))
+
+    return differences
+
+
+# Parses the load image or flash init in data
+def image_info(data):
+    if is_load_image(data):
+        return LoadImageInfo(data)
+    return FlashInitInfo(data)
+
+
+def inspect_image(path):
+    with map_image(path) as data:
+        info = image_info(data)
+        if isinstance(info, LoadImageInfo):
+            return info.describe()
+        return info.describe(data)
+
+
+# Checks that the sections of elf_binary that generate_load_image includes
+# match the segments of the load image
+def check_elf_segments(image, data, elf_binary):
+    if image.tag_only:
+        return ["{} is a tag load image, which has no segments to check".format(os.path.basename(elf_binary))]
+
+    problems = []
+    with open(elf_binary, 'rb') as f, map_image(elf_binary) as elf_data:
+        plan = plan_load_image(isp_elf.elfInfo(elf_binary))
+        if plan.entry_point != image.entry_point:
+            problems.append("entry point 0x{:x} does not match the ELF entry point 0x{:x}".format(
+                image.entry_point, plan.entry_point))
+
+        expected = plan.segments
+        actual = [(segment.address, segment.size) for segment in image.segments]
+        if expected != actual:
+            for (address, size), (expected_address, expected_size) in zip(actual + [(None, None)], expected + [(None, None)]):
+                if (address, size) != (expected_address, expected_size):
+                    break
+            problems.append("segment table does not match the ELF sections: segment {} where the ELF has {}".format(
+                "0x{:08x} (0x{:x} bytes)".format(address, size) if address is not None else "missing",
+                "0x{:08x} (0x{:x} bytes)".format(expected_address, expected_size) if expected_address is not None else "none"))
+            return problems
+
+        offset = image.offset + load_image_t.size + load_segment_t.size * len(image.segments)
+        address = None
+        for front_pad, s, size, pad in plan.copies:
+            offset += max(front_pad, 0)
+            if s.flags & isp_elf.SHF_COMPRESSED:
+                section_data, section_offset = compressed_section_data(f, s), 0
+            else:
+                section_data, section_offset = elf_data, s.offset
+
+            difference = first_difference(data, offset, section_data, section_offset, size)
+            if difference is not None:
+                problems.append("section {} differs from address 0x{:08x}".format(s.name, s.addr + difference))
+            offset += size + pad
+
+    return problems
+
+
+# Returns the problems found in the load image or flash init at path: bad
+# alignment, payloads past the end, CRC mismatches, and with elf_binary, segments
+# that do not match the executable. A flash init with a .hdr file next to it is
+# also checked against it
+def verify_image(path, elf_binary=None):
+    with map_image(path) as data:
+        info = image_info(data)
+        if isinstance(info, LoadImageInfo):
+            problems = info.problems()
+            if elf_binary and not problems:
+                problems += check_elf_segments(info, data, elf_binary)
+            return problems
+
+        problems = info.problems(data)
+        if info.truncated:
+            problems.append("last entry runs past the end of the flash init")
+
+        hdr_path = path + ".hdr"
+        if os.path.isfile(hdr_path):
+            headers = b"".join(data[entry.offset:entry.payload_offset] for entry in info.entries)
+            headers += flash_address_t.pack(flash_end_address, 0, 0)
+            if Path(hdr_path).read_bytes() != headers:
+                problems.append("{} does not match the entry headers".format(os.path.basename(hdr_path)))
+
+        if elf_binary:
+            problems.append("--elf only applies to load images")
+
+        return problems
+
+
+def diff_images(path_a, path_b):
+    with map_image(path_a) as data_a, map_image(path_b) as data_b:
+        info_a = image_info(data_a)
+        info_b = image_info(data_b)
+        if type(info_a) != type(info_b):
+            return ["one is a load image and the other a flash init"]
+
+        if isinstance(info_a, LoadImageInfo):
+            return diff_load_images(info_a, data_a, info_b, data_b)
+        return diff_flash_inits(info_a, data_a, info_b, data_b)
+
+
+# Entries of a flash init are split into blocks of at most this size for
+# delta transfers (see generate_delta_flash_init)
+flash_block_size = 64 << 10
+
+
+def flash_entry_key(address):
+    return "0x{:08x}".format(address)
+
+
+# Splits each entry of the flash init at path into blocks: at the start of each
+# segment and of the taginfo of the load image it holds, and every block_size
+# bytes in between. Returns {entry address: [[offset, size, digest], ...]},
+# in a form that can be saved as JSON
+def flash_init_blocks(path, block_size=flash_block_size):
+    blocks = {}
+    with map_image(path) as data:
+        info = FlashInitInfo(data)
+        if info.truncated:
+            raise ValueError("{} is truncated".format(path))
+
+        with memoryview(data) as view:
+            for entry in info.entries:
+                bounds = {0, entry.size}
+                if is_load_image(data, entry.payload_offset):
+                    image = LoadImageInfo(data, entry.payload_offset, entry.size)
+                    bounds.update(segment.offset for segment in image.segments)
+                    if image.taginfo_size:
+                        bounds.add(image.taginfo_offset)
+                bounds = sorted(bound for bound in bounds if bound <= entry.size)
+
+                entry_blocks = []
+                for start, end in zip(bounds, bounds[1:]):
+                    for offset in range(start, end, block_size):
+                        size = min(block_size, end - offset)
+                        payload_offset = entry.payload_offset + offset
+                        digest = hashlib.blake2b(view[payload_offset:payload_offset + size], digest_size=16)
+                        entry_blocks.append([offset, size, digest.hexdigest()])
+
+                blocks[flash_entry_key(entry.address)] = entry_blocks
+
+    return blocks
+
+
+# Writes to output_image a flash init holding only the blocks of flash_init
+# that are not among held_blocks, the flash_init_blocks of what the board was
+# last sent. Consecutive changed blocks are sent as one entry at the address
+# they are loaded to. Returns the number of payload bytes written
+def generate_delta_flash_init(output_image, flash_init, held_blocks, blocks=None):
+    if blocks is None:
+        blocks = flash_init_blocks(flash_init)
+
+    sent = 0
+    with map_image(flash_init) as data, open(output_image, 'wb') as out:
+        info = FlashInitInfo(data)
+        with memoryview(data) as view:
+            for entry in info.entries:
+                key = flash_entry_key(entry.address)
+                held = set(tuple(block) for block in held_blocks.get(key, []))
+
+                changed = []
+                for offset, size, digest in blocks[key]:
+                    if (offset, size, digest) in held:
+                        continue
+                    if changed and sum(changed[-1]) == offset:
+                        changed[-1][1] += size
+                    else:
+                        changed.append([offset, size])
+
+                for offset, size in changed:
+                    address = entry.address + offset
+                    payload_offset = entry.payload_offset + offset
+                    with view[payload_offset:payload_offset + size] as payload:
+                        crc = zlib.crc32(payload, zlib.crc32(flash_address_t.pack(address, size, 0)))
+                        out.write(flash_address_t.pack(address, size, crc & 0xffffffff))
+                        out.write(payload)
+                    sent += size
+
+        # indicate end of stream
+        out.write(flash_address_t.pack(flash_end_address, 0, 0))
+
+    return sent
 
 
 def main():
-    parser = argparse.ArgumentParser(description="Generate load image or flash images")
-    parser.add_argument("--image_type", type=str,
-    required=True, help=''' Generate load or flash image.
+    parser = argparse.ArgumentParser(description="Generate, inspect or verify load images and flash images")
+    parser.add_argument("--image_type", type=str, help=''' Generate load or flash image.
     ''')
-    parser.add_argument("-o", "--out", type=str, required=True,
+    parser.add_argument("-o", "--out", type=str,
     help='''
     Output file.
     ''')
+    parser.add_argument("--inspect", action="store_true", help='''
+    Print the headers and segment tables of the load image or flash init given
+    as input file.
+    ''')
+    parser.add_argument("--verify", action="store_true", help='''
+    Check the alignment, sizes and CRCs of the load image or flash init given as
+    input file.
+    ''')
+    parser.add_argument("--elf", type=str, help='''
+    With --verify, also check the segments of a load image against this ELF file.
+    ''')
+    parser.add_argument("--diff", type=str, metavar="OTHER", help='''
+    Compare the load image or flash init given as input file with OTHER, segment
+    by segment.
+    ''')
     parser.add_argument("--tag_info", type=str, help='''
     Taginfo file.
     ''')
@@ -207,14 +818,47 @@ def main():
     parser.add_argument("--ap_address", type=str, help='''
     Hex address (0x format) for the application processor load image in the flash init.
     ''')
+    parser.add_argument("--flash_image", nargs=2, action="append", default=[],
+    metavar=("ADDRESS", "FILE"), help='''
+    Hex address (0x format) and load image of another entry in the flash init.
+    May be repeated.
+    ''')
     parser.add_argument("input_files", metavar="Input File(s)", nargs='*',
     help="Input files to generate images from. Flash requires the kernel image first.")
     args = parser.parse_args()
 
+    if args.inspect or args.verify or args.diff:
+        if len(args.input_files) != 1:
+            parser.error("--inspect, --verify and --diff take one input file")
+
+        try:
+            if args.inspect:
+                print("\n".join(inspect_image(args.input_files[0])))
+
+            problems = []
+            if args.verify:
+                problems += verify_image(args.input_files[0], args.elf)
+                for problem in problems:
+                    logger.error(problem)
+                if not problems:
+                    print("{}: OK".format(args.input_files[0]))
+
+            differences = []
+            if args.diff:
+                differences = diff_images(args.input_files[0], args.diff)
+                print("\n".join(differences))
+        except (IOError, ValueError) as e:
+            logger.error(e)
+            sys.exit(1)
+
+        sys.exit(1 if problems or differences else 0)
+
+    if not args.image_type or not args.out:
+        parser.error("--image_type and --out are required to generate an image")
 
     if args.image_type == "flash":
-        flash_init_map = dict(zip([int(args.kernel_address, 16), int(args.ap_address, 16)], args.input_files))
-        generate_flash_init(args.out, flash_init_map)
+        flash_images = list(zip([args.kernel_address, args.ap_address], args.input_files))
+        generate_flash_init(args.out, flash_images + args.flash_image)
     elif args.image_type == "load":
         generate_load_image(args.input_files[0], args.out, args.tag_info)
 
@@ -0,0 +1,103 @@
+import os
+import json
+import hashlib
+import logging
+
+logger = logging.getLogger()
+
+manifest_file = "isp_manifest.json"
+
+# The manifest of the run in progress, if any. Set by isp_run_app
+current_manifest = None
+
+
+# Cheap fingerprint of files and directory trees from their names, sizes and
+# modification times, for inputs too large to hash on every run (like make,
+# a touched file counts as changed)
+def stamp(*paths):
+    h = hashlib.sha256()
+    for path in paths:
+        h.update(str(path).encode())
+        h.update(b"\0")
+        if path is None or not os.path.exists(path):
+            continue
+
+        if os.path.isfile(path):
+            st = os.stat(path)
+            h.update("{}:{}".format(st.st_size, st.st_mtime_ns).encode())
+            continue
+
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                try:
+                    st = os.stat(file_path)
+                except OSError:
+                    continue
+                h.update("{}:{}:{}\0".format(os.path.relpath(file_path, path),
+                                             st.st_size, st.st_mtime_ns).encode())
+
+    return h.hexdigest()
+
+
+# Records the fingerprint of the inputs each artifact in a run directory was
+# generated from, so that an incremental run (isp_run_app --incremental) only
+# regenerates the artifacts whose inputs changed.
+class RunManifest:
+    def __init__(self, run_dir, load=False):
+        self.path = os.path.join(run_dir, manifest_file)
+        self.artifacts = {}
+
+        if load:
+            try:
+                with open(self.path, "r") as f:
+                    self.artifacts = json.load(f)
+            except (IOError, ValueError):
+                pass
+
+    def save(self):
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.artifacts, f, indent=2, sort_keys=True)
+        os.replace(self.path + ".tmp", self.path)
+
+    # True if artifact was generated from inputs with fingerprint key and all of
+    # its outputs still exist. Otherwise the artifact is forgotten until it is
+    # recorded again, so an interrupted regeneration is never trusted
+    def upToDate(self, artifact, key, outputs):
+        if self.artifacts.get(artifact) == key and all(os.path.exists(o) for o in outputs):
+            logger.info("Reusing {} from the previous run".format(artifact))
+            return True
+
+        if artifact in self.artifacts:
+            del self.artifacts[artifact]
+            self.save()
+
+        return False
+
+    def record(self, artifact, key):
+        self.artifacts[artifact] = key
+        self.save()
+
+
+def startManifest(run_dir, load=False):
+    global current_manifest
+    current_manifest = RunManifest(run_dir, load)
+    return current_manifest
+
+
+def endManifest():
+    global current_manifest
+    current_manifest = None
+
+
+def upToDate(artifact, key, outputs):
+    if current_manifest is None:
+        return False
+
+    return current_manifest.upToDate(artifact, key, outputs)
+
+
+def record(artifact, key):
+    if current_manifest is not None and key:
+        current_manifest.record(artifact, key)
@@ -2,12 +2,17 @@ import shutil
 import logging
 import os
 import isp_utils
+import isp_cache
 import multiprocessing
 import subprocess 
 
 logger = logging.getLogger()
 isp_prefix = isp_utils.getIspPrefix()
 
+# Policies whose objects are kept in a shared pex-kernel tree, the least
+# recently built ones being removed first
+max_policy_builds = 8
+
 def copyPexKernelSources(source_dir, output_dir):
     logger.info("Copying pex-kernel sources")
     pex_kernel_output_dir = os.path.join(output_dir, "pex-kernel")
@@ -32,7 +37,10 @@ def copyPolicySources(policy_dir, output_dir, soc):
     gen_dir = os.path.join(pex_kernel_output_dir, "build", build_dir_name, "gen")
 
     try:
-        shutil.copytree(policy_dir, gen_dir)
+        # Don't preserve timestamps so that make rebuilds the policy objects
+        # in a shared pex-kernel tree
+        isp_utils.removeIfExists(gen_dir)
+        shutil.copytree(policy_dir, gen_dir, copy_function=shutil.copy)
     except Exception as e:
         logger.error("Copying pex-kernel sources failed with error: {}".format(str(e)))
         return False
@@ -92,3 +100,75 @@ def movePexKernel(policy_name, output_dir, soc):
 def pexKernelName(policy_name, soc):
     return "-".join(["kernel", soc, policy_name])
 
+
+# Builds the kernel in a persistent pex-kernel tree per SOC and FPGA target, in
+# which only build/<soc>-<policy>/gen is replaced for each policy. The build
+# dirs of the max_policy_builds most recently built policies are kept
+def buildSharedPexKernel(source_dir, source_hash, soc, policy_dir, policy_name, fpga, pex_kernel_out_path):
+    tree_prefix = "-".join([soc, fpga]) + "-"
+    with isp_cache.sharedBuildTree("pex-kernel-build", tree_prefix + source_hash, tree_prefix) as build_dir:
+        if not os.path.isdir(os.path.join(build_dir, "pex-kernel")):
+            isp_utils.removeIfExists(build_dir)
+            isp_utils.doMkDir(build_dir)
+            if not copyPexKernelSources(source_dir, build_dir):
+                return False
+
+        if not copyPolicySources(policy_dir, build_dir, soc):
+            return False
+
+        if not buildPexKernel(soc, policy_name, build_dir, fpga):
+            # Start from a clean tree next time in case the failure left it inconsistent
+            isp_utils.removeIfExists(build_dir)
+            return False
+
+        policy_build_dir = os.path.join(build_dir, "pex-kernel", "build", "-".join([soc, policy_name]))
+        try:
+            shutil.copy(os.path.join(policy_build_dir, pexKernelName(policy_name, soc)), pex_kernel_out_path)
+        except Exception as e:
+            logger.error("Copying PEX kernel to output dir failed with error: {}".format(e))
+            return False
+
+        isp_cache.pruneBuildDirs(policy_build_dir, soc + "-", max_policy_builds)
+
+    return True
+
+
+# Builds (or fetches from the artifact cache) the PEX kernel for the policy in
+# policy_dir, and stores it next to output_dir
+def installPexKernel(soc, policy_dir, output_dir, fpga):
+    source_dir = os.path.join(isp_prefix, "sources", "pex-kernel")
+    policy_name = os.path.basename(policy_dir)
+
+    if not isp_utils.checkDependency(source_dir, logger):
+        return False
+
+    kernel_cache = isp_cache.ArtifactCache("pex-kernels", 2048)
+    if kernel_cache.enabled:
+        pex_kernel_out_path = os.path.join(os.path.dirname(output_dir), pexKernelName(policy_name, soc))
+        source_hash = isp_cache.hashTree(source_dir)
+        cache_key = isp_cache.hashKey(source_hash, soc, fpga, policy_name, isp_cache.hashTree(policy_dir))
+
+        if kernel_cache.fetch(cache_key, pex_kernel_out_path):
+            logger.info("Using cached PEX kernel for {}".format(policy_name))
+        elif buildSharedPexKernel(source_dir, source_hash, soc, policy_dir, policy_name, fpga, pex_kernel_out_path):
+            kernel_cache.publish(cache_key, pex_kernel_out_path)
+        else:
+            return False
+
+        # the kernel is built elsewhere, so output_dir is left empty
+        shutil.rmtree(output_dir, ignore_errors=True)
+        return True
+
+    if not copyPexKernelSources(source_dir, output_dir):
+        return False
+
+    if not copyPolicySources(policy_dir, output_dir, soc):
+        return False
+
+    if not buildPexKernel(soc, policy_name, output_dir, fpga):
+        return False
+
+    if not movePexKernel(policy_name, output_dir, soc):
+        return False
+
+    return True
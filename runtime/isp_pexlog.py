@@ -0,0 +1,212 @@
+import re
+import time
+import asyncio
+import threading
+import logging
+import isp_report
+
+logger = logging.getLogger()
+
+# Messages printed by the PEX (validator or PEX kernel) that end a run, by event type
+event_patterns = {
+    "policy_violation": b"Policy Violation",
+    "tmt_miss": b"TMT miss",
+}
+
+event_warnings = {
+    "policy_violation": "Process exited due to policy violation",
+    "tmt_miss": "Process exited due to TMT miss",
+}
+
+# The PC of an event is printed on the event line or on one of the lines after it
+pc_pattern = re.compile(rb"\bPC\b\s*[=:]?\s*((?:0x)?[0-9a-fA-F]+)\b", re.IGNORECASE)
+pc_context_lines = 4
+
+# Only the first events are kept in the report; every event is counted
+max_recorded_events = 100
+
+# A line longer than this is scanned without waiting for its end
+max_line_length = 1 << 16
+
+read_size = 1 << 20
+
+poll_seconds = 0.05
+
+
+# Incrementally scans the PEX log of a running simulation for policy violations
+# and TMT misses. Only the output appended since the previous poll() is read,
+# so the log is read once no matter how large it grows. Each event records its
+# type, the PC (when printed), the byte offset of its line in the log and the
+# time it was seen, relative to the start of the scan.
+# With no path, the output is instead fed to the scanner as it is captured
+# (see isp_capture.LogCapture), possibly from another thread, and poll() only
+# returns the events found since the last poll.
+# The events are recorded in run_report (an isp_report.RunReport), if given.
+class PexLogScanner:
+    def __init__(self, path=None, run_report=None):
+        self.path = path
+        self.run_report = run_report
+        self.log = None
+        self.lock = threading.Lock()
+        self.unpolled = []
+        self.start = time.time()
+        self.offset = 0
+        self.partial = b""
+        self.counts = {event_type: 0 for event_type in event_patterns}
+        self.events = []
+        # events still looking for their PC, with the number of lines left to search
+        self.pc_pending = []
+
+    # Reads and scans the output appended since the last poll. Returns the new events
+    def poll(self):
+        if self.path is not None:
+            self.readLog()
+
+        with self.lock:
+            new_events = self.unpolled
+            self.unpolled = []
+
+        return new_events
+
+    def readLog(self):
+        if self.log is None:
+            try:
+                self.log = open(self.path, "rb")
+            except IOError:
+                return
+
+        while True:
+            data = self.log.read(read_size)
+            if not data:
+                break
+            self.feed(data)
+
+    # Scans a chunk of log output. Returns the new events
+    def feed(self, data):
+        with self.lock:
+            new_events = self.scanChunk(data)
+            self.unpolled += new_events
+
+        return new_events
+
+    def scanChunk(self, data):
+        buf = self.partial + data
+        base = self.offset
+
+        end = buf.rfind(b"\n") + 1
+        if end == 0 and len(buf) > max_line_length:
+            end = len(buf)
+        lines = buf[:end]
+        self.partial = buf[end:]
+        self.offset = base + end
+
+        if not lines:
+            return []
+
+        if self.pc_pending:
+            self.findPendingPCs(lines)
+
+        new_events = []
+        for event_type, pattern in event_patterns.items():
+            pos = lines.find(pattern)
+            while pos != -1:
+                line_start = lines.rfind(b"\n", 0, pos) + 1
+                new_events.append(self.addEvent(event_type, lines, line_start, base))
+                line_end = lines.find(b"\n", pos)
+                if line_end == -1:
+                    break
+                pos = lines.find(pattern, line_end)
+
+        new_events.sort(key=lambda e: e["offset"])
+        self.events += new_events[:max_recorded_events - len(self.events)]
+        return new_events
+
+    def addEvent(self, event_type, lines, line_start, base):
+        line_end = lines.find(b"\n", line_start)
+        if line_end == -1:
+            line_end = len(lines)
+
+        event = {
+            "type": event_type,
+            "pc": None,
+            "offset": base + line_start,
+            "time": round(time.time() - self.start, 6),
+            "line": lines[line_start:line_end].decode(errors="replace").strip(),
+        }
+        self.counts[event_type] += 1
+
+        # search the event line and the lines after it for the PC
+        context = lines[line_start:].split(b"\n", pc_context_lines + 1)
+        for line in context[:pc_context_lines + 1]:
+            if self.matchPC(event, line):
+                return event
+
+        # the chunk ended first; the last element is the empty remainder after its final newline
+        if len(context) <= pc_context_lines + 1:
+            self.pc_pending.append([event, pc_context_lines + 2 - len(context)])
+
+        return event
+
+    def matchPC(self, event, line):
+        match = pc_pattern.search(line)
+        if match is None:
+            return False
+
+        event["pc"] = match.group(1).decode()
+        if not event["pc"].startswith(("0x", "0X")):
+            event["pc"] = "0x" + event["pc"]
+        return True
+
+    def findPendingPCs(self, lines):
+        context = lines.split(b"\n", pc_context_lines)[:-1]
+        still_pending = []
+        for event, lines_left in self.pc_pending:
+            if any(self.matchPC(event, line) for line in context[:lines_left]):
+                continue
+            if lines_left > len(context):
+                still_pending.append([event, lines_left - len(context)])
+        self.pc_pending = still_pending
+
+    # Scans whatever is left in the log, including a final unterminated line
+    def finish(self):
+        new_events = self.poll()
+        if self.partial:
+            new_events += self.feed(b"\n")
+
+        return new_events
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+    # Logs a warning per event type seen and records the events in the run report
+    def report(self):
+        for event_type, count in self.counts.items():
+            if count:
+                logger.warn(event_warnings[event_type])
+
+        isp_report.reportRecord(self.run_report, "pex_events", {
+            "counts": self.counts,
+            "events": self.events,
+        })
+
+
+# Scans the whole of a finished PEX log
+def scanFile(path, run_report=None):
+    scanner = PexLogScanner(path, run_report)
+    scanner.finish()
+    scanner.close()
+    return scanner
+
+
+# Supervision watcher (see isp_supervise.supervise) that scans the PEX log as
+# the simulator writes it. With stop_on_event it returns the type of the first
+# event, ending the run; otherwise it keeps scanning until cancelled
+async def watchPexLog(scanner, stop_on_event=False, poll_seconds=poll_seconds):
+    while True:
+        events = scanner.poll()
+        if events and stop_on_event:
+            return events[0]["type"]
+
+        await asyncio.sleep(poll_seconds)
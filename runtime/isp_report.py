@@ -0,0 +1,142 @@
+import os
+import json
+import time
+import resource
+import logging
+import contextlib
+
+logger = logging.getLogger()
+
+report_file = "run_report.json"
+trace_file = "run_trace.json"
+
+# The report of the run in progress, if any. Set by isp_run_app
+current_report = None
+
+
+def dirSize(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+
+    return size
+
+
+# Timing of each phase of a run (policy compile, PEX build, tagging,
+# simulation, ...), written to run_report.json in the run directory.
+# For each phase it records the start time (relative to the start of the
+# run), duration, CPU time used by child processes that finished during the
+# phase, the peak RSS of child processes if a child finishing during the phase
+# set a new peak (getrusage only reports the peak over all children), and the
+# growth of the run directory.
+class RunReport:
+    def __init__(self, run_dir):
+        self.run_dir = run_dir
+        self.start = time.time()
+        self.phases = []
+        self.data = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        start_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start_size = dirSize(self.run_dir)
+
+        try:
+            yield
+        finally:
+            end = time.time()
+            end_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+            peak_rss = None
+            if end_usage.ru_maxrss > start_usage.ru_maxrss:
+                peak_rss = end_usage.ru_maxrss
+
+            self.phases.append({
+                "phase": name,
+                "start": round(start - self.start, 6),
+                "duration": round(end - start, 6),
+                "child_cpu_time": round((end_usage.ru_utime + end_usage.ru_stime) -
+                                        (start_usage.ru_utime + start_usage.ru_stime), 6),
+                "child_peak_rss_kb": peak_rss,
+                "bytes_written": dirSize(self.run_dir) - start_size,
+            })
+            logger.debug("Phase {} took {:.3f}s".format(name, end - start))
+
+    def record(self, key, value):
+        self.data[key] = value
+
+    def write(self, trace=False):
+        report = {
+            "run_dir": self.run_dir,
+            "start_time": self.start,
+            "duration": round(time.time() - self.start, 6),
+            "phases": sorted(self.phases, key=lambda p: p["start"]),
+        }
+        report.update(self.data)
+
+        with open(os.path.join(self.run_dir, report_file), "w") as f:
+            json.dump(report, f, indent=2)
+
+        if trace:
+            self.writeTrace()
+
+    # Chrome trace event format, for chrome://tracing or ui.perfetto.dev
+    def writeTrace(self):
+        pid = os.getpid()
+        events = [{
+            "name": p["phase"],
+            "ph": "X",
+            "ts": int(p["start"] * 1e6),
+            "dur": int(p["duration"] * 1e6),
+            "pid": pid,
+            "tid": pid,
+            "args": {k: v for k, v in p.items() if k not in ["phase", "start", "duration"]},
+        } for p in self.phases]
+
+        with open(os.path.join(self.run_dir, trace_file), "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def startReport(run_dir):
+    global current_report
+    current_report = RunReport(run_dir)
+    return current_report
+
+
+def endReport():
+    global current_report
+    current_report = None
+
+
+@contextlib.contextmanager
+def noPhase():
+    yield
+
+
+# Times the with block as a phase of report, if there is one. Code that may
+# run concurrently with other runs in one interpreter (e.g. a QemuSession)
+# holds its own report instead of using the current one
+def reportPhase(report, name):
+    if report is None:
+        return noPhase()
+
+    return report.phase(name)
+
+
+def reportRecord(report, key, value):
+    if report is not None:
+        report.record(key, value)
+
+
+# Times the with block as a phase of the current report, if there is one
+def phase(name):
+    return reportPhase(current_report, name)
+
+
+def record(key, value):
+    reportRecord(current_report, key, value)
@@ -4,6 +4,10 @@ import os
 import re
 import argparse
 import isp_utils
+import isp_report
+import isp_capture
+import isp_manifest
+import isp_cache
 import logging
 import sys
 import subprocess
@@ -45,6 +49,37 @@ def doEntitiesFile(run_dir, name):
         open(filename, "a").close()
 
 
+# Fingerprints of the inputs of the policy and PEX binary that are generated in
+# the run directory, recorded in its manifest for --incremental runs
+def policyManifestKey(policies, global_policies, debug):
+    policies_dir = os.path.join(isp_prefix, "sources", "policies")
+    return isp_cache.hashKey(policies, global_policies, debug,
+                             isp_manifest.stamp(policies_dir),
+                             isp_cache.toolId("policy-tool"))
+
+
+def pexManifestKey(design, policy_dir, sim, arch, extra):
+    sources_dir = os.path.join(isp_prefix, "sources")
+    return isp_cache.hashKey(design, sim, arch, extra,
+                             isp_manifest.stamp(policy_dir,
+                                                os.path.join(sources_dir, "policy-engine"),
+                                                os.path.join(sources_dir, "pex-kernel")))
+
+
+# Removes the logs and reports of a previous run from run_dir, keeping the
+# artifacts that an --incremental run can reuse
+def clearRunLogs(run_dir):
+    for name in os.listdir(run_dir):
+        path = os.path.join(run_dir, name)
+        if not os.path.isfile(path):
+            continue
+
+        if (name.endswith(".log") or
+            re.search(r"\.log\.[0-9]{4}\.gz$", name) or
+            name in [isp_report.report_file, isp_report.trace_file]):
+            os.remove(path)
+
+
 def compileMissingPex(design, policy_dir, pex_path, sim, arch, extra):
     logger.info("Attempting to compile missing PEX binary")
     install_path = os.path.dirname(pex_path)
@@ -90,8 +125,7 @@ def compileMissingPolicy(policies, global_policies, output_dir, debug):
     return True
 
 
-def main():
-    global sim_module
+def parseArgs(argv=None):
     parser = argparse.ArgumentParser(description="Run standalone ISP applications")
     parser.add_argument("exe_path", type=str, help='''
     Path of the executable to run
@@ -158,20 +192,62 @@ def main():
     parser.add_argument("--pex", type=str, help='''
     Path to a custom PEX implementation (validator lib, kernel, etc)
     ''')
+    parser.add_argument("--stop-on-violation", action="store_true", help='''
+    Stop the simulator at the first policy violation or TMT miss
+    ''')
+    parser.add_argument("--compress-logs", action="store_true", help='''
+    Compress the validator output (qemu) or simulation traces (vcs) on the fly
+    into size-bounded, rotated segments, keeping only their last
+    --log-tail-size MB uncompressed. Use isp_grep_log to search them
+    ''')
+    parser.add_argument("--log-max-size", type=int, default=1024, help='''
+    Size in MB of the compressed segments of a log above which the oldest are
+    removed, with --compress-logs. Default is 1024
+    ''')
+    parser.add_argument("--log-tail-size", type=int, default=16, help='''
+    Size in MB of the end of a log kept uncompressed, with --compress-logs.
+    Default is 16
+    ''')
+    parser.add_argument("-I", "--incremental", action="store_true", help='''
+    Keep the output directory of a previous run and only regenerate the policy,
+    PEX binary, tag info and simulator inputs whose inputs changed. Logs are
+    still cleared
+    ''')
+    parser.add_argument("--trace", action="store_true", help='''
+    Also export the per-phase timings in run_report.json as a Chrome trace
+    (run_trace.json) for chrome://tracing or Perfetto
+    ''')
 
-    args = parser.parse_args()
+    if argv is None:
+        argv = sys.argv[1:]
 
-    log_level = logging.INFO
-    if args.debug is True:
-        log_level = logging.DEBUG
+    args = parser.parse_args(argv)
+    args.argv = argv
 
-    logger = isp_utils.setupLogger(log_level, (not args.disable_colors))
+    return args
+
+
+def getRunDir(output_dir, exe_name, policy_name, rule_cache_name, rule_cache_size, suffix):
+    run_dir = os.path.join(output_dir, f"isp-run-{exe_name}-{policy_name}")
+    if rule_cache_name != "":
+        run_dir = f"{run_dir}-{rule_cache_name}-{rule_cache_size}"
+    if suffix:
+        run_dir = f"{run_dir}-{suffix}"
+
+    return run_dir
+
+
+# Runs a single application as described by args (see parseArgs).
+# Returns a tuple of (isp_utils.retVals result, run directory or None,
+# application exit code or None)
+def runApp(args):
+    global sim_module
 
     sim_module = __import__("isp_" + args.simulator)
 
     if not os.path.isfile(args.exe_path):
         logger.error("No binary found to run")
-        exit(1)
+        return isp_utils.retVals.NO_BIN, None, None
 
     if args.output == "":
         output_dir = os.getcwd()
@@ -180,18 +256,18 @@ def main():
 
     if args.runtime not in ["frtos", "sel4", "bare", "stock_frtos", "stock_sel4", "stock_bare"]:
         logger.error("Invalid choice of runtime. Valid choices: frtos, sel4, bare, stock_frtos, stock_sel4, stock_bare")
-        return
+        return isp_utils.retVals.BAD_ARGS, None, None
 
     arch = isp_utils.getArch(args.exe_path)
     if not arch:
         logger.error(f"Invalid choice of architecture. Valid choices: {isp_utils.supportedArchs}")
-        return
+        return isp_utils.retVals.BAD_ARGS, None, None
 
     logger.debug(f"Executable has architecture {arch}")
 
     if args.rule_cache_name not in ["", "finite", "infinite", "dmhc"]:
         logger.error("Invalid choice of rule cache name. Valid choices: finite, infinite, dmhc")
-        return
+        return isp_utils.retVals.BAD_ARGS, None, None
 
     policies = args.policies
     policy_dir = ""
@@ -214,20 +290,46 @@ def main():
 
     args.exe_path = os.path.realpath(args.exe_path)
     exe_name = os.path.basename(args.exe_path)
-    run_dir = os.path.join(output_dir, f"isp-run-{exe_name}-{policy_name}")
-    if args.rule_cache_name != "":
-        run_dir = f"{run_dir}-{args.rule_cache_name}-{args.rule_cache_size}"
-    if args.suffix:
-        run_dir = f"{run_dir}-{args.suffix}"
+    run_dir = getRunDir(output_dir, exe_name, policy_name,
+                        args.rule_cache_name, args.rule_cache_size, args.suffix)
     
     # set policy_dir based on run_dir if it's not an existing directory
     if (not (len(policies) == 1 and  "/" in args.policies[0] and os.path.isdir(policies[0]))):
         policy_dir = os.path.join(run_dir, policy_name)
 
-    isp_utils.removeIfExists(run_dir)
-    isp_utils.doMkDir(run_dir)
-    logger.addHandler( logging.FileHandler("{0}/{1}.log".format(run_dir, "isp_run_app")))
-    logger.info("isp_run_app called with 'isp_run_app {}'".format(' '.join([arg for arg in sys.argv[1:]])))
+    incremental = args.incremental and os.path.isdir(run_dir)
+    if incremental:
+        clearRunLogs(run_dir)
+    else:
+        isp_utils.removeIfExists(run_dir)
+        isp_utils.doMkDir(run_dir)
+    log_handler = logging.FileHandler("{0}/{1}.log".format(run_dir, "isp_run_app"))
+    logger.addHandler(log_handler)
+
+    report = isp_report.startReport(run_dir)
+    # recorded on every run, so that a later incremental run can reuse this one
+    isp_manifest.startManifest(run_dir, incremental)
+    result = isp_utils.retVals.FAILURE
+    process_exit_code = None
+
+    try:
+        result, process_exit_code = prepareAndRunSim(args, run_dir, policies, policy_dir,
+                                                     policy_name, arch, use_validator)
+    finally:
+        report.record("result", result)
+        report.record("exit_code", process_exit_code)
+        report.write(args.trace)
+        isp_report.endReport()
+        isp_manifest.endManifest()
+
+        logger.removeHandler(log_handler)
+        log_handler.close()
+
+    return result, run_dir, process_exit_code
+
+
+def prepareAndRunSim(args, run_dir, policies, policy_dir, policy_name, arch, use_validator):
+    logger.info("isp_run_app called with 'isp_run_app {}'".format(' '.join([arg for arg in args.argv])))
 
     pex_path = args.pex
     if not pex_path:
@@ -236,23 +338,55 @@ def main():
         pex_path = os.path.realpath(args.pex)
 
     if "stock_" not in args.runtime and use_validator == True:
-        if not os.path.isdir(policy_dir):
-            if compileMissingPolicy(policies, args.global_policies, run_dir, args.policy_debug) is False:
+        # the policy and PEX binary are only rebuilt if they were generated in
+        # the run directory; ones given on the command line are used as they are
+        policy_key = None
+        if os.path.dirname(policy_dir) == run_dir:
+            policy_key = policyManifestKey(policies, args.global_policies, args.policy_debug)
+            missing = not isp_manifest.upToDate("policy", policy_key, [policy_dir])
+        else:
+            missing = not os.path.isdir(policy_dir)
+
+        if missing:
+            isp_utils.removeIfExists(policy_dir)
+            with isp_report.phase("policy compile"):
+                policy_compiled = compileMissingPolicy(policies, args.global_policies, run_dir, args.policy_debug)
+            if policy_compiled is False:
                 logger.error("Failed to compile missing policy")
-                sys.exit(1)
-
-        if not os.path.isfile(pex_path):
-            if compileMissingPex(args.soc, policy_dir, pex_path, args.simulator, arch, args.extra) is False:
+                return isp_utils.retVals.NO_POLICY, None
+            isp_manifest.record("policy", policy_key)
+
+        pex_key = None
+        if not args.pex:
+            pex_key = pexManifestKey(args.soc, policy_dir, args.simulator, arch, args.extra)
+            missing = not isp_manifest.upToDate("pex", pex_key, [pex_path])
+        else:
+            missing = not os.path.isfile(pex_path)
+
+        if missing:
+            isp_utils.removeIfExists(pex_path)
+            with isp_report.phase("pex build"):
+                pex_compiled = compileMissingPex(args.soc, policy_dir, pex_path, args.simulator, arch, args.extra)
+            if pex_compiled is False:
                 logger.error("Failed to compile missing PEX binary")
-                sys.exit(1)
+                return isp_utils.retVals.NO_PEX, None
+            isp_manifest.record("pex", pex_key)
 
         logger.debug(f"Using PEX at path: {pex_path}")
 
-        doEntitiesFile(run_dir, exe_name)
+        doEntitiesFile(run_dir, os.path.basename(args.exe_path))
 
     logger.debug("Starting simulator...")
     soc_cfg = os.path.join(isp_prefix, "bsp", args.soc, "config", f"soc_{args.soc}.yml")
     logger.debug(f"Using SOC config {soc_cfg}")
+
+    # only passed when set, so that simulator modules without support still work
+    sim_kwargs = {}
+    if args.stop_on_violation:
+        sim_kwargs["stop_on_violation"] = True
+    if args.compress_logs:
+        sim_kwargs["log_capture"] = isp_capture.CaptureSettings(args.log_max_size, args.log_tail_size)
+
     result = sim_module.runSim(args.exe_path,
                                args.soc,
                                run_dir,
@@ -266,7 +400,34 @@ def main():
                                arch,
                                args.extra,
                                use_validator,
-                               args.tag_only)
+                               args.tag_only,
+                               **sim_kwargs)
+
+    if result != isp_utils.retVals.SUCCESS or args.tag_only is True:
+        return result, None
+
+    with isp_report.phase("log scraping"):
+        process_exit_code = getProcessExitCode(run_dir, args.runtime)
+
+    return result, process_exit_code
+
+
+def main():
+    args = parseArgs()
+
+    log_level = logging.INFO
+    if args.debug is True:
+        log_level = logging.DEBUG
+
+    logger = isp_utils.setupLogger(log_level, (not args.disable_colors))
+
+    result, run_dir, process_exit_code = runApp(args)
+
+    if result in [isp_utils.retVals.NO_BIN, isp_utils.retVals.NO_POLICY, isp_utils.retVals.NO_PEX]:
+        sys.exit(1)
+
+    if result == isp_utils.retVals.BAD_ARGS:
+        return
 
     if result != isp_utils.retVals.SUCCESS:
         logger.error(result)
@@ -278,12 +439,8 @@ def main():
     if args.uart is True:
         printUartOutput(run_dir)
 
-    process_exit_code = getProcessExitCode(run_dir, args.runtime)
     logger.debug(f"Process exited with code {process_exit_code}")
 
-    if result is not isp_utils.retVals.SUCCESS:
-        logger.error(f"Failed to run application: {result}")
-
 
 if __name__ == "__main__":
     main()
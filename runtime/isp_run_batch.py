@@ -0,0 +1,446 @@
+#! /usr/bin/python3
+
+import os
+import sys
+import csv
+import json
+import time
+import yaml
+import logging
+import argparse
+import itertools
+import multiprocessing
+import multiprocessing.connection
+from multiprocessing.pool import ThreadPool
+
+import isp_utils
+import isp_run_app
+import isp_farm
+
+isp_prefix = isp_utils.getIspPrefix()
+sys.path.append(os.path.join(isp_prefix, "runtime", "modules"))
+
+logger = logging.getLogger()
+
+# Manifest job fields and their defaults. Fields without a default are required
+job_defaults = {
+    "exe": None,
+    "soc": None,
+    "policies": ["none"],
+    "global_policies": None,
+    "policy_debug": False,
+    "simulator": "qemu",
+    "runtime": "bare",
+    "rule_cache": None,
+    "extra": None,
+    "suffix": None,
+    "no_validator": False,
+    "tag_only": False,
+    "stop_on_violation": False,
+    "compress_logs": False,
+    "incremental": False,
+    "bitstream": None,
+}
+
+result_fields = ["id", "exe", "soc", "policy", "simulator", "runtime",
+                 "rule_cache", "board", "run_dir", "result", "exit_code", "wall_time"]
+
+
+def expandMatrix(matrix):
+    keys = list(matrix.keys())
+    values = [v if isinstance(v, list) else [v] for v in matrix.values()]
+    for combination in itertools.product(*values):
+        yield dict(zip(keys, combination))
+
+
+def makeJob(defaults, entry):
+    job = dict(job_defaults)
+    job.update(defaults)
+    job.update(entry)
+
+    unknown = [k for k in job if k not in job_defaults]
+    if unknown:
+        logger.error("Unknown manifest job field(s): {}".format(", ".join(unknown)))
+        return None
+
+    if not job["exe"] or not job["soc"]:
+        logger.error("Manifest job {} is missing exe or soc".format(entry))
+        return None
+
+    if isinstance(job["policies"], str):
+        job["policies"] = [job["policies"]]
+    if isinstance(job["global_policies"], str):
+        job["global_policies"] = [job["global_policies"]]
+    if isinstance(job["extra"], str):
+        job["extra"] = [job["extra"]]
+
+    job["exe"] = os.path.realpath(job["exe"])
+    if job["bitstream"]:
+        job["bitstream"] = os.path.realpath(job["bitstream"])
+
+    return job
+
+
+# The manifest is a YAML file with optional "defaults", "jobs" and "matrix" keys.
+# "jobs" is a list of explicit jobs, "matrix" is a mapping (or list of mappings) of
+# job fields to lists of values, which is expanded into their cross product.
+def loadManifest(manifest_path):
+    with open(manifest_path, "r") as f:
+        manifest = yaml.load(f, Loader=yaml.FullLoader)
+
+    if not manifest:
+        return []
+
+    defaults = manifest.get("defaults", {})
+    entries = list(manifest.get("jobs", []))
+
+    matrices = manifest.get("matrix", [])
+    if isinstance(matrices, dict):
+        matrices = [matrices]
+    for matrix in matrices:
+        entries += list(expandMatrix(matrix))
+
+    jobs = []
+    for entry in entries:
+        job = makeJob(defaults, entry)
+        if job is None:
+            return None
+        job["id"] = len(jobs)
+        jobs.append(job)
+
+    return jobs
+
+
+def isPolicyDir(policies):
+    return len(policies) == 1 and "/" in policies[0] and os.path.isdir(policies[0])
+
+
+def jobPolicies(job):
+    if "stock_" in job["simulator"] or "stock_" in job["runtime"]:
+        return ["none"]
+
+    return job["policies"]
+
+
+def jobPolicyName(job):
+    policies = jobPolicies(job)
+    if isPolicyDir(policies):
+        return os.path.basename(os.path.abspath(policies[0]))
+
+    return isp_utils.getPolicyFullName(policies, job["global_policies"], job["policy_debug"])
+
+
+def jobNeedsPex(job):
+    return "stock_" not in job["runtime"] and not job["no_validator"]
+
+
+# Compile each distinct policy and PEX binary once so that jobs sharing them
+# do not each rebuild them into their own run directory
+def prepareJobs(jobs, prep_dir, num_workers):
+    policy_dirs = {}
+    pex_paths = {}
+
+    for job in jobs:
+        job["policy_dir"] = None
+        job["pex_path"] = None
+        job["arch"] = None
+
+        if not jobNeedsPex(job) or not os.path.isfile(job["exe"]):
+            continue
+
+        policies = jobPolicies(job)
+        if isPolicyDir(policies):
+            policy_dir = os.path.abspath(policies[0])
+        else:
+            policy_key = (tuple(policies), tuple(job["global_policies"] or []), job["policy_debug"])
+            if policy_key not in policy_dirs:
+                policy_dirs[policy_key] = os.path.join(prep_dir, "policies", jobPolicyName(job))
+            policy_dir = policy_dirs[policy_key]
+
+        job["arch"] = isp_utils.getArch(job["exe"])
+        if not job["arch"]:
+            continue
+
+        sim_module = __import__("isp_" + job["simulator"])
+        pex_key = (policy_dir, job["simulator"], job["soc"], job["arch"])
+        if pex_key not in pex_paths:
+            pex_name = os.path.basename(sim_module.defaultPexPath(os.path.basename(policy_dir), job["soc"]))
+            pex_dir = os.path.join(prep_dir, "pex", "-".join([job["simulator"], job["soc"], job["arch"]]))
+            pex_paths[pex_key] = os.path.join(pex_dir, pex_name)
+
+        job["policy_dir"] = policy_dir
+        job["pex_path"] = pex_paths[pex_key]
+
+    pool = ThreadPool(num_workers)
+
+    policy_args = [(list(policies), list(global_policies) or None, os.path.dirname(policy_dir), debug)
+                   for (policies, global_policies, debug), policy_dir in policy_dirs.items()
+                   if not os.path.isdir(policy_dir)]
+    logger.info("Compiling {} policies".format(len(policy_args)))
+    for args in policy_args:
+        isp_utils.doMkDir(args[2])
+    pool.starmap(isp_run_app.compileMissingPolicy, policy_args)
+
+    pex_args = [(soc, policy_dir, pex_path, sim, arch, None)
+                for (policy_dir, sim, soc, arch), pex_path in pex_paths.items()
+                if os.path.isdir(policy_dir) and not os.path.isfile(pex_path)]
+    logger.info("Compiling {} PEX binaries".format(len(pex_args)))
+    for args in pex_args:
+        isp_utils.doMkDir(os.path.dirname(args[2]))
+    pool.starmap(isp_run_app.compileMissingPex, pex_args)
+
+    pool.close()
+    pool.join()
+
+
+def jobArgv(job, output_dir):
+    argv = [job["exe"], job["soc"],
+            "-s", job["simulator"],
+            "-r", job["runtime"],
+            "-o", output_dir]
+
+    if job["policy_dir"]:
+        argv += ["-p", job["policy_dir"]]
+        if job["pex_path"]:
+            argv += ["--pex", job["pex_path"]]
+    else:
+        argv += ["-p"] + jobPolicies(job)
+        if job["global_policies"]:
+            argv += ["-P"] + job["global_policies"]
+        if job["policy_debug"]:
+            argv += ["-D"]
+
+    if job["rule_cache"]:
+        argv += ["-C", job["rule_cache"][0], "-c", str(job["rule_cache"][1])]
+    if job["suffix"]:
+        argv += ["-S", job["suffix"]]
+    if job["no_validator"]:
+        argv += ["-N"]
+    if job["tag_only"]:
+        argv += ["-t"]
+    if job["stop_on_violation"]:
+        argv += ["--stop-on-violation"]
+    if job["compress_logs"]:
+        argv += ["--compress-logs"]
+    if job["incremental"]:
+        argv += ["-I"]
+    if job["extra"]:
+        argv += ["-e"] + job["extra"]
+
+    return argv
+
+
+def assignRunDirs(jobs, output_dir):
+    run_dirs = set()
+    for job in jobs:
+        job_output_dir = os.path.join(output_dir, "-".join([job["simulator"], job["soc"]]))
+        rule_cache = job["rule_cache"] or ["", 0]
+        run_dir = isp_run_app.getRunDir(job_output_dir, os.path.basename(job["exe"]), jobPolicyName(job),
+                                        rule_cache[0], rule_cache[1], job["suffix"])
+
+        # Identical jobs would otherwise share (and clobber) a run directory
+        if run_dir in run_dirs:
+            job["suffix"] = "-".join(filter(None, [job["suffix"], "job{}".format(job["id"])]))
+            run_dir = "-".join([run_dir, "job{}".format(job["id"])])
+        run_dirs.add(run_dir)
+
+        job["board"] = None
+        job["output_dir"] = job_output_dir
+        job["argv"] = jobArgv(job, job_output_dir)
+
+
+def jobResult(job, result, run_dir, exit_code, wall_time):
+    return {
+        "id": job["id"],
+        "exe": job["exe"],
+        "soc": job["soc"],
+        "policy": jobPolicyName(job),
+        "simulator": job["simulator"],
+        "runtime": job["runtime"],
+        "rule_cache": "-".join(str(r) for r in job["rule_cache"]) if job["rule_cache"] else "",
+        "board": job["board"],
+        "run_dir": run_dir,
+        "result": result,
+        "exit_code": exit_code,
+        "wall_time": round(wall_time, 3),
+    }
+
+
+def runJob(job, conn):
+    start = time.time()
+    run_dir = None
+    exit_code = None
+
+    try:
+        if job["policy_dir"] and not os.path.isdir(job["policy_dir"]):
+            result = isp_utils.retVals.NO_POLICY
+        elif job["pex_path"] and not os.path.isfile(job["pex_path"]):
+            result = isp_utils.retVals.NO_PEX
+        else:
+            args = isp_run_app.parseArgs(job["argv"])
+            result, run_dir, exit_code = isp_run_app.runApp(args)
+    except Exception as e:
+        logger.error("Job {} raised exception: {}".format(job["id"], e))
+        result = isp_utils.retVals.FAILURE
+
+    conn.send(jobResult(job, result, run_dir, exit_code, time.time() - start))
+    conn.close()
+
+
+def startJob(job, running, board=None):
+    recv_conn, send_conn = multiprocessing.Pipe(duplex=False)
+    proc = multiprocessing.Process(target=runJob, args=(job, send_conn))
+    proc.start()
+    send_conn.close()
+    running[proc.sentinel] = (job, proc, recv_conn, time.time(), board)
+
+
+# Runs each job in its own forked process (so simulator module state is never
+# shared between jobs) with at most num_workers running at once. With a farm,
+# the jobs for its board types instead run one at a time on each of its boards
+def runJobs(jobs, num_workers, farm=None):
+    results = []
+    pending = list(jobs)
+    running = {}
+
+    while pending or running:
+        blocked = False
+        if farm:
+            assigned, blocked = farm.assign(pending)
+            for job, board in assigned:
+                pending.remove(job)
+                board_job = farm.boardJob(job, board)
+                board_job["argv"] = jobArgv(board_job, board_job["output_dir"])
+                logger.info("Job {} ({}) runs on board {}".format(job["id"], os.path.basename(job["exe"]),
+                                                                  board.name))
+                startJob(board_job, running, board)
+
+        workers = len([board for _, _, _, _, board in running.values() if board is None])
+        for job in list(pending):
+            if workers >= num_workers:
+                break
+            if farm and farm.serves(job):
+                continue
+            pending.remove(job)
+            startJob(job, running)
+            workers += 1
+
+        # boards held by other batches are not waited on, so they are polled
+        timeout = isp_farm.poll_seconds if blocked else None
+        for sentinel in multiprocessing.connection.wait(list(running.keys()), timeout):
+            job, proc, recv_conn, start, board = running.pop(sentinel)
+            proc.join()
+            if recv_conn.poll():
+                result = recv_conn.recv()
+            else:
+                result = jobResult(job, isp_utils.retVals.FAILURE, None, None, time.time() - start)
+            recv_conn.close()
+
+            if board:
+                farm.finish(job, board, result)
+
+            logger.info("Job {} ({}, {}, {}): {}".format(job["id"], os.path.basename(job["exe"]),
+                                                        result["policy"], job["simulator"], result["result"]))
+            results.append(result)
+
+    return sorted(results, key=lambda r: r["id"])
+
+
+def writeResults(results, output_dir):
+    json_path = os.path.join(output_dir, "isp-batch-results.json")
+    with open(json_path, "w") as f:
+        json.dump(results, f, indent=2)
+
+    csv_path = os.path.join(output_dir, "isp-batch-results.csv")
+    with open(csv_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=result_fields)
+        writer.writeheader()
+        writer.writerows(results)
+
+    logger.info("Wrote batch results to {} and {}".format(json_path, csv_path))
+
+
+def writeUtilization(farm, wall_time, output_dir):
+    utilization = farm.utilization(wall_time)
+    for board in utilization:
+        logger.info("Board {}: {} jobs ({} failed), {} reprograms, {:.0%} busy".format(
+            board["name"], board["jobs"], board["failures"], board["reprograms"], board["utilization"] or 0))
+
+    json_path = os.path.join(output_dir, "isp-batch-boards.json")
+    with open(json_path, "w") as f:
+        json.dump({"wall_time": round(wall_time, 3), "boards": utilization}, f, indent=2)
+
+    logger.info("Wrote board utilization to {}".format(json_path))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a batch of standalone ISP applications in parallel")
+    parser.add_argument("manifest", type=str, help='''
+    YAML manifest describing the jobs to run
+    ''')
+    parser.add_argument("-o", "--output", type=str, default="", help='''
+    Location of the batch output directory. Contains run directories for
+    each job, shared policies/PEX binaries and the aggregated results.
+    Default is current working directory.
+    ''')
+    parser.add_argument("-j", "--jobs", type=int, default=multiprocessing.cpu_count(), help='''
+    Maximum number of jobs to run at once. Default is the number of cores
+    ''')
+    parser.add_argument("-b", "--boards", type=str, help='''
+    YAML inventory of the FPGA boards to run jobs on. Jobs whose simulator is
+    the type of a board run one at a time on each board of that type
+    ''')
+    parser.add_argument("-d", "--debug", action="store_true", help='''
+    Enable debug logging in this script
+    ''')
+    parser.add_argument("--disable-colors", action="store_true", help='''
+    Disable colored logging
+    ''')
+
+    args = parser.parse_args()
+
+    log_level = logging.INFO
+    if args.debug is True:
+        log_level = logging.DEBUG
+
+    logger = isp_utils.setupLogger(log_level, (not args.disable_colors))
+
+    if args.output == "":
+        output_dir = os.getcwd()
+    else:
+        output_dir = os.path.abspath(args.output)
+    isp_utils.doMkDir(output_dir)
+
+    jobs = loadManifest(args.manifest)
+    if jobs is None:
+        logger.error("Failed to load manifest {}".format(args.manifest))
+        sys.exit(1)
+
+    farm = None
+    if args.boards:
+        boards = isp_farm.loadInventory(args.boards)
+        if boards is None:
+            logger.error("Failed to load board inventory {}".format(args.boards))
+            sys.exit(1)
+        farm = isp_farm.Farm(boards)
+
+    num_workers = max(1, args.jobs)
+    logger.info("Running {} jobs with {} workers".format(len(jobs), num_workers))
+
+    prepareJobs(jobs, os.path.join(output_dir, "isp-batch-prep"), num_workers)
+    assignRunDirs(jobs, output_dir)
+    start = time.time()
+    results = runJobs(jobs, num_workers, farm)
+    writeResults(results, output_dir)
+    if farm:
+        writeUtilization(farm, time.time() - start, output_dir)
+
+    failures = [r for r in results if r["result"] != isp_utils.retVals.SUCCESS]
+    logger.info("{} of {} jobs ran successfully".format(len(results) - len(failures), len(results)))
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
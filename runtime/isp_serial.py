@@ -0,0 +1,96 @@
+import os
+import mmap
+import time
+import logging
+import serial
+
+logger = logging.getLogger()
+
+default_chunk_size = 4096
+
+# An upload is abandoned once the port accepts no data for this long
+default_stall_seconds = 10
+
+progress_seconds = 5
+drain_poll_seconds = 0.05
+
+# 8N1 framing puts 10 bits on the wire for each byte
+bits_per_byte = 10
+
+
+def lineRate(baud_rate):
+    return int(baud_rate) / bits_per_byte
+
+
+def logProgress(sent, size, elapsed):
+    rate = sent / elapsed if elapsed > 0 else 0
+    eta = (size - sent) / rate if rate > 0 else float("inf")
+    logger.info("Uploaded {} of {} KB ({:.1f} KB/s, ETA {:.0f} s)".format(
+        sent >> 10, size >> 10, rate / 1024, eta))
+
+
+# Waits for the data written to port to leave its output buffer, for as long
+# as the buffer keeps draining
+def drain(port, stall_seconds):
+    waiting = port.out_waiting
+    last_change = time.perf_counter()
+    while waiting:
+        time.sleep(drain_poll_seconds)
+        now = time.perf_counter()
+        still_waiting = port.out_waiting
+        if still_waiting < waiting:
+            last_change = now
+        elif now - last_change > stall_seconds:
+            raise serial.SerialTimeoutException("Drain timeout")
+        waiting = still_waiting
+
+
+# Streams the file at path to the open serial port in chunk_size writes from
+# an mmap, so the kernel's output buffer paces the upload, and logs progress
+# with an ETA. Returns the upload's statistics for the run report, or None if
+# the port accepted no data for stall_seconds
+def uploadFile(port, path, chunk_size=default_chunk_size, stall_seconds=default_stall_seconds):
+    size = os.path.getsize(path)
+    line_rate = lineRate(port.baudrate)
+    stats = {"bytes": size,
+             "chunk_size": chunk_size,
+             "baud_rate": port.baudrate,
+             "eta_seconds": size / line_rate}
+
+    logger.info("Uploading {} ({} KB) to {} at {} baud, ETA {:.0f} s".format(
+        os.path.basename(path), size >> 10, port.port, port.baudrate, stats["eta_seconds"]))
+
+    sent = 0
+    previous_timeout = port.write_timeout
+    port.write_timeout = stall_seconds
+    start = time.perf_counter()
+    last_progress = start
+    try:
+        if size:
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                with memoryview(data) as view:
+                    while sent < size:
+                        with view[sent:sent + chunk_size] as chunk:
+                            sent += port.write(chunk)
+
+                        now = time.perf_counter()
+                        if now - last_progress >= progress_seconds:
+                            logProgress(sent, size, now - start)
+                            last_progress = now
+
+        drain(port, stall_seconds)
+    except serial.SerialTimeoutException:
+        logger.error("Upload to {} stalled after {} of {} bytes: no data was accepted for {} s".format(
+            port.port, sent, size, stall_seconds))
+        return None
+    finally:
+        port.write_timeout = previous_timeout
+
+    elapsed = time.perf_counter() - start
+    stats["seconds"] = elapsed
+    stats["bytes_per_second"] = size / elapsed if elapsed > 0 else None
+    logger.info("Uploaded {} KB in {:.1f} s ({:.1f} KB/s, {:.0%} of the line rate)".format(
+        size >> 10, elapsed, size / elapsed / 1024 if elapsed > 0 else 0,
+        size / elapsed / line_rate if elapsed > 0 else 0))
+
+    return stats
@@ -0,0 +1,179 @@
+import os
+import time
+import shlex
+import shutil
+import logging
+import tempfile
+import subprocess
+import isp_cache
+
+logger = logging.getLogger()
+
+# How long an idle ssh master connection is kept for later commands and runs
+control_persist_seconds = 300
+
+# Characters of the content hash in the name of a staged file
+name_hash_length = 16
+
+staging_prefix = ".tmp-"
+
+
+# Runs commands on a remote host over ssh, multiplexing every command and copy
+# (and those of later runs, for control_persist_seconds) over one connection
+class SshTransport:
+    def __init__(self, host):
+        self.host = host
+
+        # the socket path must stay short, so it lives in the system temp dir
+        control_dir = os.path.join(tempfile.gettempdir(), "isp-ssh-{}".format(os.getuid()))
+        os.makedirs(control_dir, mode=0o700, exist_ok=True)
+        self.options = ["-o", "ControlMaster=auto",
+                        "-o", "ControlPath={}".format(os.path.join(control_dir, "%C")),
+                        "-o", "ControlPersist={}".format(control_persist_seconds)]
+
+    def run(self, command, log=None):
+        return subprocess.call(["ssh"] + self.options + [self.host, command],
+                               stdout=log, stderr=subprocess.STDOUT)
+
+    def output(self, command, log=None):
+        process = subprocess.run(["ssh"] + self.options + [self.host, command],
+                                 stdout=subprocess.PIPE, stderr=log)
+        return process.returncode, process.stdout.decode(errors="replace")
+
+    def copy(self, local_path, remote_path, log=None):
+        return subprocess.call(["scp", "-q"] + self.options + [local_path, "{}:{}".format(self.host, remote_path)],
+                               stdout=log, stderr=subprocess.STDOUT)
+
+
+# Stand-in for SshTransport that runs the commands on this machine, with
+# "remote" paths being local ones
+class LocalTransport:
+    host = "local"
+
+    def run(self, command, log=None):
+        return subprocess.call(["sh", "-c", command], stdout=log, stderr=subprocess.STDOUT)
+
+    def output(self, command, log=None):
+        process = subprocess.run(["sh", "-c", command], stdout=subprocess.PIPE, stderr=log)
+        return process.returncode, process.stdout.decode(errors="replace")
+
+    def copy(self, local_path, remote_path, log=None):
+        try:
+            shutil.copyfile(local_path, remote_path)
+        except IOError as e:
+            if log:
+                log.write("{}\n".format(e))
+            return 1
+        return 0
+
+
+def transportFor(host):
+    if host == "local":
+        return LocalTransport()
+    return SshTransport(host)
+
+
+def stagedName(path):
+    digest = isp_cache.hashFile(path).hexdigest()[:name_hash_length]
+    return "{}-{}".format(digest, os.path.basename(path))
+
+
+# Files staged in a directory on a remote host, named by their content hash so
+# that a file already staged by an earlier run is not transferred again. Once
+# the directory holds more than max_size bytes, the least recently staged
+# files are removed.
+class RemoteStage:
+    def __init__(self, transport, stage_dir, max_size):
+        self.transport = transport
+        self.stage_dir = stage_dir
+        self.max_size = max_size
+        self.bytes_sent = 0
+        self.files_sent = 0
+        self.files_reused = 0
+
+    def remotePath(self, name):
+        return "{}/{}".format(self.stage_dir.rstrip("/"), name)
+
+    # Lists the staged files as {name: (mtime, size)}, first marking the given
+    # names as used, in one command
+    def listStaged(self, names, log):
+        stage_dir = shlex.quote(self.stage_dir)
+        command = "mkdir -p {0} && cd {0}".format(stage_dir)
+        if names:
+            command += " && touch -c " + " ".join(shlex.quote(name) for name in names)
+        command += " && for f in * .[!.]*; do [ -f \"$f\" ] && stat -c '%Y %s %n' \"$f\"; done; true"
+
+        result, output = self.transport.output(command, log)
+        if result != 0:
+            return None
+
+        staged = {}
+        for line in output.splitlines():
+            fields = line.split(" ", 2)
+            if len(fields) == 3:
+                staged[fields[2]] = (int(fields[0]), int(fields[1]))
+        return staged
+
+    # Names of the least recently used files to remove to bring the stage
+    # under max_size, never including the files in use
+    def evictions(self, staged, in_use):
+        total = sum(size for _, size in staged.values())
+        evicted = []
+        for name, (mtime, size) in sorted(staged.items(), key=lambda item: item[1][0]):
+            if total <= self.max_size:
+                break
+            if name in in_use:
+                continue
+            evicted.append(name)
+            total -= size
+        return evicted
+
+    # Makes the files at paths available on the remote host, transferring only
+    # those it does not have. Returns {local path: remote path}, or None if
+    # the transfer failed
+    def stage(self, paths, log=None):
+        names = {path: stagedName(path) for path in paths}
+
+        staged = self.listStaged(names.values(), log)
+        if staged is None:
+            logger.error("Failed to list the staged files in {} on {}".format(self.stage_dir, self.transport.host))
+            return None
+
+        # copied under a temporary name and renamed once complete, so that an
+        # interrupted copy is never taken for a staged file
+        renames = []
+        for path, name in names.items():
+            if name in staged:
+                logger.debug("{} is already staged as {}".format(os.path.basename(path), name))
+                self.files_reused += 1
+                continue
+
+            logger.debug("Staging {} as {}".format(os.path.basename(path), name))
+            if self.transport.copy(path, self.remotePath(staging_prefix + name), log) != 0:
+                logger.error("Failed to copy {} to {}".format(path, self.transport.host))
+                return None
+
+            size = os.path.getsize(path)
+            staged[name] = (int(time.time()), size)
+            self.bytes_sent += size
+            self.files_sent += 1
+            renames.append(name)
+
+        stale_copies = [name for name in staged if name.startswith(staging_prefix)]
+        for name in stale_copies:
+            del staged[name]
+        evicted = self.evictions(staged, set(names.values()))
+        if evicted:
+            logger.debug("Removing least recently used staged files {}".format(", ".join(evicted)))
+
+        commands = ["cd {}".format(shlex.quote(self.stage_dir))]
+        commands += ["mv -f {} {}".format(shlex.quote(staging_prefix + name), shlex.quote(name)) for name in renames]
+        removals = [name for name in stale_copies if name[len(staging_prefix):] not in renames] + evicted
+        if removals:
+            commands.append("rm -f " + " ".join(shlex.quote(name) for name in removals))
+
+        if len(commands) > 1 and self.transport.run(" && ".join(commands), log) != 0:
+            logger.error("Failed to update the staged files in {} on {}".format(self.stage_dir, self.transport.host))
+            return None
+
+        return {path: self.remotePath(name) for path, name in names.items()}
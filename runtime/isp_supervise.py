@@ -0,0 +1,191 @@
+import os
+import signal
+import asyncio
+import logging
+import isp_utils
+
+logger = logging.getLogger()
+
+# how often log files are checked for new output. Files give no readiness
+# notification, so file watchers sleep between reads instead of spinning
+log_poll_seconds = 0.05
+
+# how long a process is given to exit after SIGTERM before it is killed
+grace_seconds = 5
+
+read_size = 1 << 16
+
+# printed by the PEX kernel when it cannot continue
+unrecoverable_msg = "Unrecoverable failure"
+
+
+async def launch(args, stdout=None, stderr=None, cwd=None, env=None):
+    logger.debug("Launching {}".format(" ".join(args)))
+    return await asyncio.create_subprocess_exec(*args, stdout=stdout, stderr=stderr,
+                                                cwd=cwd, env=env)
+
+
+# Watches a log file written by a simulator for any of patterns, and returns
+# the first one found. Returns None only if cancelled
+async def watchFile(path, patterns, poll_seconds=log_poll_seconds):
+    scanner = isp_utils.LogScanner(path, patterns)
+    try:
+        while True:
+            match = scanner.scan()
+            if match is not None:
+                return match
+            await asyncio.sleep(poll_seconds)
+    finally:
+        scanner.close()
+
+
+# Watches a readable file descriptor (a serial port, pipe or pty) for any of
+# patterns, copying everything read to log (a binary file, if given). Returns
+# the first pattern found, or None at end of file
+async def watchFd(fd, patterns, log=None):
+    loop = asyncio.get_event_loop()
+    encoded = [p.encode() for p in patterns]
+    keep = isp_utils.scanKeep(encoded)
+    tail = b""
+    readable = asyncio.Event()
+
+    os.set_blocking(fd, False)
+    loop.add_reader(fd, readable.set)
+    try:
+        while True:
+            await readable.wait()
+            readable.clear()
+            try:
+                data = os.read(fd, read_size)
+            except BlockingIOError:
+                continue
+            if not data:
+                return None
+
+            if log is not None:
+                log.write(data)
+                log.flush()
+
+            match, tail = isp_utils.scanChunk(tail, data, encoded, keep)
+            if match is not None:
+                return match
+    finally:
+        loop.remove_reader(fd)
+
+
+# Waits for a multiprocessing.Process (or anything else with a sentinel file
+# descriptor) to finish, and returns trigger
+async def watchSentinel(sentinel, trigger):
+    loop = asyncio.get_event_loop()
+    done = asyncio.Event()
+    loop.add_reader(sentinel, done.set)
+    try:
+        await done.wait()
+    finally:
+        loop.remove_reader(sentinel)
+
+    return trigger
+
+
+async def watchEvent(event, trigger):
+    await event.wait()
+    return trigger
+
+
+# Sends SIGTERM to proc (an asyncio subprocess), and SIGKILL if it has not
+# exited within grace seconds
+async def terminate(proc, grace=grace_seconds):
+    if proc.returncode is not None:
+        return proc.returncode
+
+    try:
+        proc.send_signal(signal.SIGTERM)
+        return await asyncio.wait_for(proc.wait(), grace)
+    except ProcessLookupError:
+        pass
+    except asyncio.TimeoutError:
+        logger.warn("Process {} did not exit after SIGTERM, killing it".format(proc.pid))
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass
+
+    return await proc.wait()
+
+
+# Supervises proc (an asyncio subprocess, or None) until it exits, one of
+# watchers (coroutines such as watchFile or watchFd) returns a trigger,
+# timeout seconds (0 for no timeout) pass or stop_event (an asyncio.Event) is
+# set. proc is then terminated. Returns the exitReasons value and the trigger
+# that ended the run, if any
+async def supervise(proc=None, watchers=(), timeout=0, stop_event=None, grace=grace_seconds):
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout if timeout else None
+
+    watch_tasks = [asyncio.ensure_future(w) for w in watchers]
+    pending = set(watch_tasks)
+
+    wait_task = None
+    if proc is not None:
+        wait_task = asyncio.ensure_future(proc.wait())
+        pending.add(wait_task)
+
+    stop_task = None
+    if stop_event is not None:
+        stop_task = asyncio.ensure_future(stop_event.wait())
+        pending.add(stop_task)
+
+    reason = None
+    trigger = None
+    try:
+        while reason is None:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    reason = isp_utils.exitReasons.TIMEOUT
+                    break
+
+            if not pending:
+                reason = isp_utils.exitReasons.PROCESS_EXIT
+                break
+
+            done, pending = await asyncio.wait(pending, timeout=remaining,
+                                               return_when=asyncio.FIRST_COMPLETED)
+
+            # a watcher match takes precedence over the exit it may have caused
+            for task in watch_tasks:
+                if task in done and task.result() is not None:
+                    reason = isp_utils.exitReasons.LOG_MATCH
+                    trigger = task.result()
+                    break
+            else:
+                if wait_task is not None and wait_task in done:
+                    reason = isp_utils.exitReasons.PROCESS_EXIT
+                elif stop_task is not None and stop_task in done:
+                    reason = isp_utils.exitReasons.STOPPED
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+        if proc is not None:
+            await terminate(proc, grace)
+
+    return reason, trigger
+
+
+# Runs a supervision coroutine to completion from synchronous code, on a loop
+# of its own (asyncio.run is not available before Python 3.7). The loop is
+# made the thread's current one, as the child watcher of the main thread
+# reports subprocess exits to that loop. Before Python 3.8 the watcher only
+# serves the main thread, so coroutines that launch processes must be run
+# from it
+def run(coro):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
@@ -2,20 +2,32 @@ import os
 import errno
 import shutil
 import logging
+import tempfile
 import coloredlogs
 import subprocess
-
-from elftools.elf.elffile import ELFFile
+import isp_report
+import isp_manifest
+import isp_elf
 
 # possible module outcomes
 class retVals:
     NO_BIN = "No binary found to run"
     NO_POLICY = "No policy found"
+    NO_PEX = "No PEX binary found"
+    BAD_ARGS = "Invalid arguments"
     TAG_FAIL = "Tagging tools did not produce expected output"
     SUCCESS = "Simulator run successfully"
     FAILURE = "Simulator failed to run to completion"
 
 
+# reasons a supervised process stopped running
+class exitReasons:
+    PROCESS_EXIT = "Process exited"
+    LOG_MATCH = "Log pattern matched"
+    TIMEOUT = "Timed out"
+    STOPPED = "Stopped by request"
+
+
 elf_archs = {
     ("EM_RISCV", 32) : "rv32",
     ("EM_RISCV", 64) : "rv64",
@@ -83,31 +95,93 @@ def setupLogger(level, colors=True):
     return logger
 
 
+def tagInfoCacheKey(exe_path, run_dir, policy_dir, soc_cfg):
+    # isp_cache imports isp_utils, so it can't be imported at module level
+    import isp_cache
+
+    exe_name = os.path.basename(exe_path)
+    entities_path = os.path.join(run_dir, exe_name + ".entities.yml")
+
+    entities_hash = None
+    if os.path.isfile(entities_path):
+        entities_hash = isp_cache.hashFile(entities_path).hexdigest()
+
+    soc_cfg_hash = None
+    if soc_cfg is not None and os.path.isfile(soc_cfg):
+        soc_cfg_hash = isp_cache.hashFile(soc_cfg).hexdigest()
+
+    # the policy directory includes the policy and composite entities files
+    return isp_cache.hashKey(exe_name,
+                             isp_cache.hashFile(exe_path).hexdigest(),
+                             isp_cache.hashTree(policy_dir),
+                             entities_hash,
+                             soc_cfg_hash,
+                             isp_cache.toolId("gen_tag_info"))
+
+
 def generateTagInfo(exe_path, run_dir, policy_dir, soc_cfg=None, arch=None):
+    import isp_cache
+
     policy = os.path.basename(policy_dir).split("-debug")[0]
     exe_name = os.path.basename(exe_path)
-    doMkDir(os.path.join(run_dir, "bininfo"))
-    args = ["gen_tag_info",
-            "--policy_dir", policy_dir,
-            "--tag_file", os.path.join(run_dir, "bininfo", exe_name + ".taginfo"),
-            "--bin", exe_path,
-            "--entities", os.path.join(policy_dir, "policy_entities.yml"),
-            os.path.join(policy_dir, "composite_entities.yml"),
-            os.path.join(run_dir, exe_name + ".entities.yml")]
-    if soc_cfg is not None:
-        args += ["--soc_file", soc_cfg]
-
-    with open(os.path.join(run_dir, "inits.log"), "w+") as initlog:
-        subprocess.Popen(args, stdout=initlog,
-                         stderr=subprocess.STDOUT, cwd=run_dir).wait()
-
-    bininfo_base_path = os.path.join(run_dir, "bininfo", exe_name) + ".{}"
-
-    if not os.path.isfile(bininfo_base_path.format("taginfo")) or \
-       not os.path.isfile(bininfo_base_path.format("text"))    or \
-       not os.path.isfile(bininfo_base_path.format("text.tagged")):
+    bininfo_dir = os.path.join(run_dir, "bininfo")
+    bininfo_base_path = os.path.join(bininfo_dir, exe_name) + ".{}"
+    doMkDir(bininfo_dir)
+
+    # gen_tag_info output only depends on its inputs, so re-runs of the same
+    # binary and policy (e.g. with other rule caches or simulators) reuse it
+    with isp_report.phase("gen_tag_info"):
+        taginfo_cache = isp_cache.ArtifactCache("taginfo", 4096)
+        cache_key = ""
+        if taginfo_cache.enabled or isp_manifest.current_manifest is not None:
+            cache_key = tagInfoCacheKey(exe_path, run_dir, policy_dir, soc_cfg)
+
+        # an incremental run keeps bininfo when its inputs are unchanged
+        taginfo_paths = [bininfo_base_path.format(ext) for ext in ["taginfo", "text", "text.tagged"]]
+        if isp_manifest.upToDate("taginfo", cache_key, taginfo_paths):
+            return True
+
+        cached = taginfo_cache.fetch(cache_key, bininfo_dir)
+        if cached:
+            stats = taginfo_cache.stats()
+            logging.info("Using cached taginfo for {} ({} hits, {} misses)".format(exe_name, stats["hits"], stats["misses"]))
+            with open(os.path.join(run_dir, "inits.log"), "w+") as initlog:
+                initlog.write("Tag info copied from {}\n".format(taginfo_cache.entryPath(cache_key)))
+        else:
+            if taginfo_cache.enabled:
+                stats = taginfo_cache.stats()
+                logging.info("Generating taginfo for {} ({} hits, {} misses)".format(exe_name, stats["hits"], stats["misses"]))
+
+            args = ["gen_tag_info",
+                    "--policy_dir", policy_dir,
+                    "--tag_file", bininfo_base_path.format("taginfo"),
+                    "--bin", exe_path,
+                    "--entities", os.path.join(policy_dir, "policy_entities.yml"),
+                    os.path.join(policy_dir, "composite_entities.yml"),
+                    os.path.join(run_dir, exe_name + ".entities.yml")]
+            if soc_cfg is not None:
+                args += ["--soc_file", soc_cfg]
+
+            with open(os.path.join(run_dir, "inits.log"), "w+") as initlog:
+                subprocess.Popen(args, stdout=initlog,
+                                 stderr=subprocess.STDOUT, cwd=run_dir).wait()
+
+    if not all(os.path.isfile(path) for path in taginfo_paths):
         return False
 
+    if not cached and taginfo_cache.enabled:
+        # bininfo may also hold the tag images of a previous (incremental)
+        # run, which must not be cached with the gen_tag_info outputs
+        staging_dir = tempfile.mkdtemp(prefix=".taginfo-", dir=run_dir)
+        try:
+            for path in taginfo_paths:
+                os.link(path, os.path.join(staging_dir, os.path.basename(path)))
+            taginfo_cache.publish(cache_key, staging_dir)
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+    isp_manifest.record("taginfo", cache_key)
+
     return True
 
 
@@ -130,6 +204,56 @@ def terminateMessage(runtime):
     return ""
 
 
+# Bytes of the previous chunk scanChunk must carry to find any of patterns
+# (encoded) straddling two chunks
+def scanKeep(patterns):
+    return max([len(p) for p in patterns] + [1]) - 1
+
+
+# Scans a chunk of output for patterns, carrying the tail of the previous chunk
+# so that a pattern split across two reads is still found. Returns the matched
+# pattern (or None) and the tail to carry into the next call
+def scanChunk(tail, data, patterns, keep):
+    window = tail + data
+    for pattern in patterns:
+        if pattern in window:
+            return pattern.decode(), b""
+
+    return None, window[-keep:] if keep else b""
+
+
+# Incrementally scans a growing log file for any of a set of patterns, reading
+# only the output appended since the previous scan. The tail of each read is
+# kept so that a pattern straddling two reads is still found.
+class LogScanner:
+    def __init__(self, path, patterns):
+        self.path = path
+        self.patterns = [p.encode() for p in patterns]
+        self.keep = scanKeep(self.patterns)
+        self.tail = b""
+        self.log = None
+
+    # Returns the first pattern found in the new output, or None
+    def scan(self):
+        if self.log is None:
+            try:
+                self.log = open(self.path, "rb")
+            except IOError:
+                return None
+
+        data = self.log.read()
+        if not data:
+            return None
+
+        match, self.tail = scanChunk(self.tail, data, self.patterns, self.keep)
+        return match
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+
 def checkDependency(path, logger, repo=None):
     if not os.path.exists(path):
         if repo:
@@ -148,10 +272,13 @@ def checkDependency(path, logger, repo=None):
 
 
 def getArch(exe_path):
-    exe = open(exe_path, "rb")
-    elf_file = ELFFile(exe)
+    try:
+        elf_info = isp_elf.elfInfo(exe_path)
+    except ValueError as e:
+        logging.error(e)
+        return None
 
-    elf_arch = (elf_file.header["e_machine"], elf_file.elfclass)
+    elf_arch = (elf_info.machineName(), elf_info.elfclass)
 
     if elf_arch in elf_archs:
         return elf_archs[elf_arch]
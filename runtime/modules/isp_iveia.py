@@ -1,8 +1,12 @@
 import isp_utils
+import isp_report
+import isp_supervise
+import isp_pexlog
+import isp_manifest
+import isp_stage
 import os
 import argparse
 import logging
-import subprocess
 import serial
 import pexpect
 import pexpect_serial
@@ -38,26 +42,7 @@ def defaultPexPath(policy_name, soc):
 
 def installPex(soc, policy_dir, output_dir):
     logger.info("Installing pex kernel for iveia")
-    pex_kernel_source_dir = os.path.join(isp_prefix, "sources", "pex-kernel")
-    pex_firmware_source_dir = os.path.join(isp_prefix, "sources", "pex-firmware")
-    policy_name = os.path.basename(policy_dir)
-
-    if not isp_utils.checkDependency(pex_kernel_source_dir, logger):
-        return False
-
-    if not isp_pex_kernel.copyPexKernelSources(pex_kernel_source_dir, output_dir):
-        return False
-
-    if not isp_pex_kernel.copyPolicySources(policy_dir, output_dir, soc):
-        return False
-
-    if not isp_pex_kernel.buildPexKernel(soc, policy_name, output_dir, "gfe"):
-        return False
-
-    if not isp_pex_kernel.movePexKernel(policy_name, output_dir, soc):
-        return False
-
-    return True
+    return isp_pex_kernel.installPexKernel(soc, policy_dir, output_dir, "gfe")
 
 
 #################################
@@ -71,6 +56,13 @@ def parseExtra(extra):
     parser.add_argument("--ap-tty", help="TTY for AP UART (autodetect by default)")
     parser.add_argument("--no-log", action="store_true", help="Do not read from the TTYs. This disables exit handling and output logging")
     parser.add_argument("--iveia-tmp", type=str, default="/opt", help="Temp location on iveia's FS")
+    parser.add_argument("--iveia-host", type=str, default="root@atlas-ii-z8-hp", help='''
+    ssh destination of the iveia board, or "local" to run its commands on this machine
+    ''')
+    parser.add_argument("--stage-max-size", type=int, default=1024, help='''
+    Size in MB above which the least recently used images staged on the board
+    (in <iveia-tmp>/isp-stage) are removed. Default is 1024
+    ''')
     parser.add_argument("--flash-init", type=str, help="Pre-built flash init")
     parser.add_argument("--kernel-address", type=str, default="0x40000000", help='''
     Hex address (0x format) for the kernel load image in the flash init.
@@ -115,6 +107,12 @@ def detectTTY(symlink):
         return None
 
 
+# The TTY given with +pex-tty/+ap-tty, or else the first one matching symlink
+def boardTTY(tty, symlink):
+    if tty:
+        return os.path.realpath(tty)
+    return detectTTY(symlink)
+
 
 def ap_thread(ap_tty, ap_baud_rate, ap_log, runtime):
 
@@ -126,14 +124,26 @@ def ap_thread(ap_tty, ap_baud_rate, ap_log, runtime):
     ap_expect.expect(isp_utils.terminateMessage(runtime))
 
 
-def pex_thread(pex_tty, pex_baud_rate, pex_log):
+def pex_thread(pex_tty, pex_baud_rate, pex_log, stop_on_violation=False):
     pex_serial = serial.Serial(pex_tty, pex_baud_rate, timeout=3000000, bytesize=serial.EIGHTBITS,
                                 parity=serial.PARITY_NONE, xonxoff=False, rtscts=False, dsrdtr=False)
     pex_expect = pexpect_serial.SerialSpawn(pex_serial, timeout=3000000, encoding='utf-8', codec_errors='ignore')
     pex_expect.logfile = pex_log
 
-    pex_expect.expect("Unrecoverable failure")
-    logger.warn("Process failed to run to completion")
+    patterns = [isp_supervise.unrecoverable_msg]
+    if stop_on_violation:
+        patterns += [pattern.decode() for pattern in isp_pexlog.event_patterns.values()]
+
+    if pex_expect.expect(patterns) == 0:
+        logger.warn("Process failed to run to completion")
+
+
+# Waits for the first of the UART reader processes to finish, which happens
+# when it sees the message it is waiting for
+async def waitForHelpers(helpers):
+    watchers = [isp_supervise.watchSentinel(helper.sentinel, helper.name) for helper in helpers]
+    reason, helper_name = await isp_supervise.supervise(watchers=watchers)
+    logger.debug("{} finished".format(helper_name))
 
 
 def tagInit(exe_path, run_dir, policy_dir, soc_cfg, arch, pex_kernel_path,
@@ -148,22 +158,32 @@ def tagInit(exe_path, run_dir, policy_dir, soc_cfg, arch, pex_kernel_path,
         return False
 
     logger.debug("Using flash init file {}".format(flash_init_image_path))
-    if not os.path.exists(flash_init_image_path):
+    # the flash init generated in the run directory is regenerated by an
+    # incremental run when its inputs changed; one given with +flash-init is
+    # used as it is
+    flash_init_key = "{}-{}-{}".format(isp_manifest.stamp(exe_path, tag_file_path, pex_kernel_path),
+                                       kernel_address, ap_address)
+    if os.path.dirname(flash_init_image_path) == run_dir:
+        missing = not isp_manifest.upToDate("flash init", flash_init_key, [flash_init_image_path])
+    else:
+        missing = not os.path.exists(flash_init_image_path)
+
+    if missing:
         logger.info("Generating flash init")
-        isp_load_image.generate_tag_load_image(ap_load_image_path, tag_file_path)
-        isp_load_image.generate_load_image(pex_kernel_path, pex_load_image_path)
+        with isp_report.phase("flash init"):
+            isp_load_image.generate_tag_load_image(ap_load_image_path, tag_file_path)
+            isp_load_image.generate_load_image(pex_kernel_path, pex_load_image_path)
 
-        flash_init_map = {kernel_address:pex_load_image_path,
-                          ap_address:ap_load_image_path}
-        isp_load_image.generate_flash_init(flash_init_image_path, flash_init_map)
+            flash_init_map = {kernel_address:pex_load_image_path,
+                              ap_address:ap_load_image_path}
+            isp_load_image.generate_flash_init(flash_init_image_path, flash_init_map)
+        isp_manifest.record("flash init", flash_init_key)
 
     return True
 
-def runIveiaCmd(cmd, pex_log, run_dir):
-    local_cmd = ["ssh",
-                 "root@atlas-ii-z8-hp"] + cmd
-
-    result = subprocess.call(local_cmd, stdout=pex_log, stderr=subprocess.STDOUT, cwd=run_dir)
+def runIveiaCmd(transport, cmd, pex_log):
+    pex_log.flush()
+    result = transport.run(" ".join(cmd), pex_log)
 
     if result != 0:
         logger.error("Failed to execute command remotely on the iveia board ...")
@@ -172,7 +192,11 @@ def runIveiaCmd(cmd, pex_log, run_dir):
 
     return isp_utils.retVals.SUCCESS
 
-def runPipe(exe_path, ap, pex_tty, pex_baud_rate, pex_log, run_dir, pex_kernel_path, no_log, iveia_tmp):
+def runPipe(exe_path, ap, pex_tty, pex_baud_rate, pex_log, run_dir, pex_kernel_path, no_log, iveia_tmp,
+            stop_on_violation=False, transport=None, stage_max_size=1024):
+    if transport is None:
+        transport = isp_stage.SshTransport("root@atlas-ii-z8-hp")
+
     logger.debug("Connecting PEX uart to {}, baud rate {}".format(pex_tty, pex_baud_rate))
     pex_serial = serial.Serial(pex_tty, pex_baud_rate, timeout=3000000,
             bytesize=serial.EIGHTBITS, parity=serial.PARITY_NONE, xonxoff=False, rtscts=False, dsrdtr=False)
@@ -182,36 +206,36 @@ def runPipe(exe_path, ap, pex_tty, pex_baud_rate, pex_log, run_dir, pex_kernel_p
 
     ap_tags_load_image = os.path.join(run_dir, os.path.basename(exe_path) + ".load_image")
 
-    # before you copy the images to the iveia_tmp, make sure you clear that dir (e.g. remove all the
-    # files in there possibly from other runs )
-#    cmd = ["/bin/rm -f",
-#           iveia_tmp + "/" + os.path.basename(exe_path),
-#           iveia_tmp + "/" + os.path.basename(pex_path),
-#           iveia_tmp + "/" + os.path.basename(exe_path) + ".load_image"]
-#    result1 = runIveiaCmd(cmd, pex_log, run_dir)
-
-
-    load_pex_and_tag_files_args = ["scp",
-                                   pex_kernel_path,
-                                   ap_tags_load_image,
-                                   exe_path,
-                                   "root@atlas-ii-z8-hp:" + iveia_tmp]
-
-    result = subprocess.call(load_pex_and_tag_files_args, stdout=pex_log, stderr=subprocess.STDOUT, cwd=run_dir)
-
-    if result != 0:
+    # images are staged under their content hash and kept for later runs, so
+    # only the ones the board does not have yet are copied
+    stage = isp_stage.RemoteStage(transport, os.path.join(iveia_tmp, "isp-stage"), stage_max_size << 20)
+    upload_paths = [pex_kernel_path, ap_tags_load_image, exe_path]
+    start = time.perf_counter()
+    with isp_report.phase("upload"):
+        pex_log.flush()
+        remote_paths = stage.stage(upload_paths, pex_log)
+    elapsed = time.perf_counter() - start
+    isp_report.record("upload", {"bytes": sum(os.path.getsize(path) for path in upload_paths),
+                                 "bytes_sent": stage.bytes_sent,
+                                 "files_sent": stage.files_sent,
+                                 "files_reused": stage.files_reused,
+                                 "seconds": elapsed,
+                                 "bytes_per_second": stage.bytes_sent / elapsed if elapsed > 0 else None})
+
+    if remote_paths is None:
         logger.error("Failed to copy to iveia board the pex kernel and the ap_tag_info files ...")
-        logger.error("Used command : {} returned {}".format(load_pex_and_tag_files_args, result))
         return isp_utils.retVals.FAILURE
 
+    logger.info("Copied {} of {} images to the iveia board ({} KB)".format(
+        stage.files_sent, len(upload_paths), stage.bytes_sent >> 10))
+
     isp_load_args = ["isp-loader",
-                     iveia_tmp + "/" + os.path.basename(exe_path),
-                     iveia_tmp + "/" + os.path.basename(pex_kernel_path),
-                     iveia_tmp + "/" + os.path.basename(exe_path) +
-                     ".load_image"]
+                     remote_paths[exe_path],
+                     remote_paths[pex_kernel_path],
+                     remote_paths[ap_tags_load_image]]
 
     logger.info("Loading pex kernel and ap tags into the mem space of the PIPE and AP respectively and issuing reset")
-    result = runIveiaCmd(isp_load_args, pex_log, run_dir)
+    result = runIveiaCmd(transport, isp_load_args, pex_log)
 
     if result != isp_utils.retVals.SUCCESS:
         return isp_utils.retVals.FAILURE
@@ -224,13 +248,13 @@ def runPipe(exe_path, ap, pex_tty, pex_baud_rate, pex_log, run_dir, pex_kernel_p
         return isp_utils.retVals.FAILURE
     pex_expect.close()
 
-    pex = multiprocessing.Process(target=pex_thread, args=(pex_tty, pex_baud_rate, pex_log))
+    pex = multiprocessing.Process(target=pex_thread, name="pex", args=(pex_tty, pex_baud_rate, pex_log, stop_on_violation))
     if not no_log:
         pex.start()
 
-    logger.debug("waiting for pex and ap to finish")
-    while pex.is_alive() and ap.is_alive():
-        pass
+    if not no_log:
+        logger.debug("waiting for pex and ap to finish")
+        isp_supervise.run(waitForHelpers([pex, ap]))
 
     ap.terminate()
     pex.terminate()
@@ -238,7 +262,8 @@ def runPipe(exe_path, ap, pex_tty, pex_baud_rate, pex_log, run_dir, pex_kernel_p
     return isp_utils.retVals.SUCCESS
 
 def runSim(exe_path, soc, run_dir, policy_dir, pex_path, runtime, rule_cache,
-           gdb_port, tagfile, soc_cfg, arch, extra, use_validator=False, tag_only=True):
+           gdb_port, tagfile, soc_cfg, arch, extra, use_validator=False, tag_only=True,
+           stop_on_violation=False):
     extra_args = parseExtra(extra)
     ap_log_file = os.path.join(run_dir, "uart.log")
     pex_log_file = os.path.join(run_dir, "pex.log")
@@ -258,34 +283,29 @@ def runSim(exe_path, soc, run_dir, policy_dir, pex_path, runtime, rule_cache,
     ap_log = open(ap_log_file, "w")
     pex_log = open(pex_log_file, "w")
 
-    ap_tty = detectTTY(ap_tty_symlink)
+    ap_tty = boardTTY(extra_args.ap_tty, ap_tty_symlink)
     if not ap_tty:
-        logger.error("Failed to autodetect AP TTY file. If you know the symlink, re-run with the +ap_tty option")
+        logger.error("Failed to autodetect AP TTY file. If you know the symlink, re-run with the +ap-tty option")
         return isp_utils.retVals.FAILURE
 
-    pex_tty = detectTTY(pex_tty_symlink)
+    pex_tty = boardTTY(extra_args.pex_tty, pex_tty_symlink)
     if not pex_tty:
-        logger.error("Failed to autodetect PEX TTY file. If you know the symlink, re-run with the +pex_tty option")
+        logger.error("Failed to autodetect PEX TTY file. If you know the symlink, re-run with the +pex-tty option")
         return isp_utils.retVals.FAILURE
 
-    ap = multiprocessing.Process(target=ap_thread, args=(ap_tty, extra_args.ap_br, ap_log, runtime))
+    ap = multiprocessing.Process(target=ap_thread, name="ap", args=(ap_tty, extra_args.ap_br, ap_log, runtime))
     if not extra_args.no_log:
         logger.debug("Connecting AP uart to {}, baud rate {}".format(ap_tty, extra_args.ap_br))
         ap.start()
 
-    result = runPipe(exe_path, ap, pex_tty, extra_args.pex_br, pex_log, run_dir, pex_path, extra_args.no_log, extra_args.iveia_tmp)
-
-    # clean after yourself - remove any files stored in the iveia_tmp
-    logger.info("Cleaning after yourself ...")
-    cmd = ["/bin/rm -f",
-           extra_args.iveia_tmp + "/" + os.path.basename(exe_path),
-           extra_args.iveia_tmp + "/" + os.path.basename(pex_path),
-           extra_args.iveia_tmp + "/" + os.path.basename(exe_path) + ".load_image"]
-    result1 = runIveiaCmd(cmd, pex_log, run_dir)
-    if result1 != isp_utils.retVals.SUCCESS:
-        logger.warning("Failed to clean after yourself, check out the {} log for details!".format(pex_log))
+    with isp_report.phase("simulation"):
+        result = runPipe(exe_path, ap, pex_tty, extra_args.pex_br, pex_log, run_dir, pex_path,
+                         extra_args.no_log, extra_args.iveia_tmp, stop_on_violation,
+                         isp_stage.transportFor(extra_args.iveia_host), extra_args.stage_max_size)
 
     pex_log.close()
     ap_log.close()
 
+    isp_pexlog.scanFile(pex_log_file, isp_report.current_report).report()
+
     return result
@@ -1,28 +1,35 @@
 import socket
 import select
-import threading
-import time
+import asyncio
 import sys
 import subprocess
 import os
 import logging
 import isp_utils
+import isp_cache
+import isp_report
+import isp_supervise
+import isp_pexlog
+import isp_capture
 import shutil
 import multiprocessing
 
-# set timeout seconds
-timeout_seconds = 3600
+# default timeout seconds, per runtime
+default_timeout_seconds = 3600
+sel4_timeout_seconds = 36000
 
-uart_log_file = "uart.log"
-status_log_file = "pex.log"
+# how often the UART log is checked for the termination message
+uart_poll_seconds = 0.01
 
-process_exit = False
 qemu_base_cmd = "qemu-system-riscv"
 
 logger = logging.getLogger()
 
 isp_prefix = isp_utils.getIspPrefix()
 
+# Policy engine sources that every validator build shares
+engine_sources = ["validator", "tagging_tools", "Makefile.isp", "CMakeLists.txt"]
+
 #################################
 # Build/Install validator
 # Invoked by isp_install_policy
@@ -54,7 +61,10 @@ def copyEngineSources(engine_dir, output_dir):
 def copyPolicySources(policy_dir, output_dir, soc):
     engine_output_dir = os.path.join(output_dir, "engine", "policy")
     try:
-        shutil.copytree(policy_dir, engine_output_dir)
+        # Don't preserve timestamps so that make rebuilds the policy objects
+        # in a shared engine tree
+        isp_utils.removeIfExists(engine_output_dir)
+        shutil.copytree(policy_dir, engine_output_dir, copy_function=shutil.copy)
     except Exception as e:
         logger.error("Copying policy sources failed with error: {}".format(str(e)))
         return False
@@ -103,11 +113,61 @@ def defaultPexPath(policy_name, soc):
     return os.path.join(isp_prefix, "validator", validatorName(policy_name))
 
 
+def engineSourceHash(engine_dir):
+    return isp_cache.hashKey(*[isp_cache.hashTree(os.path.join(engine_dir, source))
+                               for source in engine_sources])
+
+
+# Builds the validator in a persistent engine tree shared by all policies, so
+# that only the objects generated from the policy are rebuilt and relinked.
+# There is one tree per version of the engine sources, and builds in it are
+# serialized with a lock.
+def buildSharedValidator(engine_dir, engine_hash, policy_dir, policy_name, validator_out_path):
+    with isp_cache.sharedBuildTree("engine-build", engine_hash) as build_dir:
+        if not os.path.isdir(os.path.join(build_dir, "engine")):
+            isp_utils.removeIfExists(build_dir)
+            if not copyEngineSources(engine_dir, build_dir):
+                return False
+
+        if not copyPolicySources(policy_dir, build_dir, None):
+            return False
+
+        if not buildValidator(policy_name, build_dir):
+            # Start from a clean tree next time in case the failure left it inconsistent
+            isp_utils.removeIfExists(build_dir)
+            return False
+
+        try:
+            shutil.copy(os.path.join(build_dir, "engine", "build", "librv-sim-validator.so"), validator_out_path)
+        except Exception as e:
+            logger.error("Copying validator to output dir failed with error: {}".format(e))
+            return False
+
+    return True
+
+
 def installPex(soc, policy_dir, output_dir):
     logger.info("Installing policy validator for QEMU")
     engine_dir = os.path.join(isp_prefix, "sources", "policy-engine")
     policy_name = os.path.basename(policy_dir)
-    
+
+    validator_cache = isp_cache.ArtifactCache("validators", 4096)
+    if validator_cache.enabled:
+        validator_out_path = os.path.join(os.path.dirname(output_dir), validatorName(policy_name))
+        engine_hash = engineSourceHash(engine_dir)
+        cache_key = isp_cache.hashKey(engine_hash, isp_cache.hashTree(policy_dir))
+
+        if validator_cache.fetch(cache_key, validator_out_path):
+            logger.info("Using cached validator for {}".format(policy_name))
+            return True
+
+        if not buildSharedValidator(engine_dir, engine_hash, policy_dir, policy_name, validator_out_path):
+            logger.error("Failed to build validator")
+            return False
+
+        validator_cache.publish(cache_key, validator_out_path)
+        return True
+
     if not copyEngineSources(engine_dir, output_dir):
         logger.error("Failed to copy policy engine sources")
         return False
@@ -132,9 +192,39 @@ def installPex(soc, policy_dir, output_dir):
 #################################
 def qemuCommand(run_cmd, env, options):
     args = " ".join([run_cmd] + options)
-    return "LD_LIBRARY_PATH={} {}".format(env["LD_LIBRARY_PATH"], args)
+    return "LD_LIBRARY_PATH={} {}".format(env.get("LD_LIBRARY_PATH", ""), args)
+
+def qemuPath(arch, use_validator=True):
+    qemu_cmd = qemu_base_cmd + '32'
+    if arch == 'rv64':
+        qemu_cmd = qemu_base_cmd + '64'
+
+    if use_validator == False:
+        return os.path.join(os.environ['ISP_PREFIX'],'stock-tools','bin', qemu_cmd)
+
+    return os.path.join(os.environ['ISP_PREFIX'],'bin', qemu_cmd)
+
+def qemuTimeout(runtime):
+    if "sel4" in runtime:
+        return sel4_timeout_seconds
+
+    return default_timeout_seconds
 
-def qemuOptions(exe_path, run_dir, extra, runtime, use_validator=True, gdb_port=0):
+# A free port for an seL4 run to serve its console on. Each run gets its own,
+# as concurrent runs (sessions or isp_run_batch jobs) cannot share one. Ports
+# the kernel picks for bind(0) are spread over the ephemeral range, so runs
+# starting at the same time do not pick the same one
+def sel4SerialPort():
+    probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        probe.bind(("", 0))
+        return probe.getsockname()[1]
+    finally:
+        probe.close()
+
+
+def qemuOptions(exe_path, run_dir, extra, runtime, use_validator=True, gdb_port=0,
+                uart_log_file="uart.log", serial_port=None):
     # Base options for any runtime
     opts = [ "-nographic",
              "-kernel", exe_path,
@@ -149,8 +239,10 @@ def qemuOptions(exe_path, run_dir, extra, runtime, use_validator=True, gdb_port=
     # Machine selection
     if "sel4" in runtime:
         opts += ["-machine", "sifive_u"]
-        opts += ["-serial", "tcp::4445,server,nodelay"]
-        timeout_seconds = 36000
+        if serial_port is None:
+            serial_port = sel4SerialPort()
+        logger.info("seL4 console served on tcp port {}".format(serial_port))
+        opts += ["-serial", "tcp::{},server,nodelay".format(serial_port)]
     else:
         opts += ["-machine", "sifive_e"]
 
@@ -196,96 +288,152 @@ def doValidatorCfg(policy_dir, run_dir, exe_path, rule_cache, soc_cfg, tagfile):
         f.write(validatorCfg)
 
 
-def watchdog():
-    global process_exit
-    for i in range(timeout_seconds * 10):
-        if not process_exit:
-            time.sleep(0.5)
-        else:
-            return
-    logger.warn("Watchdog timeout")
-    process_exit = True
-
-
 def qemuSetupValidatorEnvironment(pex_path, run_dir, arch):
-    os.symlink(pex_path, os.path.join(run_dir, "librv-sim-validator.so"))
+    validator_link = os.path.join(run_dir, "librv-sim-validator.so")
+    # an incremental run keeps the link of the previous run
+    if os.path.lexists(validator_link):
+        os.remove(validator_link)
+    os.symlink(pex_path, validator_link)
     env = dict(os.environ)
     env["LD_LIBRARY_PATH"] = run_dir
 
     return env
 
 
-def launchQEMU(run_dir, runtime, env, options):
-    global process_exit
-    terminate_msg = isp_utils.terminateMessage(runtime)
-    status_log = open(os.path.join(run_dir, status_log_file), "w+")
-
-    try:
-        logger.debug("Running qemu cmd: {}\n".format(qemuCommand(run_cmd, env, options)))
-        rc = subprocess.Popen([run_cmd] + options, env=env, stdout=status_log,
-                              stderr=subprocess.STDOUT)
-        while rc.poll() is None and not process_exit:
-            time.sleep(1)
+# A single QEMU run. The session owns its QEMU process, the monitor of its UART
+# log and its deadline, and keeps no state at module level, so any number of
+# sessions can run concurrently in one interpreter as coroutines on one event
+# loop (runAsync). run() runs a single session and must be called from the main
+# thread, since before Python 3.8 only its event loop is told of subprocess
+# exits. stop() may be called from any thread to end the run early. The validator's output is scanned for policy
+# violations as it is written; with stop_on_violation the first one ends the run.
+# With log_capture (an isp_capture.CaptureSettings) the validator's output is
+# compressed and size-bounded instead of written to pex.log as is. The phases
+# and events of the run are recorded in run_report (an isp_report.RunReport),
+# if given, which concurrent sessions must not share.
+class QemuSession:
+    def __init__(self, run_dir, runtime, run_cmd, env, timeout_seconds=None,
+                 uart_log_file="uart.log", status_log_file="pex.log", stop_on_violation=False,
+                 log_capture=None, run_report=None):
+        self.run_dir = run_dir
+        self.runtime = runtime
+        self.run_cmd = run_cmd
+        self.env = env
+        self.timeout_seconds = timeout_seconds or qemuTimeout(runtime)
+        self.uart_log_path = os.path.join(run_dir, uart_log_file)
+        self.status_log_path = os.path.join(run_dir, status_log_file)
+        self.stop_on_violation = stop_on_violation
+        self.log_capture = log_capture
+        self.run_report = run_report
+        self.pex_scanner = None
+        self.process = None
+        self.exit_reason = None
+        self.stop_requested = False
+        self.stop_event = None
+        self.loop = None
+
+    def command(self, options):
+        return qemuCommand(self.run_cmd, self.env, options)
+
+    def stop(self):
+        self.stop_requested = True
+        if self.loop is not None:
             try:
-                uart_log = open(os.path.join(run_dir, uart_log_file), 'r')
-                uart_output = uart_log.read()
-                uart_log.close()
-                if terminate_msg in uart_output:
-                    rc.terminate()
-                    process_exit = True
-                    return
-            except IOError:
-                #keep trying if fail to open uart log
+                self.loop.call_soon_threadsafe(self.stop_event.set)
+            except RuntimeError:
+                # the run already finished and its loop is closed
                 pass
-            except UnicodeDecodeError:
-                # TODO: is this really what we want to do on this exception?
-                rc.terminate()
-                process_exit = True
-                return;
-        if rc.returncode != 0:
-            raise Exception("exited with return code " + str(rc.returncode))
-    except Exception as e:
-        logger.error("QEMU run failed for exception {}.\n".format(e))
-    finally:
-        process_exit = True
-        rc.terminate()
-
-        # using grep because the pex log can get large when debug is on
-        grep_cmd = ["grep", "Policy Violation\\|TMT miss", os.path.join(run_dir, status_log_file)]
-        grep_results = subprocess.run(grep_cmd, env=env, stdout=subprocess.PIPE);
-        if "Policy Violation" in str(grep_results.stdout):
-            logger.warn("Process exited due to policy violation")
-        if "TMT miss" in str(grep_results.stdout):
-            logger.warn("Process exited due to TMT miss")
 
+    def run(self, options):
+        return isp_supervise.run(self.runAsync(options))
+
+    # Runs QEMU until the runtime prints its termination message, QEMU exits,
+    # the deadline passes or stop() is called, and returns the exitReasons value
+    async def runAsync(self, options):
+        self.stop_event = asyncio.Event()
+        self.loop = asyncio.get_event_loop()
+        if self.stop_requested:
+            self.stop_event.set()
+
+        capture = None
+        if self.log_capture is not None:
+            self.pex_scanner = isp_pexlog.PexLogScanner(run_report=self.run_report)
+            capture = isp_capture.LogCapture(self.status_log_path, self.log_capture, self.pex_scanner)
+        else:
+            self.pex_scanner = isp_pexlog.PexLogScanner(self.status_log_path, self.run_report)
 
-def launchQEMUDebug(run_dir, env, options):
-    status_log = open(os.path.join(run_dir, status_log_file), "w+")
-    logger.debug("Running qemu cmd: {}\n".format(qemuCommand(run_cmd, env, options)))
+        terminate_msg = isp_utils.terminateMessage(self.runtime)
+        watchers = [isp_supervise.watchFile(self.uart_log_path, [terminate_msg], uart_poll_seconds),
+                    isp_pexlog.watchPexLog(self.pex_scanner, self.stop_on_violation)]
 
-    rc = subprocess.Popen([run_cmd] + options, env=env, stdout=status_log)
-    rc.wait()
+        try:
+            status_log = capture.pipe() if capture else open(self.status_log_path, "w+")
+            try:
+                logger.debug("Running qemu cmd: {}\n".format(self.command(options)))
+                self.process = await isp_supervise.launch([self.run_cmd] + options, env=self.env,
+                                                          stdout=status_log, stderr=subprocess.STDOUT)
+            finally:
+                # QEMU holds its own copy
+                if capture:
+                    os.close(status_log)
+                else:
+                    status_log.close()
+
+            if capture:
+                capture.start()
+
+            self.exit_reason, trigger = await isp_supervise.supervise(self.process, watchers,
+                                                                      self.timeout_seconds, self.stop_event)
+
+            if trigger in isp_pexlog.event_patterns:
+                logger.info("Stopping QEMU at the first {}".format(trigger.replace("_", " ")))
+            elif self.exit_reason == isp_utils.exitReasons.TIMEOUT:
+                logger.warn("Watchdog timeout")
+            elif self.exit_reason == isp_utils.exitReasons.PROCESS_EXIT and self.process.returncode != 0:
+                raise Exception("exited with return code " + str(self.process.returncode))
+        except Exception as e:
+            logger.error("QEMU run failed for exception {}.\n".format(e))
+        finally:
+            for watcher in watchers:
+                watcher.close()
+            if self.process is not None:
+                await isp_supervise.terminate(self.process)
+
+            if capture and capture.threads:
+                await asyncio.get_event_loop().run_in_executor(None, capture.close)
+            elif capture:
+                capture.abort()
+
+            # only the output written since the last scan is left to read
+            with isp_report.reportPhase(self.run_report, "log scraping"):
+                self.pex_scanner.finish()
+            self.pex_scanner.close()
+            self.pex_scanner.report()
+
+        return self.exit_reason
+
+    # Runs QEMU waiting for a debugger, with no deadline
+    def runDebug(self, options):
+        with open(self.status_log_path, "w+") as status_log:
+            logger.debug("Running qemu cmd: {}\n".format(self.command(options)))
+            self.process = subprocess.Popen([self.run_cmd] + options, env=self.env, stdout=status_log)
+            self.process.wait()
+
+        self.exit_reason = isp_utils.exitReasons.PROCESS_EXIT
+        return self.exit_reason
 
 
 def runSim(exe_path, soc, run_dir, policy_dir, pex_path, runtime, rule_cache,
-           gdb_port, tagfile, soc_cfg, arch, extra, use_validator=True, tag_only=False):
-    global run_cmd
-    global uart_log_file
-    global status_log_file
-
-    qemu_cmd = qemu_base_cmd + '32'
-    if arch == 'rv64':
-        qemu_cmd = qemu_base_cmd + '64'
-
+           gdb_port, tagfile, soc_cfg, arch, extra, use_validator=True, tag_only=False,
+           stop_on_violation=False, log_capture=None):
+    run_cmd = qemuPath(arch, use_validator)
     env = dict(os.environ)
 
-    if use_validator == False:
-        run_cmd = os.path.join(os.environ['ISP_PREFIX'],'stock-tools','bin', qemu_cmd)
-    else:
-        run_cmd = os.path.join(os.environ['ISP_PREFIX'],'bin', qemu_cmd)
-        env = qemuSetupValidatorEnvironment(pex_path, run_dir, arch)
+    if use_validator == True:
+        with isp_report.phase("simulator setup"):
+            env = qemuSetupValidatorEnvironment(pex_path, run_dir, arch)
 
-        doValidatorCfg(policy_dir, run_dir, exe_path, rule_cache, soc_cfg, tagfile)
+            doValidatorCfg(policy_dir, run_dir, exe_path, rule_cache, soc_cfg, tagfile)
 
         if tagfile is None:
             if isp_utils.generateTagInfo(exe_path, run_dir, policy_dir, arch=arch) is False:
@@ -294,20 +442,19 @@ def runSim(exe_path, soc, run_dir, policy_dir, pex_path, runtime, rule_cache,
     if tag_only is True:
         return isp_utils.retVals.SUCCESS
 
-    options = qemuOptions(exe_path, run_dir, extra, runtime, use_validator, gdb_port)
+    session = QemuSession(run_dir, runtime, run_cmd, env, stop_on_violation=stop_on_violation,
+                          log_capture=log_capture, run_report=isp_report.current_report)
+    serial_port = None
+    if "sel4" in runtime:
+        serial_port = sel4SerialPort()
+        isp_report.record("sel4_console_port", serial_port)
+    options = qemuOptions(exe_path, run_dir, extra, runtime, use_validator, gdb_port, serial_port=serial_port)
 
-    try:
-        logger.debug("Begin QEMU test... (timeout: {})".format(timeout_seconds))
+    logger.debug("Begin QEMU test... (timeout: {})".format(session.timeout_seconds))
+    with isp_report.phase("simulation"):
         if gdb_port != 0:
-            launchQEMUDebug(run_dir, env, options)
+            session.runDebug(options)
         else:
-            wd = threading.Thread(target=watchdog)
-            wd.start()
-            qemu = threading.Thread(target=launchQEMU, args=(run_dir, runtime, env, options))
-            qemu.start()
-            wd.join()
-            qemu.join()
-    finally:
-        pass
+            session.run(options)
 
     return isp_utils.retVals.SUCCESS
@@ -1,13 +1,15 @@
 import isp_utils
+import isp_report
+import isp_supervise
+import isp_pexlog
+import isp_capture
+import isp_manifest
 import os
 import argparse
 import logging
-import multiprocessing
-import pexpect
 import shutil
 import subprocess
 import sys
-import time
 
 sys.path.append(os.path.join(isp_utils.getIspPrefix(), "runtime"))
 import isp_load_image
@@ -61,26 +63,7 @@ def installTagMemHexdump(policy_name, output_dir):
 
 def installPex(soc, policy_dir, output_dir):
     logger.info("Installing pex kernel for VCS")
-    pex_kernel_source_dir = os.path.join(isp_prefix, "sources", "pex-kernel")
-    pex_firmware_source_dir = os.path.join(isp_prefix, "sources", "pex-firmware")
-    policy_name = os.path.basename(policy_dir)
-
-    if not isp_utils.checkDependency(pex_kernel_source_dir, logger):
-        return False
-
-    if not isp_pex_kernel.copyPexKernelSources(pex_kernel_source_dir, output_dir):
-        return False
-
-    if not isp_pex_kernel.copyPolicySources(policy_dir, output_dir, soc):
-        return False
-
-    if not isp_pex_kernel.buildPexKernel(soc, policy_name, output_dir, "gfe-sim"):
-        return False
-
-    if not isp_pex_kernel.movePexKernel(policy_name, output_dir, soc):
-        return False
-
-    return True
+    return isp_pex_kernel.installPexKernel(soc, policy_dir, output_dir, "gfe-sim")
 
 
 #################################
@@ -123,15 +106,18 @@ def validateFileName (fileName):
     else:
         return True
 
-def waitForError(run_dir, pex_uart_log):
-    pex_uart_log_path = os.path.join(run_dir, pex_uart_log)
-    while not os.path.exists(pex_uart_log_path):
-        pass
-    child = pexpect.spawn("tail", ["-f", pex_uart_log_path])
-    child.expect("Unrecoverable failure", timeout=None)
+async def superviseVcs(sim_args, run_dir, connector_trace, ap_trace, pex_uart_log_path, timeout,
+                       pex_scanner, stop_on_violation):
+    proc = await isp_supervise.launch(sim_args, stdout=connector_trace, stderr=ap_trace, cwd=run_dir)
+    watchers = [isp_supervise.watchFile(pex_uart_log_path, [isp_supervise.unrecoverable_msg]),
+                isp_pexlog.watchPexLog(pex_scanner, stop_on_violation)]
+    reason, trigger = await isp_supervise.supervise(proc, watchers, timeout)
+
+    return reason, trigger
+
 
 def runVcsSim(exe_path, ap_hex_dump_path, pex_hex_dump_path, tag_mem_hexdump_path, config, debug, timeout, max_cycles,
-              ap_uart_log, pex_uart_log):
+              ap_uart_log, pex_uart_log, stop_on_violation=False, log_capture=None):
     sim_path = os.path.join(isp_prefix, "vcs", f"simv-galois.system-{config}")
     if debug is True:
         sim_path += "-debug"
@@ -176,30 +162,43 @@ def runVcsSim(exe_path, ap_hex_dump_path, pex_hex_dump_path, tag_mem_hexdump_pat
 
     sim_args.append(exe_path)
 
-    connector_trace = open(connector_trace_path, "w")
-    ap_trace = open(ap_trace_path, "w")
-
-    proc = subprocess.Popen(sim_args, stdout=connector_trace, stderr=ap_trace, cwd=run_dir)
-    tail = multiprocessing.Process(target=waitForError, args=(run_dir, pex_uart_log))
-    sleep = multiprocessing.Process(target=time.sleep, args=(timeout,))
-    tail.start()
-    if timeout != 0:
-        sleep.start()
-    while proc.poll() is None and tail.is_alive() and (timeout == 0 or sleep.is_alive()):
-        pass
-    proc.kill()
-    tail.terminate()
-    if timeout != 0:
-        sleep.terminate()
-
-    connector_trace.close()
-    ap_trace.close()
+    captures = []
+    if log_capture is not None:
+        captures = [isp_capture.LogCapture(connector_trace_path, log_capture),
+                    isp_capture.LogCapture(ap_trace_path, log_capture)]
+        connector_trace, ap_trace = [capture.pipe() for capture in captures]
+        for capture in captures:
+            capture.start()
+    else:
+        connector_trace = open(connector_trace_path, "w")
+        ap_trace = open(ap_trace_path, "w")
+
+    pex_scanner = isp_pexlog.PexLogScanner(pex_uart_log_path, isp_report.current_report)
+    reason, trigger = isp_supervise.run(superviseVcs(sim_args, run_dir, connector_trace, ap_trace,
+                                                     pex_uart_log_path, timeout, pex_scanner, stop_on_violation))
+    logger.info("VCS simulation ended: {}".format(reason))
+    if trigger == isp_supervise.unrecoverable_msg:
+        logger.warn("Process failed to run to completion")
+
+    if captures:
+        os.close(connector_trace)
+        os.close(ap_trace)
+        for capture in captures:
+            capture.close()
+    else:
+        connector_trace.close()
+        ap_trace.close()
+
+    pex_scanner.finish()
+    pex_scanner.close()
+    pex_scanner.report()
 
     return True
 
 
 def runSim(exe_path, soc, run_dir, policy_dir, pex_path, runtime, rule_cache,
-           gdb_port, tagfile, soc_cfg, arch, extra, use_validator=False, tag_only=False):
+           gdb_port, tagfile, soc_cfg, arch, extra, use_validator=False, tag_only=False,
+           stop_on_violation=False, log_capture=None):
     extra_args = parseExtra(extra)
     ap_log_file = os.path.join(run_dir, "uart.log")
     pex_log_file = os.path.join(run_dir, "pex.log")
@@ -213,23 +212,36 @@ def runSim(exe_path, soc, run_dir, policy_dir, pex_path, runtime, rule_cache,
     if isp_utils.generateTagInfo(exe_path, run_dir, policy_dir, soc_cfg=soc_cfg, arch=arch) is False:
         return isp_utils.retVals.TAG_FAIL
 
-    policy = policy_name.replace(debug_suffix, "") if policy_name.endswith(debug_suffix) else policy_name
-    if not shutil.which(f"tag_mem_hexdump-{policy}") and not installTagMemHexdump(policy_name, run_dir):
-        return isp_utils.retVals.NO_BIN
-    logger.info("Generating hex files")
-    tag_mem_hexdump_path = generateTagMemHexdump(run_dir, tag_file_path, policy_name)
-
-    isp_load_image.generate_load_image(exe_path, ap_load_image_path, tag_file_path)
-    isp_load_image.generate_load_image(pex_path, pex_load_image_path)
-    isp_load_image.generate_hex_dump(ap_load_image_path, ap_hex_dump_path, 64)
-    isp_load_image.generate_hex_dump(pex_load_image_path, pex_hex_dump_path, 64)
+    # the hex files only depend on the executable, its tags and the PEX binary,
+    # so an incremental run keeps them unless one of those changed
+    tag_mem_hexdump_path = tag_file_path + ".hex"
+    hex_key = isp_manifest.stamp(exe_path, tag_file_path, pex_path)
+    hex_paths = [tag_mem_hexdump_path, ap_hex_dump_path, pex_hex_dump_path]
+    if not isp_manifest.upToDate("hex files", hex_key, hex_paths):
+        policy = policy_name.replace(debug_suffix, "") if policy_name.endswith(debug_suffix) else policy_name
+        with isp_report.phase("tag_mem_hexdump"):
+            if not shutil.which(f"tag_mem_hexdump-{policy}") and not installTagMemHexdump(policy_name, run_dir):
+                return isp_utils.retVals.NO_BIN
+            logger.info("Generating hex files")
+            tag_mem_hexdump_path = generateTagMemHexdump(run_dir, tag_file_path, policy_name)
+
+        with isp_report.phase("load image"):
+            isp_load_image.generate_load_image(exe_path, ap_load_image_path, tag_file_path)
+            isp_load_image.generate_load_image(pex_path, pex_load_image_path)
+
+        with isp_report.phase("hex dump"):
+            isp_load_image.generate_hex_dump(ap_load_image_path, ap_hex_dump_path, 64)
+            isp_load_image.generate_hex_dump(pex_load_image_path, pex_hex_dump_path, 64)
+
+        isp_manifest.record("hex files", hex_key)
 
     if tag_only is True:
         return isp_utils.retVals.SUCCESS
 
     # XXX: use default logfile names for now, update for parallel sim runs
-    runVcsSim(exe_path, ap_hex_dump_path, pex_hex_dump_path, tag_mem_hexdump_path,
-              extra_args.config, extra_args.debug, extra_args.timeout, extra_args.max_cycles,
-              "uart.log", "pex.log")
+    with isp_report.phase("simulation"):
+        runVcsSim(exe_path, ap_hex_dump_path, pex_hex_dump_path, tag_mem_hexdump_path,
+                  extra_args.config, extra_args.debug, extra_args.timeout, extra_args.max_cycles,
+                  "uart.log", "pex.log", stop_on_violation, log_capture)
 
     return isp_utils.retVals.SUCCESS
@@ -1,4 +1,11 @@
 import isp_utils
+import isp_report
+import isp_supervise
+import isp_pexlog
+import isp_manifest
+import isp_serial
+import isp_cache
+import isp_jtag
 import os
 import argparse
 import logging
@@ -11,6 +18,7 @@ import sys
 import time
 import multiprocessing
 import glob
+import json
 import shutil
 
 sys.path.append(os.path.join(isp_utils.getIspPrefix(), "runtime"))
@@ -21,12 +29,17 @@ logger = logging.getLogger()
 
 isp_prefix = isp_utils.getIspPrefix()
 bitstream_dir = os.path.join(isp_prefix, "vcu118", "bitstreams")
+board_state_dir = os.path.join(isp_prefix, "vcu118", "state")
 
 pex_tty_symlink = "/dev/serial/by-id/usb-FTDI_FT232R_USB_UART_*-if00-port0"
 ap_tty_symlink = "/dev/serial/by-id/usb-Silicon_Labs_CP2105_Dual_USB_to_UART_Bridge_Controller_*-if01-port0"
 
 fpga = "gfe"
 
+default_openocd_port = isp_jtag.default_port
+
+gdb_path = "riscv64-unknown-elf-gdb"
+
 #################################
 # Build/Install PEX kernel
 # Invoked by isp_install_policy
@@ -38,26 +51,7 @@ def defaultPexPath(policy_name, soc):
 
 def installPex(soc, policy_dir, output_dir):
     logger.info("Installing pex kernel for VCU118")
-    pex_kernel_source_dir = os.path.join(isp_prefix, "sources", "pex-kernel")
-    pex_firmware_source_dir = os.path.join(isp_prefix, "sources", "pex-firmware")
-    policy_name = os.path.basename(policy_dir)
-
-    if not isp_utils.checkDependency(pex_kernel_source_dir, logger):
-        return False
-
-    if not isp_pex_kernel.copyPexKernelSources(pex_kernel_source_dir, output_dir):
-        return False
-
-    if not isp_pex_kernel.copyPolicySources(policy_dir, output_dir, soc):
-        return False
-
-    if not isp_pex_kernel.buildPexKernel(soc, policy_name, output_dir, "gfe"):
-        return False
-
-    if not isp_pex_kernel.movePexKernel(policy_name, output_dir, soc):
-        return False
-
-    return True
+    return isp_pex_kernel.installPexKernel(soc, policy_dir, output_dir, "gfe")
 
 
 #################################
@@ -78,11 +72,40 @@ def parseExtra(extra):
     parser.add_argument("--ap-address", type=str, default="0xf8040000", help='''
     Hex address (0x format) for the application processor load image in the flash init.
     ''')
-    parser.add_argument("--bitstream", type=str,
-                        help="Re-program the FPGA with the specified bitstream")
+    parser.add_argument("--bitstream", type=str, help='''
+    Re-program the FPGA with the specified bitstream, unless it was the last one
+    programmed on this board (see +force-program)
+    ''')
+    parser.add_argument("--force-program", action="store_true", help='''
+    Re-program the FPGA with +bitstream even if the board holds it already, e.g.
+    after it was power cycled or programmed by another tool
+    ''')
     parser.add_argument("--no-reset", action="store_true", help="Skip resetting the FPGA")
     parser.add_argument("--reset-address", type=str, default="0x6fff0000", help="Soft reset address (default is 0x6fff0000)")
     parser.add_argument("--board", type=str, default="vcu118", help="Target board: vcu118 or vcu108")
+    parser.add_argument("--pex-br", type=int, default=115200, help="PEX UART baud rate")
+    parser.add_argument("--upload-chunk-size", type=int, default=isp_serial.default_chunk_size, help='''
+    Bytes written to the PEX UART at a time when sending the flash init
+    ''')
+    parser.add_argument("--upload-stall-timeout", type=float, default=isp_serial.default_stall_seconds, help='''
+    Seconds without progress after which sending the flash init fails
+    ''')
+    parser.add_argument("--openocd-cfg", type=str, help='''
+    openocd configuration selecting the board's JTAG adapter
+    (default is $ISP_PREFIX/vcu118/ssith_gfe.cfg)
+    ''')
+    parser.add_argument("--openocd-port", type=int, default=default_openocd_port, help='''
+    Port openocd serves gdb on. Other ports disable openocd's telnet and tcl
+    servers, so that the openocd of several boards can run on one host
+    ''')
+    parser.add_argument("--debug-daemon", action="store_true", help='''
+    Reset, load and start the application through openocd and gdb kept running
+    between runs on this board, rather than starting them for every run
+    ''')
+    parser.add_argument("--delta-flash", action="store_true", help='''
+    Only send the blocks of the flash init that differ from those last sent to
+    the board, falling back to the full flash init if it does not boot
+    ''')
 
     if not extra:
         return parser.parse_args([])
@@ -114,6 +137,51 @@ def detectTTY(symlink):
         return None
 
 
+# The TTY given with +pex-tty/+ap-tty, or else the first one matching symlink
+def boardTTY(tty, symlink):
+    if tty:
+        return os.path.realpath(tty)
+    return detectTTY(symlink)
+
+
+# What was last loaded on the board behind pex_tty, kept across runs so that
+# work the board has already done can be skipped
+def boardStatePath(pex_tty):
+    return os.path.join(board_state_dir, os.path.basename(pex_tty) + ".json")
+
+
+def loadBoardState(pex_tty):
+    try:
+        with open(boardStatePath(pex_tty), "r") as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def saveBoardState(pex_tty, state):
+    isp_utils.doMkDir(board_state_dir)
+    state_path = boardStatePath(pex_tty)
+    with open(state_path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(state_path + ".tmp", state_path)
+
+
+def updateBoardState(pex_tty, **values):
+    state = loadBoardState(pex_tty)
+    state.update(values)
+    saveBoardState(pex_tty, state)
+
+
+# The hash of the bitstream the board behind pex_tty (or the default PEX TTY)
+# was last programmed with, if known. Used by isp_farm to schedule jobs
+def heldBitstream(pex_tty=None):
+    pex_tty = boardTTY(pex_tty, pex_tty_symlink)
+    if pex_tty is None:
+        return None
+
+    return loadBoardState(pex_tty).get("bitstream")
+
+
 def program_fpga(bit_file, ltx_file, board, log_file):
     tcl_script = os.path.join(isp_prefix, "vcu118", "tcl", "prog_bit.tcl")
     args = ["vivado", "-mode", "batch", "-source", tcl_script, "-tclargs", bit_file, ltx_file, board]
@@ -123,25 +191,29 @@ def program_fpga(bit_file, ltx_file, board, log_file):
 
     vivado_log = open(log_file, "w")
 
-    try:
-        result = subprocess.call(args, cwd=bitstream_dir,
-                        stdout=vivado_log, stderr=subprocess.STDOUT)
-    except FileNotFoundError:
-        # Attempt to run vivado_lab is vivado is not found
-        logger.info("Vivado executable not found. Attempting to program using vivado_lab")
-        args[0] = "vivado_lab"
-        result = subprocess.call(args, cwd=bitstream_dir,
-                                stdout=vivado_log, stderr=subprocess.STDOUT)
-
-    # These processes will fail if vivado actually did its cleanup. That's fine.
-    logger.info("Running vivado cleanup. These commands failing likely means vivado did its own cleanup")
-
-    proc_res = subprocess.Popen("rm -f /tmp/digilent-adept2-*", shell=True, stderr=subprocess.STDOUT)
-    proc_res.wait()
-    logger.info(f"{(proc_res.args)} returned {proc_res.returncode}, with output:\n{proc_res.stdout}")
-
-    proc_res = subprocess.run(["killall", "hw_server", "cs_server"], stderr=subprocess.STDOUT)
-    logger.info(f"{(proc_res.args)} returned {proc_res.returncode}, with output:\n{proc_res.stdout}")
+    # the cleanup kills every hw_server on the host, so boards sharing a host
+    # are programmed one at a time
+    isp_utils.doMkDir(board_state_dir)
+    with isp_cache.lockFile(os.path.join(board_state_dir, "vivado.lock")):
+        try:
+            result = subprocess.call(args, cwd=bitstream_dir,
+                            stdout=vivado_log, stderr=subprocess.STDOUT)
+        except FileNotFoundError:
+            # Attempt to run vivado_lab is vivado is not found
+            logger.info("Vivado executable not found. Attempting to program using vivado_lab")
+            args[0] = "vivado_lab"
+            result = subprocess.call(args, cwd=bitstream_dir,
+                                    stdout=vivado_log, stderr=subprocess.STDOUT)
+
+        # These processes will fail if vivado actually did its cleanup. That's fine.
+        logger.info("Running vivado cleanup. These commands failing likely means vivado did its own cleanup")
+
+        proc_res = subprocess.Popen("rm -f /tmp/digilent-adept2-*", shell=True, stderr=subprocess.STDOUT)
+        proc_res.wait()
+        logger.info(f"{(proc_res.args)} returned {proc_res.returncode}, with output:\n{proc_res.stdout}")
+
+        proc_res = subprocess.run(["killall", "hw_server", "cs_server"], stderr=subprocess.STDOUT)
+        logger.info(f"{(proc_res.args)} returned {proc_res.returncode}, with output:\n{proc_res.stdout}")
 
     vivado_log.close()
 
@@ -152,27 +224,85 @@ def program_fpga(bit_file, ltx_file, board, log_file):
     return True
 
 
-def start_openocd(log_file=None):
-    openocd_path = os.path.join(isp_prefix, "bin", "openocd")
-    gfe_cfg_path = os.path.join(isp_prefix, "vcu118", "ssith_gfe.cfg")
+# Which openocd configuration (and so JTAG adapter) and gdb port a run uses,
+# and the board whose debug daemon runs them, if any (see parseExtra)
+class OpenocdSettings:
+    def __init__(self, cfg_path=None, port=default_openocd_port, daemon=None):
+        self.cfg_path = cfg_path or os.path.join(isp_prefix, "vcu118", "ssith_gfe.cfg")
+        self.port = port
+        self.daemon = daemon
+
+    def command(self):
+        return isp_jtag.openocdCommand(os.path.join(isp_prefix, "bin", "openocd"), self.cfg_path, self.port)
+
 
-    if not isp_utils.checkDependency(gfe_cfg_path, logger, "hope-gfe"):
+def start_openocd(log_file=None, settings=None):
+    if settings is None:
+        settings = OpenocdSettings()
+
+    if not isp_utils.checkDependency(settings.cfg_path, logger, "hope-gfe"):
         return None
-    
+
+    args = settings.command()
     if log_file:
         openocd_log = open(log_file, "w")
-        openocd_proc = subprocess.Popen([openocd_path, "-f", gfe_cfg_path], stdout=openocd_log,
+        openocd_proc = subprocess.Popen(args, stdout=openocd_log,
                         stderr=subprocess.STDOUT)
     else:
-        openocd_proc = subprocess.Popen([openocd_path, "-f", gfe_cfg_path])
+        openocd_proc = subprocess.Popen(args)
 
     return openocd_proc
 
 
-def soft_reset(exe_path, reset_address, openocd_log_file, gdb_log_file):
+# Stops the debug daemon of the board behind pex_tty, if one runs, so that
+# other tools can use its JTAG adapter
+def stop_debug_daemon(pex_tty):
+    isp_jtag.stop(isp_jtag.socketPath(os.path.basename(pex_tty)))
+
+
+# Connects to the board's debug daemon, starting it if needed. Its logs are
+# kept with the board's state
+def debug_session(openocd):
+    if not isp_utils.checkDependency(openocd.cfg_path, logger, "hope-gfe"):
+        return None
+
+    isp_utils.doMkDir(board_state_dir)
+    return isp_jtag.session(isp_jtag.socketPath(openocd.daemon), openocd.command(), openocd.port,
+                            gdb_path, os.path.join(board_state_dir, openocd.daemon + ".jtag"))
+
+
+# Loads the application and starts it with the board's debug daemon. Returns
+# the session, to be closed once the run is over, or None on failure
+def debug_session_run(exe_path, openocd):
+    logger.debug("Starting the application with the debug daemon")
+    session = debug_session(openocd)
+    if session is None:
+        return None
+
+    if not session.load(exe_path) or not session.cont():
+        session.close()
+        return None
+
+    return session
+
+
+def soft_reset(exe_path, reset_address, openocd_log_file, gdb_log_file, openocd=None):
+    if openocd is None:
+        openocd = OpenocdSettings()
+
     logger.info("Soft resetting FPGA")
-    openocd_proc = start_openocd(log_file=openocd_log_file)
-    gdb_reset(exe_path, reset_address, gdb_log_file)
+    if openocd.daemon:
+        session = debug_session(openocd)
+        if session is None:
+            return False
+        reset = session.reset(reset_address)
+        session.close()
+        return reset
+
+    openocd_proc = start_openocd(openocd_log_file, openocd)
+    if not openocd_proc:
+        return False
+    gdb_reset(exe_path, reset_address, gdb_log_file, openocd.port)
 
     if openocd_proc.poll():
         logger.error("Openocd process terminated early with code {}".format(openocd_proc.returncode))
@@ -183,7 +313,7 @@ def soft_reset(exe_path, reset_address, openocd_log_file, gdb_log_file):
 
 
 def start_gdb(exe_path, gdb_log=None):
-    child = pexpect.spawn("riscv64-unknown-elf-gdb", [exe_path], encoding="utf-8", timeout=None)
+    child = pexpect.spawn(gdb_path, [exe_path], encoding="utf-8", timeout=None)
     if not gdb_log:
         child.logfile = sys.stdout
     else:
@@ -197,7 +327,7 @@ def send_gdb_command(child, com):
     child.sendline(com)
 
 
-def gdb_reset(exe_path, reset_address, log_file=None):
+def gdb_reset(exe_path, reset_address, log_file=None, port=default_openocd_port):
     if log_file:
         gdb_log = open(log_file, "w")
 
@@ -205,7 +335,7 @@ def gdb_reset(exe_path, reset_address, log_file=None):
 
     send_gdb_command(child, "set style enabled off")
     send_gdb_command(child, "set confirm off")
-    send_gdb_command(child, "target remote :3333")
+    send_gdb_command(child, "target remote :{}".format(port))
     send_gdb_command(child, "set {{int}}{} = 1".format(reset_address))
     child.expect_exact(["(gdb)", ">"])
 
@@ -218,7 +348,7 @@ def gdb_reset(exe_path, reset_address, log_file=None):
         gdb_log.close()
 
 
-def gdb_thread(exe_path, log_file=None, arch="rv32"):
+def gdb_thread(exe_path, log_file=None, arch="rv32", port=default_openocd_port):
     if log_file:
         gdb_log = open(log_file, "w")
 
@@ -226,7 +356,7 @@ def gdb_thread(exe_path, log_file=None, arch="rv32"):
 
     send_gdb_command(child, "set style enabled off")
     send_gdb_command(child, "set confirm off")
-    send_gdb_command(child, "target remote :3333")
+    send_gdb_command(child, "target remote :{}".format(port))
     send_gdb_command(child, "load")
     send_gdb_command(child, "continue")
     logger.info("Process running in gdb")
@@ -248,14 +378,26 @@ def ap_thread(ap_tty, ap_log, runtime):
     ap_expect.expect(isp_utils.terminateMessage(runtime))
 
 
-def pex_thread(pex_tty, pex_log):
-    pex_serial = serial.Serial(pex_tty, 115200, timeout=3000000, bytesize=serial.EIGHTBITS,
+def pex_thread(pex_tty, pex_baud_rate, pex_log, stop_on_violation=False):
+    pex_serial = serial.Serial(pex_tty, pex_baud_rate, timeout=3000000, bytesize=serial.EIGHTBITS,
                                 parity=serial.PARITY_NONE, xonxoff=False, rtscts=False, dsrdtr=False)
     pex_expect = pexpect_serial.SerialSpawn(pex_serial, timeout=3000000, encoding='utf-8', codec_errors='ignore')
     pex_expect.logfile = pex_log
 
-    pex_expect.expect("Unrecoverable failure")
-    logger.warn("Process failed to run to completion")
+    patterns = [isp_supervise.unrecoverable_msg]
+    if stop_on_violation:
+        patterns += [pattern.decode() for pattern in isp_pexlog.event_patterns.values()]
+
+    if pex_expect.expect(patterns) == 0:
+        logger.warn("Process failed to run to completion")
+
+
+# Waits for the first of the UART reader processes to finish, which happens
+# when it sees the message it is waiting for
+async def waitForHelpers(helpers):
+    watchers = [isp_supervise.watchSentinel(helper.sentinel, helper.name) for helper in helpers]
+    reason, helper_name = await isp_supervise.supervise(watchers=watchers)
+    logger.debug("{} finished".format(helper_name))
 
 
 def tagInit(exe_path, run_dir, policy_dir, soc_cfg, arch, pex_kernel_path,
@@ -270,63 +412,141 @@ def tagInit(exe_path, run_dir, policy_dir, soc_cfg, arch, pex_kernel_path,
         return False
     
     logger.debug("Using flash init file {}".format(flash_init_image_path))
-    if not os.path.exists(flash_init_image_path):
+    # the flash init generated in the run directory is regenerated by an
+    # incremental run when its inputs changed; one given with +flash-init is
+    # used as it is
+    flash_init_key = "{}-{}-{}".format(isp_manifest.stamp(exe_path, tag_file_path, pex_kernel_path),
+                                       kernel_address, ap_address)
+    if os.path.dirname(flash_init_image_path) == run_dir:
+        missing = not isp_manifest.upToDate("flash init", flash_init_key, [flash_init_image_path])
+    else:
+        missing = not os.path.exists(flash_init_image_path)
+
+    if missing:
         logger.info("Generating flash init")
-        isp_load_image.generate_tag_load_image(ap_load_image_path, tag_file_path)
-        isp_load_image.generate_load_image(pex_kernel_path, pex_load_image_path)
+        with isp_report.phase("flash init"):
+            isp_load_image.generate_tag_load_image(ap_load_image_path, tag_file_path)
+            isp_load_image.generate_load_image(pex_kernel_path, pex_load_image_path)
 
-        flash_init_map = {kernel_address:pex_load_image_path,
-                          ap_address:ap_load_image_path}
-        isp_load_image.generate_flash_init(flash_init_image_path, flash_init_map)
+            flash_init_map = {kernel_address:pex_load_image_path,
+                              ap_address:ap_load_image_path}
+            isp_load_image.generate_flash_init(flash_init_image_path, flash_init_map)
+        isp_manifest.record("flash init", flash_init_key)
 
     return True
 
 
-def runPipe(exe_path, ap, pex_tty, pex_log, openocd_log_file,
-            gdb_log_file, flash_init_image_path, gdb_port, no_log, arch):
+# How the flash init is sent to the PEX UART (see parseExtra)
+class UploadSettings:
+    def __init__(self, baud_rate=115200, chunk_size=isp_serial.default_chunk_size,
+                 stall_seconds=isp_serial.default_stall_seconds):
+        self.baud_rate = baud_rate
+        self.chunk_size = chunk_size
+        self.stall_seconds = stall_seconds
+
+
+# Writes a flash init to the PEX boot loader and returns whether the PEX
+# kernel then started
+def transferFlashInit(pex_tty, pex_log, flash_init_image_path, upload):
     logger.debug("Connecting to {}".format(pex_tty))
-    pex_serial = serial.Serial(pex_tty, 115200, timeout=3000000,
+    pex_serial = serial.Serial(pex_tty, upload.baud_rate, timeout=3000000,
             bytesize=serial.EIGHTBITS, parity=serial.PARITY_NONE, xonxoff=False, rtscts=False, dsrdtr=False)
 
     pex_expect = pexpect_serial.SerialSpawn(pex_serial, timeout=3000000, encoding='utf-8', codec_errors='ignore')
     pex_expect.logfile = pex_log
-    
+
     logger.info("Sending flash init file {} to {}".format(flash_init_image_path, pex_tty))
-    pex_serial.write(open(flash_init_image_path, "rb").read())
+    stats = isp_serial.uploadFile(pex_serial, flash_init_image_path, upload.chunk_size, upload.stall_seconds)
+    isp_report.record("flash_init_upload", stats)
+    if stats is None:
+        pex_expect.close()
+        return False
     logger.debug("Done writing init file")
 
     found = pex_expect.expect(["Entering idle loop.", "Entering infinite loop.", pexpect.EOF])
-    if found > 0:
-        pex_expect.close()
-        return isp_utils.retVals.FAILURE
     pex_expect.close()
 
-    pex = multiprocessing.Process(target=pex_thread, args=(pex_tty, pex_log))
+    return found == 0
+
+
+# Sends the flash init to the board. With delta_init_path, only the blocks that
+# differ from those the board was last sent (recorded in its state file) are
+# written there and sent. If the board does not boot from them, it is reset
+# with reset (if given) and sent the full flash init
+def sendFlashInit(pex_tty, pex_log, flash_init_image_path, upload, delta_init_path=None, reset=None):
+    blocks = isp_load_image.flash_init_blocks(flash_init_image_path)
+    total = sum(size for entry_blocks in blocks.values() for _, size, _ in entry_blocks)
+    held_blocks = loadBoardState(pex_tty).get("flash_blocks") if delta_init_path else None
+
+    # forgotten until the transfer succeeds, since a failed one leaves the
+    # board's memory in an unknown state
+    updateBoardState(pex_tty, flash_blocks=None)
+
+    if held_blocks:
+        sent = isp_load_image.generate_delta_flash_init(delta_init_path, flash_init_image_path,
+                                                        held_blocks, blocks)
+        logger.info("Sending {} of {} bytes of the flash init that changed since the last run".format(sent, total))
+        if transferFlashInit(pex_tty, pex_log, delta_init_path, upload):
+            updateBoardState(pex_tty, flash_blocks=blocks)
+            return True
+
+        logger.warn("PEX did not start from the delta flash init. Sending the full flash init")
+        if reset is None or not reset():
+            return False
+
+    if not transferFlashInit(pex_tty, pex_log, flash_init_image_path, upload):
+        return False
+
+    updateBoardState(pex_tty, flash_blocks=blocks)
+    return True
+
+
+def runPipe(exe_path, ap, pex_tty, pex_log, openocd_log_file,
+            gdb_log_file, flash_init_image_path, gdb_port, no_log, arch, stop_on_violation=False,
+            delta_init_path=None, reset=None, upload=None, openocd=None):
+    if upload is None:
+        upload = UploadSettings()
+    if openocd is None:
+        openocd = OpenocdSettings()
+
+    with isp_report.phase("flash init transfer"):
+        sent = sendFlashInit(pex_tty, pex_log, flash_init_image_path, upload, delta_init_path, reset)
+    if not sent:
+        return isp_utils.retVals.FAILURE
+
+    pex = multiprocessing.Process(target=pex_thread, name="pex", args=(pex_tty, upload.baud_rate, pex_log, stop_on_violation))
     if not no_log:
         pex.start()
 
-    logger.debug("Spawning openocd")
-    openocd_proc = start_openocd(openocd_log_file)
-    if not openocd_proc:
-        return isp_utils.retVals.FAILURE
+    if openocd.daemon:
+        session = debug_session_run(exe_path, openocd)
+        if session is None:
+            return isp_utils.retVals.FAILURE
+    else:
+        logger.debug("Spawning openocd")
+        openocd_proc = start_openocd(openocd_log_file, openocd)
+        if not openocd_proc:
+            return isp_utils.retVals.FAILURE
 
-    logger.debug("Spawning gdb")
-    gdb = multiprocessing.Process(target=gdb_thread, args=(exe_path, gdb_log_file, arch))
+        logger.debug("Spawning gdb")
+        gdb = multiprocessing.Process(target=gdb_thread, args=(exe_path, gdb_log_file, arch, openocd.port))
 
-    if gdb_port == 0:
-        gdb.start()
+        if gdb_port == 0:
+            gdb.start()
 
     if no_log:
         logger.info("Application is running. Press CTRL-C to exit")
         while True:
-            pass
+            time.sleep(1)
 
     logger.debug("waiting for pex and ap to finish")
-    while pex.is_alive() and ap.is_alive():
-        pass
+    isp_supervise.run(waitForHelpers([pex, ap]))
 
-    openocd_proc.terminate()
-    gdb.terminate()
+    if openocd.daemon:
+        session.close()
+    else:
+        openocd_proc.terminate()
+        gdb.terminate()
 
     ap.terminate()
     pex.terminate()
@@ -335,29 +555,39 @@ def runPipe(exe_path, ap, pex_tty, pex_log, openocd_log_file,
 
 
 def runStock(exe_path, ap, openocd_log_file, gdb_log_file,
-             gdb_port, no_log, arch):
-    logger.debug("Spawning openocd")
-    openocd_proc = start_openocd(openocd_log_file)
-    if not openocd_proc:
-        return isp_utils.retVals.FAILURE
+             gdb_port, no_log, arch, openocd=None):
+    if openocd is None:
+        openocd = OpenocdSettings()
 
-    logger.debug("Spawning gdb")
-    gdb = threading.Thread(target=gdb_thread, args=(exe_path, gdb_log_file, arch))
-    if gdb_port == 0:
-        gdb.start()
+    if openocd.daemon:
+        session = debug_session_run(exe_path, openocd)
+        if session is None:
+            return isp_utils.retVals.FAILURE
+    else:
+        logger.debug("Spawning openocd")
+        openocd_proc = start_openocd(openocd_log_file, openocd)
+        if not openocd_proc:
+            return isp_utils.retVals.FAILURE
+
+        logger.debug("Spawning gdb")
+        gdb = threading.Thread(target=gdb_thread, args=(exe_path, gdb_log_file, arch, openocd.port))
+        if gdb_port == 0:
+            gdb.start()
 
     if no_log:
         logger.info("Application is running. Press CTRL-C to exit")
         while True:
-            pass
+            time.sleep(1)
 
-    while ap.is_alive():
-        pass
+    isp_supervise.run(waitForHelpers([ap]))
 
-    openocd_proc.terminate()
+    if openocd.daemon:
+        session.close()
+    else:
+        openocd_proc.terminate()
 
-    if gdb_port != 0:
-        gdb.join()
+        if gdb_port != 0:
+            gdb.join()
 
     ap.terminate()
 
@@ -365,7 +595,8 @@ def runStock(exe_path, ap, openocd_log_file, gdb_log_file,
 
 
 def runSim(exe_path, soc, run_dir, policy_dir, pex_path, runtime, rule_cache,
-           gdb_port, tagfile, soc_cfg, arch, extra, use_validator=False, tag_only=False):
+           gdb_port, tagfile, soc_cfg, arch, extra, use_validator=False, tag_only=False,
+           stop_on_violation=False):
     extra_args = parseExtra(extra)
     ap_log_file = os.path.join(run_dir, "uart.log")
     pex_log_file = os.path.join(run_dir, "pex.log")
@@ -391,42 +622,96 @@ def runSim(exe_path, soc, run_dir, policy_dir, pex_path, runtime, rule_cache,
     ap_log = open(ap_log_file, "w")
     pex_log = open(pex_log_file, "w")
 
+    ap_tty = boardTTY(extra_args.ap_tty, ap_tty_symlink)
+    if not ap_tty:
+        logger.error("Failed to autodetect AP TTY file. If you know the symlink, re-run with the +ap-tty option")
+        return isp_utils.retVals.FAILURE
+
+    pex_tty = boardTTY(extra_args.pex_tty, pex_tty_symlink)
+    if not pex_tty:
+        logger.error("Failed to autodetect PEX TTY file. If you know the symlink, re-run with the +pex-tty option")
+        return isp_utils.retVals.FAILURE
+
+    # the daemon's gdb would keep a debugger given a port (-g) from connecting
+    daemon = None
+    if extra_args.debug_daemon and gdb_port == 0:
+        daemon = os.path.basename(pex_tty)
+    else:
+        stop_debug_daemon(pex_tty)
+
+    openocd = OpenocdSettings(extra_args.openocd_cfg and os.path.realpath(extra_args.openocd_cfg),
+                              extra_args.openocd_port, daemon)
+
+    reset_needed = not extra_args.no_reset
     if extra_args.bitstream:
         bit_file = os.path.realpath(extra_args.bitstream)
-        ltx_file = os.path.splitext(bit_file)[0] + ".ltx"
-        logger.info("Re-programming FPGA with bitstream {}".format(bit_file))
-        if program_fpga(bit_file, ltx_file, extra_args.board, vivado_log_file) is False:
-            return isp_utils.retVals.FAILURE
-    elif not extra_args.no_reset:
-        if not soft_reset(exe_path, extra_args.reset_address, openocd_log_file, gdb_log_file):
+        bitstream_hash = isp_cache.hashFile(bit_file).hexdigest()
+        programmed = False
+
+        if not extra_args.force_program and loadBoardState(pex_tty).get("bitstream") == bitstream_hash:
+            logger.info("FPGA already holds bitstream {}, skipping re-programming".format(bit_file))
+            if not reset_needed:
+                programmed = True
+            else:
+                with isp_report.phase("soft reset"):
+                    programmed = soft_reset(exe_path, extra_args.reset_address, openocd_log_file, gdb_log_file,
+                                            openocd)
+                if not programmed:
+                    logger.warn("Soft reset failed. Re-programming FPGA")
+            reset_needed = False
+
+        isp_report.record("bitstream", {"hash": bitstream_hash, "programmed": not programmed})
+        if not programmed:
+            ltx_file = os.path.splitext(bit_file)[0] + ".ltx"
+            logger.info("Re-programming FPGA with bitstream {}".format(bit_file))
+            # programming clears the memory the flash init was loaded to, and
+            # what the FPGA holds is unknown until it succeeds
+            updateBoardState(pex_tty, flash_blocks=None, bitstream=None)
+            stop_debug_daemon(pex_tty)
+            with isp_report.phase("fpga programming"):
+                programmed = program_fpga(bit_file, ltx_file, extra_args.board, vivado_log_file)
+            if programmed is False:
+                return isp_utils.retVals.FAILURE
+            updateBoardState(pex_tty, bitstream=bitstream_hash)
+            reset_needed = False
+
+    if reset_needed:
+        with isp_report.phase("soft reset"):
+            reset = soft_reset(exe_path, extra_args.reset_address, openocd_log_file, gdb_log_file, openocd)
+        if not reset:
             logger.error('''
             Soft reset failed. Please re-program the FPGA by providing a +bitstream argument or with the command:
             vivado -mode batch -source $ISP_PREFIX/vcu118/tcl/prog_bit.tcl -tclargs <bitstream> <ltx> vcu118
             ''')
             return isp_utils.retVals.FAILURE
 
-    ap_tty = detectTTY(ap_tty_symlink)
-    if not ap_tty:
-        logger.error("Failed to autodetect AP TTY file. If you know the symlink, re-run with the +ap_tty option")
-        return isp_utils.retVals.FAILURE
-
-    pex_tty = detectTTY(pex_tty_symlink)
-    if not pex_tty:
-        logger.error("Failed to autodetect PEX TTY file. If you know the symlink, re-run with the +pex_tty option")
-        return isp_utils.retVals.FAILURE
-
-    ap = multiprocessing.Process(target=ap_thread, args=(ap_tty, ap_log, runtime))
+    ap = multiprocessing.Process(target=ap_thread, name="ap", args=(ap_tty, ap_log, runtime))
     if not extra_args.no_log:
         logger.debug("Connecting to {}".format(ap_tty))
         ap.start()
 
-    if extra_args.stock:
-        result = runStock(exe_path, ap, openocd_log_file, gdb_log_file, gdb_port, extra_args.no_log, arch)
-    else:
-        result = runPipe(exe_path, ap, pex_tty, pex_log, openocd_log_file,
-                         gdb_log_file, flash_init_image_path, gdb_port, extra_args.no_log, arch)
+    with isp_report.phase("simulation"):
+        if extra_args.stock:
+            result = runStock(exe_path, ap, openocd_log_file, gdb_log_file, gdb_port, extra_args.no_log, arch,
+                              openocd)
+        else:
+            delta_init_path = None
+            reset = None
+            if extra_args.delta_flash:
+                delta_init_path = os.path.join(run_dir, "delta.init")
+                if not extra_args.no_reset:
+                    reset = lambda: soft_reset(exe_path, extra_args.reset_address, openocd_log_file, gdb_log_file,
+                                               openocd)
+
+            upload = UploadSettings(extra_args.pex_br, extra_args.upload_chunk_size,
+                                    extra_args.upload_stall_timeout)
+            result = runPipe(exe_path, ap, pex_tty, pex_log, openocd_log_file,
+                             gdb_log_file, flash_init_image_path, gdb_port, extra_args.no_log, arch,
+                             stop_on_violation, delta_init_path, reset, upload, openocd)
 
     pex_log.close()
     ap_log.close()
 
+    isp_pexlog.scanFile(pex_log_file, isp_report.current_report).report()
+
     return result